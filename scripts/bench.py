@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: UTF8 -*-
+''' throughput benchmarks
+    usage: bench.py [name ...]
+'''
+import glob
+import logging
+import os
+import sys
+import time
+
+DIR = os.path.dirname(sys.argv[0])
+PROJECT_PATH = os.path.join(DIR, '..')
+SOURCE_PATH = os.path.join(PROJECT_PATH, 'src')
+TESTS_PATH = os.path.join(PROJECT_PATH, 'tests')
+sys.path.append(SOURCE_PATH)
+
+import log
+from shogi import kifu
+from shogi.position import Position, SFEN_STARTPOS
+
+PERFT_DEPTH = 3
+
+def _load_sfens():
+  sfens = [SFEN_STARTPOS]
+  with open(os.path.join(TESTS_PATH, 'sfen', 'checkmates.sfen'), 'r', encoding = 'UTF8') as f:
+    sfens.extend(s.rstrip() for s in f)
+  for fn in sorted(glob.glob(os.path.join(TESTS_PATH, 'wars', '*.kif')))[:50]:
+    with open(fn, 'r', encoding = 'UTF8') as f:
+      g = kifu.game_parse(f.read())
+    if not g is None:
+      sfens.extend(g.positions().values())
+  return sfens
+
+def _report(name: str, n: int, t: float, unit: str = 'nodes'):
+  print(f'{name:<24} {n:>10} {unit} {t:8.3f}s {n / t:12.0f} {unit}/s')
+
+def bench_movegen(sfens):
+  positions = [Position(s) for s in sfens]
+  t = time.perf_counter()
+  moves = [pos.legal_moves() for pos in positions]
+  _report('legal_moves', sum(len(l) for l in moves), time.perf_counter() - t)
+  t = time.perf_counter()
+  for pos in positions:
+    pos.is_check()
+    pos.is_legal()
+  _report('is_check/is_legal', 2 * len(positions), time.perf_counter() - t)
+  n = 0
+  t = time.perf_counter()
+  for pos, l in zip(positions, moves):
+    for m in l:
+      u = pos.do_move(m)
+      pos.undo_move(m, u)
+    n += len(l)
+  _report('do_move/undo_move', n, time.perf_counter() - t)
+  t = time.perf_counter()
+  for pos, l in zip(positions, moves):
+    for m in l:
+      m.legal = 0
+      u = pos.try_move(m)
+      pos.undo_move(m, u)
+  _report('try_move/undo_move', n, time.perf_counter() - t)
+  pos = Position()
+  t = time.perf_counter()
+  n = pos.perft(PERFT_DEPTH)
+  _report(f'perft({PERFT_DEPTH})', n, time.perf_counter() - t)
+
+def bench_sfen(sfens):
+  t = time.perf_counter()
+  for s in sfens:
+    Position(s).sfen()
+  _report('Position(sfen).sfen()', len(sfens), time.perf_counter() - t, 'sfens')
+  t = time.perf_counter()
+  for s in sfens:
+    Position.from_sfen(s).sfen()
+  _report('from_sfen(sfen).sfen()', len(sfens), time.perf_counter() - t, 'sfens')
+  positions = [Position.from_sfen(s) for s in sfens]
+  t = time.perf_counter()
+  for _ in range(10):
+    for pos in positions:
+      pos.sfen()
+  _report('cached sfen()', 10 * len(sfens), time.perf_counter() - t, 'sfens')
+
+def _load_kifs():
+  r = []
+  for d in ['wars', '81dojo']:
+    for fn in sorted(glob.glob(os.path.join(TESTS_PATH, d, '*.kif'))):
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        r.append(f.read())
+  return r
+
+def bench_kifu(_sfens):
+  kifs = _load_kifs()
+  for name, parser in [('KifuParser(fast = False)', kifu.KifuParser(fast = False)), ('KifuParser()', kifu.KifuParser())]:
+    t = time.perf_counter()
+    for s in kifs:
+      parser.parse(s)
+    _report(name, len(kifs), time.perf_counter() - t, 'games')
+  tokens = []
+  for s in kifs:
+    g = kifu.game_parse(s)
+    prev_move = None
+    for m in g.moves:
+      tokens.append((m.kifu_str(prev_move), 1 if m.to_piece > 0 else -1, prev_move))
+      prev_move = m
+  for name, f in [('move_parse', kifu.move_parse), ('move_parse_fast', kifu.move_parse_fast)]:
+    t = time.perf_counter()
+    for s, side, prev_move in tokens:
+      f(s, side, prev_move)
+    _report(name, len(tokens), time.perf_counter() - t, 'moves')
+
+BENCHMARKS = {
+  'kifu': bench_kifu,
+  'movegen': bench_movegen,
+  'sfen': bench_sfen,
+}
+
+def main():
+  log.init_logging(None, logging.WARNING)
+  names = sys.argv[1:] or list(BENCHMARKS)
+  sfens = _load_sfens()
+  print(f'{len(sfens)} positions')
+  for name in names:
+    BENCHMARKS[name](sfens)
+
+main()
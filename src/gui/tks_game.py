@@ -26,42 +26,12 @@ def _timedelta_to_str(t: Optional[timedelta]) -> str:
     return ''
   return str(t)
 
-class _Positions:
-  def __init__(self, game: Game):
-    self._game = game
-    self._sfens = []
-  def goto_move(self, move_no: int) -> Position:
-    if move_no == 0:
-      return Position()
-    while move_no >= len(self._sfens):
-      self._sfens.append(None)
-    sfen = self._sfens[move_no]
-    if not sfen is None:
-      return Position(sfen)
-    i = move_no
-    while (i >= 0) and (self._sfens[i] is None):
-      i -= 1
-    if i < 0:
-      pos = Position()
-      i = 0
-    else:
-      pos = Position(self._sfens[i])
-    cur_move = i
-    for j in range(i, move_no):
-      if j >= len(self._game.moves):
-        break
-      m = self._game.moves[j]
-      pos.do_move(m)
-      cur_move = j + 1
-    self._sfens[cur_move] = pos.sfen()
-    return pos
-
 class TableMoves:
   def __init__(self, game_window):
     view_font = game_window.table_font
     parent = game_window.frame2
     game = game_window.game
-    self._positions = _Positions(game)
+    self._cursor = game.cursor()
     self._game_window = game_window
     columns = ('move_no', 'kifu', 'time', 'cum_time', 'score')
     self.table = table.Table(parent, 'TableMoves', columns, view_font, tk.BROWSE)
@@ -90,7 +60,7 @@ class TableMoves:
     logging.debug('Select item %s, event %s', item, event)
     self.goto_move(int(item[0]))
   def goto_move(self, move_no: int):
-    pos = self._positions.goto_move(move_no)
+    pos = self._cursor.seek(move_no)
     self._game_window.draw_position(pos)
     m = None
     if move_no > 0:
@@ -2,6 +2,7 @@
 
 import hashlib
 import functools
+import io
 import logging
 import lzma
 import os
@@ -13,9 +14,9 @@ from elo_rating import performance
 import shogi
 from shogi.game import Game
 from shogi.history import PositionWithHistory
-from shogi.move import Move
 from shogi.position import Position
-from shogi.kifu import TimeControl, game_parse
+from shogi import ndjson
+from shogi.kifu import KifuParser, TimeControl, game_parse, game_write_to_file
 from shogi.piece import side_to_str
 #import usi
 
@@ -256,17 +257,44 @@ class KifuDB:
     with open(filename, 'r', encoding = 'UTF8') as f:
       kifu = f.read()
       return self._insert_kifu_data(filename, kifu)
-  def _insert_kifu_data(self, filename: str, data: str) -> bool:
-    b = bytes(data, 'UTF8')
+  def _find_game_by_data(self, b: bytes) -> Tuple[str, Optional[int]]:
     kifu_md5 = _md5_digest(b)
     rowid = self.find_game_by_kifu_md5(kifu_md5)
     if not rowid is None:
       logging.info('KIFU file has been already inserted in DB (rowid = %d).', rowid)
+    return (kifu_md5, rowid)
+  def _insert_kifu_data(self, filename: str, data: str) -> bool:
+    b = bytes(data, 'UTF8')
+    kifu_md5, rowid = self._find_game_by_data(b)
+    if not rowid is None:
       return False
     g = game_parse(data)
     if g is None:
       logging.warning("Can not parse KIFU file '%s'", os.path.basename(filename))
       return False
+    self._insert_game(g, b, kifu_md5)
+    return True
+  def insert_game(self, g: Game) -> bool:
+    '''game is stored as KIF, returns False if the same KIF has been already inserted'''
+    f = io.StringIO()
+    game_write_to_file(g, f)
+    b = bytes(f.getvalue(), 'UTF8')
+    kifu_md5, rowid = self._find_game_by_data(b)
+    if not rowid is None:
+      return False
+    self._insert_game(g, b, kifu_md5)
+    return True
+  def insert_ndjson_file(self, filename: str, workers: Optional[int] = None) -> int:
+    '''games of NDJSON export or USI position lines (see shogi.ndjson) are validated on a process pool,
+       returns number of inserted games'''
+    n = 0
+    with open(filename, 'rb') as f:
+      #games are loaded back without validation (see load_game()), so they are always validated here
+      for cg in ndjson.parse_parallel(f, skip_errors = True, workers = workers):
+        if self.insert_game(cg.to_game()):
+          n += 1
+    return n
+  def _insert_game(self, g: Game, b: bytes, kifu_md5: str):
     data = lzma.compress(b)
     fields = ['sente', 'gote', 'start_date', 'sente_rating', 'gote_rating', 'time_control']
     v = g.get_row_values_from_tags(fields)
@@ -286,19 +314,16 @@ class KifuDB:
     self.insert_values('kifus', fields, v)
     rowid = self.find_game_by_kifu_md5(kifu_md5)
     assert not rowid is None
-    pos = shogi.position.Position()
+    pos = shogi.position.Position(g.start_pos)
     vals = []
     for m in g.moves:
       sfen = pos.sfen()
-      try:
-        pos.do_move(m)
-      except shogi.move.IllegalMove:
+      if pos.try_move(m) is None:
         break
       h1, h2 = sfen_hashes(sfen)
       vals.append([h1, h2, m.pack_to_int(), rowid])
     fields = ['pos_hash1', 'pos_hash2', 'move', 'game']
     self.insert_many_values('moves',  fields, vals)
-    return True
   def time_control_stats(self):
     q = '''SELECT time_controls.time_control, COUNT(*) as c FROM kifus
 INNER JOIN time_controls ON time_controls.rowid == kifus.time_control
@@ -354,8 +379,7 @@ ORDER BY c DESC
       else:
         ms = moves.pop()
         if ms.games >= max_games:
-          m = Move.unpack_from_int(ms.packed_move, pos.side_to_move)
-          pos.do_move(m)
+          pos.do_move(ms.packed_move)
           r.append((ms.performance(), ms.games, ms.percent, pos.kifu_line(), pos.sfen()))
           stack.append(moves)
           moves = self.moves_with_stats(pos, player_and_tc)
@@ -442,7 +466,8 @@ ORDER BY b
     kifu = self.find_data_by_game_id(game_id)
     if kifu is None:
       return None
-    return game_parse(kifu)
+    #games were validated at insertion
+    return KifuParser(trusted = True).parse(kifu)
   def make_player_and_tc_filter(self, game: Game) -> Optional[PlayerAndTimeControlFilter]:
     player = self.player_with_most_games()
     if player is None:
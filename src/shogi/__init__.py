@@ -1,14 +1,23 @@
 # -*- coding: UTF8 -*-
 ''' shogi rules (move generation, etc.) '''
 
+from . import bitboard
+from . import bulk
 from . import castles
 from . import csa
 from . import cell
+from . import compact
 from . import evaluation
+from . import halfkp
 from . import history
 from . import kifu
 from . import move
+from . import ndjson
 from . import openings
 from . import piece
 from . import position
 from . import psn
+from . import reader
+from . import tree
+from . import tsume
+from . import zobrist
@@ -1,6 +1,7 @@
 # -*- coding: UTF8 -*-
 
 from os import getenv
+from typing import Iterator
 
 def iter_is_empty(it):
   for _ in it:
@@ -16,3 +17,14 @@ def lang() -> str:
 def sfen_moveno(s: str) -> int:
   a = s.split()
   return int(a[3])
+
+def iter_lines(text_or_stream, encoding: str = 'UTF8') -> Iterator[str]:
+  '''lines (without end of line characters) of string, text stream or binary stream, streams are read lazily'''
+  if isinstance(text_or_stream, str):
+    for s in text_or_stream.split('\n'):
+      yield s.rstrip('\r')
+    return
+  for s in text_or_stream:
+    if isinstance(s, bytes):
+      s = s.decode(encoding)
+    yield s.rstrip('\r\n')
@@ -53,7 +53,6 @@ class PositionForPatternRecognition(position.Position):
     self.last_move = None
     self._count_moves_d = {}
     self._was_drops = False
-    self._cached_sfen = None
     self._patterns_d = {}
     self._sente_unmovable_pieces = 511
     self._gote_unmovable_pieces = 511
@@ -115,7 +114,8 @@ class PositionForPatternRecognition(position.Position):
   def get_pattern_match(self, key: str):
     return self._patterns_d[key]
   def do_move(self, m: Move):
-    self._cached_sfen = None
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, self.side_to_move)
     self._moves_destination_s.add((m.to_piece, m.to_cell))
     if self.side_to_move > 0:
       if not m.from_cell is None:
@@ -181,12 +181,6 @@ class PositionForPatternRecognition(position.Position):
     if (not self._was_drops) and m.is_drop():
       self._was_drops = True
     #self._check_pawns()
-  def sfen(self, move_no = True) -> str:
-    if not move_no:
-      return super().sfen(move_no)
-    if self._cached_sfen is None:
-      self._cached_sfen = super().sfen()
-    return self._cached_sfen
   def _rook_in_the_camp(self, side: int) -> bool:
     ''' unoptimized version for testing prototype'''
     a, s = (self.board[4*9:], set([piece.ROOK, piece.DRAGON])) if side > 0 else (self.board[:5*9], set([-piece.ROOK, -piece.DRAGON]))
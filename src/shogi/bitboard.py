@@ -0,0 +1,162 @@
+# -*- coding: UTF8 -*-
+''' 81-bit integer bitboards (bit 9 * row + col) and precomputed attack masks '''
+
+from typing import List, Tuple
+
+from . import cell
+from . import piece
+
+FULL = (1 << 81) - 1
+
+#index of piece p in the per piece bitboards list
+OFFSET = piece.DRAGON
+
+#(dr, dc), dr < 0 is the direction to the gote camp
+DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+UP, DOWN = 0, 1
+ROOK_DIRECTIONS = [0, 1, 2, 3]
+BISHOP_DIRECTIONS = [4, 5, 6, 7]
+
+def side_index(side: int) -> int:
+  return 0 if side > 0 else 1
+
+def cells(b: int):
+  '''iterates over set bits of bitboard'''
+  while b:
+    t = b & -b
+    yield t.bit_length() - 1
+    b ^= t
+
+def _build_rays() -> List[List[int]]:
+  t = []
+  for dr, dc in DIRECTIONS:
+    a = []
+    for k in range(81):
+      r, c = divmod(k, 9)
+      m = 0
+      while True:
+        r += dr
+        c += dc
+        if not ((0 <= r < 9) and (0 <= c < 9)):
+          break
+        m |= 1 << (9 * r + c)
+      a.append(m)
+    t.append(a)
+  return t
+
+def _build_step_attacks(side: int) -> List[List[int]]:
+  t = [None] * (piece.DRAGON + 1)
+  for p in range(1, piece.DRAGON + 1):
+    dirs = piece.MOVE_TABLE[p]
+    if dirs is None:
+      continue
+    a = []
+    for k in range(81):
+      r, c = divmod(k, 9)
+      m = 0
+      for dr, dc, sliding in dirs:
+        if sliding:
+          continue
+        y, x = r + side * dr, c + dc
+        if (0 <= y < 9) and (0 <= x < 9):
+          m |= 1 << (9 * y + x)
+      a.append(m)
+    t[p] = a
+  return t
+
+RAYS = _build_rays()
+#nearest cell along decreasing direction is the highest bit
+_DECREASING = [9 * dr + dc < 0 for dr, dc in DIRECTIONS]
+#step (non sliding) attacks of piece p placed on cell k: STEP_ATTACKS[side_index(side)][p][k]
+STEP_ATTACKS = (_build_step_attacks(1), _build_step_attacks(-1))
+
+def _build_step_attacks_by_piece() -> List[List[int]]:
+  empty = [0] * 81
+  t = [empty] * (2 * piece.DRAGON + 1)
+  for side in (1, -1):
+    for p, a in enumerate(STEP_ATTACKS[side_index(side)]):
+      if not a is None:
+        t[side * p + OFFSET] = a
+  return t
+
+#STEP_ATTACKS indexed by signed piece: STEP_ATTACKS_BY_PIECE[p + OFFSET][k]
+STEP_ATTACKS_BY_PIECE = _build_step_attacks_by_piece()
+#cells from which a step piece could attack given cell (king moves and both sides knight jumps)
+NEIGHBOURS = [STEP_ATTACKS[0][piece.KING][k] | STEP_ATTACKS[0][piece.KNIGHT][k] | STEP_ATTACKS[1][piece.KNIGHT][k] for k in range(81)]
+ROOK_RAYS = [RAYS[0][k] | RAYS[1][k] | RAYS[2][k] | RAYS[3][k] for k in range(81)]
+BISHOP_RAYS = [RAYS[4][k] | RAYS[5][k] | RAYS[6][k] | RAYS[7][k] for k in range(81)]
+
+def _build_between() -> List[List[int]]:
+  t = [[0] * 81 for _ in range(81)]
+  for a in range(81):
+    for d in range(len(DIRECTIONS)):
+      for b in cells(RAYS[d][a]):
+        t[a][b] = RAYS[d][a] ^ RAYS[d][b] ^ (1 << b)
+  return t
+
+def _build_drop_masks() -> List[int]:
+  t = [FULL] * (2 * piece.DRAGON + 1)
+  for p in range(1, piece.KING):
+    for side in (1, -1):
+      t[side * p + OFFSET] = sum(1 << k for k in range(81) if cell.can_drop(k, side * p))
+  return t
+
+#cells strictly between a and b if they are on the same line: BETWEEN[a][b]
+BETWEEN = _build_between()
+#cells where unpromoted piece still has moves (legal drop or move without promotion): DROP_MASKS[p + OFFSET]
+DROP_MASKS = _build_drop_masks()
+PROMOTION_ZONES = ((1 << 27) - 1, FULL ^ ((1 << 54) - 1))
+FILES = [sum(1 << (9 * row + col) for row in range(9)) for col in range(9)]
+
+def first_blocker(d: int, k: int, occupied: int) -> int:
+  '''nearest occupied cell from k in direction d or -1'''
+  b = RAYS[d][k] & occupied
+  if b == 0:
+    return -1
+  if _DECREASING[d]:
+    return b.bit_length() - 1
+  return (b & -b).bit_length() - 1
+
+def ray_attacks(d: int, k: int, occupied: int) -> int:
+  '''cells attacked from k in direction d including the first blocker'''
+  ray = RAYS[d][k]
+  j = first_blocker(d, k, occupied)
+  if j < 0:
+    return ray
+  return ray ^ RAYS[d][j]
+
+def rook_attacks(k: int, occupied: int) -> int:
+  return ray_attacks(0, k, occupied) | ray_attacks(1, k, occupied) | ray_attacks(2, k, occupied) | ray_attacks(3, k, occupied)
+
+def bishop_attacks(k: int, occupied: int) -> int:
+  return ray_attacks(4, k, occupied) | ray_attacks(5, k, occupied) | ray_attacks(6, k, occupied) | ray_attacks(7, k, occupied)
+
+def lance_attacks(k: int, side: int, occupied: int) -> int:
+  return ray_attacks(UP if side > 0 else DOWN, k, occupied)
+
+def piece_attacks(p: int, k: int, occupied: int) -> int:
+  '''cells attacked by piece p (with sign) placed on cell k'''
+  r = STEP_ATTACKS_BY_PIECE[p + OFFSET][k]
+  a = abs(p)
+  if a == piece.LANCE:
+    r |= lance_attacks(k, p, occupied)
+  elif a in (piece.BISHOP, piece.HORSE):
+    r |= bishop_attacks(k, occupied)
+  elif a in (piece.ROOK, piece.DRAGON):
+    r |= rook_attacks(k, occupied)
+  return r
+
+def from_board(board: List[int]) -> Tuple[List[int], int, int]:
+  '''(per piece bitboards, sente occupancy, gote occupancy)'''
+  bb = [0] * (2 * piece.DRAGON + 1)
+  sente, gote = 0, 0
+  for k, p in enumerate(board):
+    if p == piece.FREE:
+      continue
+    b = 1 << k
+    bb[p + OFFSET] |= b
+    if p > 0:
+      sente |= b
+    else:
+      gote |= b
+  return (bb, sente, gote)
@@ -0,0 +1,129 @@
+# -*- coding: UTF8 -*-
+''' parsing many game files on a process pool
+
+    workers return picklable compact results (CompactGame: packed moves, tags, result)
+    instead of Game objects with positions
+'''
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import logging
+import os
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from . import reader
+from .compact import CompactGame
+
+class FileResult:
+  '''games parsed from one file and errors as (byte offset of the game or None, message)'''
+  __slots__ = ('path', 'games', 'errors')
+  def __init__(self, path: str, games: List[CompactGame], errors: List[Tuple[Optional[int], str]]):
+    self.path = path
+    self.games = games
+    self.errors = errors
+  def __reduce__(self):
+    return (FileResult, (self.path, self.games, self.errors))
+  def __repr__(self):
+    return f'FileResult {{path = {self.path}, games = {len(self.games)}, errors = {len(self.errors)}}}'
+  def ok(self) -> bool:
+    return not self.errors
+
+def parse_file(path: str, fmt: Optional[str] = None, encoding: str = 'UTF8') -> FileResult:
+  '''parses all games of the file (or archive), never raises'''
+  games, errors = [], []
+  try:
+    for raw in reader.iter_raw_games(path, fmt, encoding):
+      try:
+        g = reader.parse_raw_game(raw, fmt)
+      #parsers could raise Nifu, IndexError, KeyError, etc. on broken games
+      except Exception as err:
+        errors.append((raw.offset, repr(err)))
+        continue
+      if g is None:
+        errors.append((raw.offset, 'could not parse game'))
+      else:
+        games.append(CompactGame.from_game(g))
+  #OSError, tarfile.ReadError, zipfile.BadZipFile, etc.
+  except Exception as err:
+    errors.append((None, repr(err)))
+  return FileResult(path, games, errors)
+
+def _parse_chunk(paths: List[str], fmt: Optional[str], encoding: str) -> List[FileResult]:
+  return [parse_file(path, fmt, encoding) for path in paths]
+
+def _chunks(items: Iterable, chunksize: int) -> Iterator[list]:
+  chunk = []
+  for x in items:
+    chunk.append(x)
+    if len(chunk) >= chunksize:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def map_chunks(func: Callable[..., list], items: Iterable, chunksize: int, args: tuple = (), workers: Optional[int] = None,
+               ordered: bool = True, max_pending: Optional[int] = None) -> Iterator:
+  '''elements of func(chunk, *args) lists for chunks of items, func and its arguments have to be picklable,
+     workers = 0 calls func in the calling process, at most max_pending chunks (default 4 * workers) are queued'''
+  chunks = _chunks(items, max(1, chunksize))
+  if workers == 0:
+    for chunk in chunks:
+      yield from func(chunk, *args)
+    return
+  if workers is None:
+    workers = os.cpu_count() or 1
+  if max_pending is None:
+    max_pending = 4 * workers
+  with ProcessPoolExecutor(max_workers = workers) as executor:
+    pending = deque() if ordered else set()
+    for chunk in chunks:
+      future = executor.submit(func, chunk, *args)
+      if ordered:
+        pending.append(future)
+        while len(pending) >= max_pending:
+          yield from pending.popleft().result()
+      else:
+        pending.add(future)
+        while len(pending) >= max_pending:
+          done, pending = wait(pending, return_when = FIRST_COMPLETED)
+          for f in done:
+            yield from f.result()
+    if ordered:
+      while pending:
+        yield from pending.popleft().result()
+    else:
+      while pending:
+        done, pending = wait(pending, return_when = FIRST_COMPLETED)
+        for f in done:
+          yield from f.result()
+
+def parse_files(paths: Iterable[str], format: Optional[str] = None, workers: Optional[int] = None, chunksize: int = 8,
+                ordered: bool = True, encoding: str = 'UTF8', max_pending: Optional[int] = None) -> Iterator[FileResult]:
+  '''FileResult for each path, in paths order if ordered else as completed,
+     format is 'kif', 'csa', 'psn' or None (detected by suffix or content), see map_chunks()'''
+  yield from map_chunks(_parse_chunk, (os.fspath(path) for path in paths), chunksize, (format, encoding), workers, ordered, max_pending)
+
+def parse_games(paths: Iterable[str], format: Optional[str] = None, workers: Optional[int] = None, chunksize: int = 8,
+                ordered: bool = True) -> Iterator[CompactGame]:
+  '''games of all files, errors are logged'''
+  for r in parse_files(paths, format, workers, chunksize, ordered):
+    for offset, err in r.errors:
+      logging.warning('%s (offset %s): %s', r.path, offset, err)
+    yield from r.games
+
+def _load_chunk(paths: List[str], parse_func: Callable) -> List[Tuple[Optional[CompactGame], int]]:
+  r = []
+  for path in paths:
+    with open(path, 'r', encoding = 'UTF8') as f:
+      data = f.read()
+    g = parse_func(data)
+    r.append((None if g is None else CompactGame.from_game(g), len(data)))
+  return r
+
+def load_files(paths: List[str], parse_func: Callable, workers: Optional[int] = None) -> Iterator[Tuple[Optional[CompactGame], int]]:
+  '''(game or None if parse_func returned None, size of file) for each single game file in paths order,
+     parse_func (e.g. kifu.game_parse) has to be picklable, exceptions are propagated, see map_chunks()'''
+  if workers is None:
+    workers = os.cpu_count() or 1
+  chunksize = -(-len(paths) // max(1, workers))
+  yield from map_chunks(_load_chunk, paths, chunksize, (parse_func, ), workers)
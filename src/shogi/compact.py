@@ -0,0 +1,105 @@
+# -*- coding: UTF8 -*-
+''' frozen compact games (packed moves, times in centiseconds, interned tags) and stores of many games in shared buffers '''
+
+from array import array
+import sys
+from typing import Iterator, Optional, Tuple
+
+from .game import Game
+from .move import MoveList
+from .result import GameResult
+
+def _intern(value):
+  return sys.intern(value) if isinstance(value, str) else value
+
+class CompactGame:
+  '''immutable game: start position, moves (MoveList), result, tags and comments'''
+  __slots__ = ('start_pos', 'moves', 'game_result', 'tags', 'comments')
+  def __init__(self, start_pos: Optional[str], moves: MoveList, game_result: Optional[GameResult], tags: tuple, comments: tuple):
+    object.__setattr__(self, 'start_pos', start_pos)
+    object.__setattr__(self, 'moves', moves)
+    object.__setattr__(self, 'game_result', game_result)
+    #((key, value), ...) with interned strings
+    object.__setattr__(self, 'tags', tags)
+    #((move_no, (comment, ...)), ...)
+    object.__setattr__(self, 'comments', comments)
+  def __setattr__(self, name, value):
+    raise AttributeError(f'CompactGame is frozen, could not set {name}')
+  def __reduce__(self):
+    return (CompactGame, (self.start_pos, self.moves, self.game_result, self.tags, self.comments))
+  def __len__(self):
+    return len(self.moves)
+  def __eq__(self, other):
+    if not isinstance(other, CompactGame):
+      return False
+    return (self.start_pos == other.start_pos) and (self.moves == other.moves) and (self.game_result == other.game_result) and \
+           (self.tags == other.tags) and (self.comments == other.comments)
+  def get_tag(self, key: str):
+    for k, v in self.tags:
+      if k == key:
+        return v
+    return None
+  @classmethod
+  def from_game(cls, game: Game):
+    tags = tuple((sys.intern(key), _intern(value)) for key, value in game.tags.items())
+    comments = tuple((move_no, tuple(l)) for move_no, l in game.comments.items())
+    return cls(game.start_pos, MoveList(game.start_side_to_move, game.moves), game.game_result, tags, comments)
+  def to_game(self) -> Game:
+    '''moves are replayed in trusted mode (see Game)'''
+    g = Game(self.start_pos, trusted = True)
+    for m in self.moves:
+      g.do_move(m)
+    g.end_trusted_replay()
+    g.game_result = self.game_result
+    for key, value in self.tags:
+      g.set_tag(key, value)
+    for move_no, l in self.comments:
+      g.comments[move_no].extend(l)
+    return g
+
+class GameStore:
+  '''compact games with moves and times of all games in shared contiguous arrays'''
+  def __init__(self):
+    self._packed = array('I')
+    self._times = array('i')
+    self._cum_times = array('i')
+    self._offsets = array('Q', [0])
+    self._start_side_to_move = array('b')
+    self._meta = []
+  def __len__(self):
+    return len(self._meta)
+  def append(self, game) -> int:
+    '''game is Game or CompactGame, returns index of stored game'''
+    if isinstance(game, Game):
+      game = CompactGame.from_game(game)
+    l = game.moves
+    self._packed.extend(l.packed)
+    self._times.extend(l.times)
+    self._cum_times.extend(l.cum_times)
+    self._offsets.append(len(self._packed))
+    self._start_side_to_move.append(l.start_side_to_move)
+    self._meta.append((game.start_pos, game.game_result, game.tags, game.comments))
+    return len(self._meta) - 1
+  def extend(self, games):
+    for g in games:
+      self.append(g)
+  def packed_moves(self, i: int) -> array:
+    return self._packed[self._offsets[i]:self._offsets[i + 1]]
+  def __getitem__(self, i: int) -> CompactGame:
+    if i < 0:
+      i += len(self._meta)
+    if not 0 <= i < len(self._meta):
+      raise IndexError('GameStore index out of range')
+    u, v = self._offsets[i], self._offsets[i + 1]
+    l = MoveList(self._start_side_to_move[i])
+    l.packed = self._packed[u:v]
+    l.times = self._times[u:v]
+    l.cum_times = self._cum_times[u:v]
+    start_pos, game_result, tags, comments = self._meta[i]
+    return CompactGame(start_pos, l, game_result, tags, comments)
+  def __iter__(self) -> Iterator[CompactGame]:
+    for i in range(len(self._meta)):
+      yield self[i]
+  def buffers(self) -> Tuple[array, array, array, array]:
+    '''(packed moves, times, cumulative times, offsets) of all games, moves of i-th game are [offsets[i], offsets[i + 1])'''
+    return (self._packed, self._times, self._cum_times, self._offsets)
@@ -1,17 +1,20 @@
 # -*- coding: UTF8 -*-
-''' parsing CSA format files downloaded from Shogi Quest application
+''' parsing CSA V2.2 format files (Floodgate archives, files downloaded from Shogi Quest application)
+    http://www2.computer-shogi.org/protocol/record_v22.html
     https://gist.github.com/Marken-Foo/b1047990ee0c65537582ebe591e2b6d7
 '''
 import datetime
 import logging
-from typing import Optional
+import re
+from typing import Iterator, List, Optional, Tuple
 
 import log
-from . import piece
-from .game import Game
+from . import kifu, piece
+from .game import Game, parse_player_name
 from .move import Move
-from .position import Position
+from .position import Position, SFEN_STARTPOS
 from .result import GameResult
+from ._misc import iter_lines
 
 def _create_csa_dict(s, offset = 0):
   return dict(map(lambda t: (t[1], t[0] + offset), enumerate(s)))
@@ -33,7 +36,7 @@ def _parse_cell(it) -> Optional[int]:
 def _parse_time(t: str) -> Optional[datetime.timedelta]:
   if t.startswith('T'):
     try:
-      return datetime.timedelta(seconds = int(t[1:]))
+      return datetime.timedelta(seconds = float(t[1:]) if '.' in t else int(t[1:]))
     except ValueError:
       pass
   return None
@@ -66,51 +69,299 @@ def _parse_move(pos: Position, s: str) -> Optional[Move]:
     log.raise_value_error(f'_parse_move(): from_piece is promoted, but to_piece is not(move = {s}, from_piece = {from_piece}, to_piece = {to_piece})')
   return Move(from_piece, from_cell, to_piece, to_cell)
 
-def game_parse(game_kif: str) -> Game:
-  g = Game()
-  it = iter(game_kif.split('\n'))
-  t = next(it)
-  if t != "'Shogi Quest":
-    log.raise_value_error('Expected shogi quest')
-  g.set_tag('location', 'Shogi Quest')
-  t = next(it)
-  if not t.startswith('N+'):
-    log.raise_value_error('Expected sente')
-  g.parse_player_name(t[2:], 'sente')
-  t = next(it)
-  if not t.startswith('N-'):
-    log.raise_value_error('Expected gote')
-  g.parse_player_name(t[2:], 'gote')
-  for i in range(1, 10):
-    t = next(it)
-    if not t.startswith('P' + str(i)):
-      log.raise_value_error('Expected starting position')
-  if next(it) != '+':
-    log.raise_value_error('Expected sente is side of first move')
-  cum_time = [ datetime.timedelta(seconds = 0), datetime.timedelta(seconds = 0)]
-  while True:
-    t = next(it)
-    if t == '':
-      break
-    logging.debug(t)
-    if t.startswith('%'):
-      if t == '%TORYO':
-        g.set_result(GameResult.RESIGNATION)
-      elif t == '%TIME_UP':
-        g.set_result(GameResult.TIME)
+#$KEY:VALUE header lines
+_CSA_HEADER_D = {
+  'EVENT': 'event',
+  'SITE': 'location',
+  'START_TIME': 'start_date',
+  'END_TIME': 'end_date',
+  'TIME_LIMIT': 'time_control',
+  'OPENING': 'opening',
+}
+
+_REGEXP_TIME_LIMIT = re.compile(r'(\d+):(\d+)[+](\d+)')
+
+_RESULTS_D = {
+  '%TORYO': GameResult.RESIGNATION,
+  '%CHUDAN': GameResult.ABORTED,
+  '%SENNICHITE': GameResult.REPETITION,
+  '%TIME_UP': GameResult.TIME,
+  '%ILLEGAL_MOVE': GameResult.ILLEGAL_MOVE,
+  '%TSUMI': GameResult.CHECKMATE,
+  '%KACHI': GameResult.ENTERING_KING,
+}
+
+#number of pieces of each kind (PAWN .. KING)
+_PIECES_COUNT = [18, 4, 4, 4, 4, 2, 2, 2]
+
+def _set_header_tag(tags: dict, s: str):
+  if s.startswith("'Shogi Quest"):
+    tags['location'] = 'Shogi Quest'
+  elif s.startswith('N+'):
+    parse_player_name(tags, s[2:], 'sente')
+  elif s.startswith('N-'):
+    parse_player_name(tags, s[2:], 'gote')
+  elif s.startswith('V'):
+    tags['csa_version'] = s[1:]
+  elif s.startswith('$'):
+    i = s.find(':')
+    if i < 0:
+      return
+    key = _CSA_HEADER_D.get(s[1:i])
+    value = s[i+1:]
+    if key is None:
+      tags[s[1:i].lower()] = value
+    elif key.endswith('_date'):
+      date = kifu.parse_datetime(value)
+      if not date is None:
+        tags[key] = date
+    elif key == 'time_control':
+      m = _REGEXP_TIME_LIMIT.fullmatch(value)
+      if m is None:
+        tags['time_limit'] = value
+      else:
+        tags[key] = kifu.TimeControl(60 * int(m.group(1)) + int(m.group(2)), int(m.group(3)))
+    else:
+      tags[key] = value
+
+def _is_move(s: str) -> bool:
+  return (len(s) > 1) and (s[0] in ('+', '-'))
+
+def _is_header(s: str) -> bool:
+  return (s[:1] in ('V', 'N', '$', 'P')) or s.startswith("'Shogi Quest")
+
+def _statements(lines: Iterator[str]) -> Iterator[str]:
+  '''statements of CSA lines, statements are separated by commas (except in comments)'''
+  for line in lines:
+    if line.startswith("'"):
+      yield line
+    else:
+      for s in line.split(','):
+        yield s.strip()
+
+def scan_headers(text_or_stream, count_moves: bool = False, encoding: str = 'UTF8') -> Tuple[dict, Optional[int]]:
+  '''tags of the game without parsing and replaying moves, stream is read up to the first move,
+     with count_moves number of moves is also returned (None otherwise)'''
+  tags = {}
+  n = None
+  for s in _statements(iter_lines(text_or_stream, encoding)):
+    if n is None:
+      if _is_move(s) or s.startswith('%') or s.startswith('/'):
+        if not count_moves:
+          return (tags, None)
+        n = 0
       else:
-        log.raise_value_error(f'unknown result (result={t}')
-      break
-    m = _parse_move(g.pos, t)
-    if m is None:
-      log.raise_value_error(f'can not parse move (move = {t})')
-    side = 0 if g.pos.side_to_move > 0 else 1
-    t = _parse_time(next(it))
-    if not t is None:
-      cum_time[side] += t
-      m.time = t
-      m.cum_time = cum_time[side]
-    g.do_move(m)
-  if (g.game_result is None) and (not g.pos.has_legal_move()):
-    g.set_result(GameResult.CHECKMATE)
-  return g
+        _set_header_tag(tags, s)
+        continue
+    if s.startswith('%') or s.startswith('/'):
+      return (tags, n)
+    if _is_move(s):
+      n += 1
+  return (tags, n if count_moves else None)
+
+def _parse_cell_pieces(s: str) -> List[Tuple[Optional[int], int]]:
+  '''(cell or None for hand, piece without side) items of PI, P+ and P- statements'''
+  r = []
+  for i in range(0, len(s), 4):
+    t = s[i:i+4]
+    if len(t) != 4:
+      log.raise_value_error(f'_parse_cell_pieces(): illegal statement (piece = {t})')
+    cell = _parse_cell(iter(t[:2]))
+    if t[2:] == 'AL':
+      p = 0
+    else:
+      p = _PIECES_D.get(t[2:])
+      if p is None:
+        log.raise_value_error(f'_parse_cell_pieces(): illegal piece (piece = {t})')
+    r.append((cell, p))
+  return r
+
+class _GameBuilder:
+  '''CSA game fed statement by statement'''
+  def __init__(self, trusted: bool):
+    self._trusted = trusted
+    self.tags = {}
+    self.game = None
+    self.error = None
+    #moves or game result were met, header statement starts next game
+    self.body = False
+    self._board = None
+    self._hands = ([0] * piece.ROOK, [0] * piece.ROOK)
+    self._comments = []
+    self._cum_time = [datetime.timedelta(0), datetime.timedelta(0)]
+    #move which next time statement belongs to
+    self._timed_move = None
+  def empty(self) -> bool:
+    return (not self.tags) and (self.game is None) and (self._board is None) and (not self._comments)
+  def feed(self, s: str) -> bool:
+    '''False if statement starts the next game (statement isn't consumed)'''
+    if s == '':
+      return True
+    if self.body and _is_header(s):
+      return False
+    if not self.error is None:
+      return True
+    try:
+      self._feed(s)
+    except (ValueError, StopIteration) as err:
+      self.error = err
+      if _is_move(s) or s.startswith('%'):
+        self.body = True
+    return True
+  def _start_board(self):
+    if self._board is None:
+      self._board = [piece.FREE] * 81
+  def _create_game(self, side_to_move: int):
+    sfen = None
+    if not self._board is None:
+      sfen = Position.build_sfen(self._board, side_to_move, 1, self._hands[0], self._hands[1])
+      if sfen == SFEN_STARTPOS:
+        sfen = None
+    elif side_to_move < 0:
+      log.raise_value_error('initial position is expected')
+    g = Game(sfen, trusted = self._trusted)
+    g.tags = self.tags
+    for c in self._comments:
+      g.append_comment_before_move(g.pos.move_no, c)
+    self.game = g
+  def _feed_position(self, s: str):
+    if s.startswith('PI'):
+      self._board = Position.from_sfen(SFEN_STARTPOS).board
+      for cell, p in _parse_cell_pieces(s[2:]):
+        if (cell is None) or (abs(self._board[cell]) != p):
+          log.raise_value_error(f'illegal PI statement {s}')
+        self._board[cell] = piece.FREE
+    elif s[1:2].isdigit():
+      row = int(s[1]) - 1
+      #trailing spaces of empty cell could be stripped
+      t = s[2:].ljust(27)
+      if (not 0 <= row < 9) or (len(t) != 27):
+        log.raise_value_error(f'illegal position statement {s}')
+      self._start_board()
+      for i in range(9):
+        c = t[3*i:3*i+3]
+        k = 9 * row + 8 - i
+        if c.strip() == '*':
+          self._board[k] = piece.FREE
+        else:
+          p = _PIECES_D.get(c[1:])
+          if (p is None) or (not c[0] in ('+', '-')):
+            log.raise_value_error(f'illegal position statement {s}')
+          self._board[k] = p if c[0] == '+' else -p
+    elif s[1:2] in ('+', '-'):
+      side = 1 if s[1] == '+' else -1
+      self._start_board()
+      hand = self._hands[0 if side > 0 else 1]
+      for cell, p in _parse_cell_pieces(s[2:]):
+        if p == 0:
+          #AL: all remaining pieces (except kings) to hand
+          used = [0] * piece.KING
+          for q in self._board:
+            if q != piece.FREE:
+              used[piece.unpromote(abs(q)) - 1] += 1
+          for i in range(piece.ROOK):
+            hand[i] += max(0, _PIECES_COUNT[i] - used[i] - self._hands[0][i] - self._hands[1][i])
+        elif cell is None:
+          hand[p - 1] += 1
+        else:
+          self._board[cell] = side * p
+    else:
+      log.raise_value_error(f'illegal position statement {s}')
+  def _feed(self, s: str):
+    c = s[0]
+    if c == "'":
+      if s.startswith("'Shogi Quest"):
+        _set_header_tag(self.tags, s)
+      elif self.game is None:
+        self._comments.append(s[1:])
+      else:
+        self.game.append_comment_before_move(self.game.pos.move_no, s[1:])
+    elif c in ('V', 'N', '$'):
+      _set_header_tag(self.tags, s)
+    elif c == 'P':
+      self._feed_position(s)
+    elif c in ('+', '-'):
+      side = 1 if c == '+' else -1
+      if len(s) == 1:
+        self._create_game(side)
+        return
+      self.body = True
+      if self.game is None:
+        self._create_game(side)
+      g = self.game
+      self._timed_move = None
+      if g.has_result():
+        return
+      if side != g.pos.side_to_move:
+        log.raise_value_error(f'unexpected side of move {s}')
+      m = _parse_move(g.pos, s)
+      g.do_move(m)
+      #rejected move isn't appended, game result auto detected after the move doesn't matter
+      if g.moves and (g.moves[-1] is m):
+        self._timed_move = m
+    elif c == 'T':
+      t = _parse_time(s)
+      if t is None:
+        log.raise_value_error(f'illegal time statement {s}')
+      m = self._timed_move
+      if not m is None:
+        side = 0 if m.to_piece > 0 else 1
+        self._cum_time[side] += t
+        m.time = t
+        m.cum_time = self._cum_time[side]
+    elif c == '%':
+      self.body = True
+      self._timed_move = None
+      if self.game is None:
+        self._create_game(1)
+      g = self.game
+      r = _RESULTS_D.get(s)
+      if r is None and s.endswith('ILLEGAL_ACTION'):
+        #side which made illegal action loses
+        loser = 1 if s[1] == '+' else -1
+        r = GameResult.ILLEGAL_MOVE if loser == g.pos.side_to_move else GameResult.ILLEGAL_PRECEDING_MOVE
+      if r is None:
+        #%HIKIWAKE, %JISHOGI, %MAX_MOVES, etc. have no GameResult
+        self.tags['csa_result'] = s
+      else:
+        g.set_result(r)
+    else:
+      log.raise_value_error(f'unknown statement {s}')
+  def finish(self) -> Game:
+    if not self.error is None:
+      raise self.error
+    if self.game is None:
+      self._create_game(1)
+    g = self.game
+    g.end_trusted_replay()
+    g.adjourn()
+    return g
+
+def iter_games(text_or_stream, encoding: str = 'UTF8', trusted: bool = False, skip_errors: bool = False) -> Iterator[Game]:
+  '''games of multi-game CSA text or stream (read incrementally), games are separated by '/' lines or
+     by header of the next game, with skip_errors games which can't be parsed are logged and skipped'''
+  def finish(b: _GameBuilder):
+    if b.empty():
+      return
+    try:
+      yield b.finish()
+    except (ValueError, StopIteration) as err:
+      if not skip_errors:
+        raise ValueError(f'CSA game {b.tags}: {err}') from err
+      logging.warning('CSA game %s: %s', b.tags, err)
+  b = _GameBuilder(trusted)
+  for s in _statements(iter_lines(text_or_stream, encoding)):
+    if s.startswith('/'):
+      yield from finish(b)
+      b = _GameBuilder(trusted)
+    elif not b.feed(s):
+      yield from finish(b)
+      b = _GameBuilder(trusted)
+      b.feed(s)
+  yield from finish(b)
+
+def game_parse(game_csa: str, trusted: bool = False) -> Game:
+  '''the first game of CSA text (V2.2 or Shogi Quest flavour)'''
+  for g in iter_games(game_csa, trusted = trusted):
+    return g
+  log.raise_value_error('game_parse(): no game')
@@ -0,0 +1,118 @@
+# -*- coding: UTF8 -*-
+''' batch conversion of positions to NumPy arrays (numpy is an optional dependency)
+
+    boards: int8[N, 81] signed pieces (Position.board layout)
+    hands: int8[N, 2, 7] pieces in hand of sente and gote (Position.sente_pieces, Position.gote_pieces)
+    side: int8[N] side to move (1 or -1)
+'''
+
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from . import piece
+from .position import Position, SFEN_STARTPOS
+
+#piece kinds (without sign) in one hot planes order, sente planes are followed by gote planes
+PIECE_KINDS = [piece.PAWN, piece.LANCE, piece.KNIGHT, piece.SILVER, piece.GOLD, piece.BISHOP, piece.ROOK, piece.KING,
+               piece.TOKIN, piece.PROMOTED + piece.LANCE, piece.PROMOTED + piece.KNIGHT, piece.PROMOTED + piece.SILVER,
+               piece.HORSE, piece.DRAGON]
+
+def _build_plane_table() -> np.ndarray:
+  t = np.full(2 * piece.DRAGON + 1, -1, dtype = np.int8)
+  for i, p in enumerate(PIECE_KINDS):
+    t[p + piece.DRAGON] = i
+    t[-p + piece.DRAGON] = i + len(PIECE_KINDS)
+  return t
+
+#one hot plane of piece p: _PLANES[p + piece.DRAGON], -1 for free cell
+_PLANES = _build_plane_table()
+
+def allocate(n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  return (np.zeros((n, 81), dtype = np.int8), np.zeros((n, 2, 7), dtype = np.int8), np.zeros(n, dtype = np.int8))
+
+def positions_to_arrays(positions: Iterable[Position]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  boards, hands, side = [], [], []
+  for pos in positions:
+    boards.append(pos.board)
+    hands.append((pos.sente_pieces, pos.gote_pieces))
+    side.append(pos.side_to_move)
+  if not boards:
+    return allocate(0)
+  return (np.array(boards, dtype = np.int8), np.array(hands, dtype = np.int8), np.array(side, dtype = np.int8))
+
+def arrays_to_positions(boards: np.ndarray, hands: np.ndarray, side: np.ndarray, move_no: int = 1) -> List[Position]:
+  '''arrays are trusted'''
+  return [Position.from_board(b, s, h[0], h[1], move_no) for b, h, s in zip(boards.tolist(), hands.tolist(), side.tolist())]
+
+def game_rows(game) -> int:
+  '''number of rows game_to_arrays() writes'''
+  return len(game.moves) + 1
+
+def game_to_arrays(game, out: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None, offset: int = 0):
+  '''positions before each move and the final position of the game replayed into preallocated arrays
+     starting from row offset, moves are trusted (already validated by Game), returns arrays'''
+  n = game_rows(game)
+  if out is None:
+    out = allocate(n)
+    offset = 0
+  boards, hands, side = out
+  if offset + n > len(side):
+    raise ValueError(f'game_to_arrays(): {n} rows do not fit into buffer of size {len(side)} at offset {offset}')
+  pos = Position.from_sfen(SFEN_STARTPOS if game.start_pos is None else game.start_pos)
+  i = offset
+  boards[i] = pos.board
+  hands[i] = (pos.sente_pieces, pos.gote_pieces)
+  side[i] = pos.side_to_move
+  for m in game.moves:
+    b, h = boards[i + 1], hands[i + 1]
+    b[:] = boards[i]
+    h[:] = hands[i]
+    s = 0 if m.to_piece > 0 else 1
+    if m.from_cell is None:
+      h[s, abs(m.to_piece) - 1] -= 1
+    else:
+      t = int(b[m.to_cell])
+      if t != piece.FREE:
+        a = abs(t)
+        if a != piece.KING:
+          h[s, piece.unpromote(a) - 1] += 1
+      b[m.from_cell] = piece.FREE
+    b[m.to_cell] = m.to_piece
+    side[i + 1] = -side[i]
+    i += 1
+  return out
+
+def one_hot(boards: np.ndarray) -> np.ndarray:
+  '''bool[N, 28, 81] piece kind planes (PIECE_KINDS of sente, then of gote)'''
+  planes = _PLANES[boards.astype(np.int64) + piece.DRAGON]
+  return planes[:, np.newaxis, :] == np.arange(2 * len(PIECE_KINDS), dtype = np.int8)[np.newaxis, :, np.newaxis]
+
+def _shift(a: np.ndarray, dr: int, dc: int) -> np.ndarray:
+  '''r[:, row + dr, col + dc] = a[:, row, col]'''
+  r = np.zeros_like(a)
+  r[:, max(dr, 0):9 + min(dr, 0), max(dc, 0):9 + min(dc, 0)] = a[:, max(-dr, 0):9 - max(dr, 0), max(-dc, 0):9 - max(dc, 0)]
+  return r
+
+def attack_counts(boards: np.ndarray) -> np.ndarray:
+  '''int8[N, 2, 81] number of sente and gote pieces attacking each cell'''
+  b = boards.reshape(-1, 9, 9)
+  empty = b == piece.FREE
+  r = np.zeros((len(b), 2, 9, 9), dtype = np.int8)
+  for i, side in enumerate((1, -1)):
+    for p in range(1, piece.DRAGON + 1):
+      dirs = piece.MOVE_TABLE[p]
+      if dirs is None:
+        continue
+      src = b == side * p
+      if not src.any():
+        continue
+      for dr, dc, sliding in dirs:
+        dr *= side
+        t = _shift(src, dr, dc)
+        r[:, i] += t
+        if sliding:
+          for _ in range(7):
+            t = _shift(t & empty, dr, dc)
+            r[:, i] += t
+  return r.reshape(-1, 2, 81)
@@ -1,17 +1,24 @@
 # -*- coding: UTF8 -*-
 
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
-from typing import Mapping, Optional
+import threading
+from typing import Iterator, List, Mapping, Optional
 
 import log
-from .move import Move, IllegalMove, kifu_line
+from . import piece
+from .move import Move, IllegalMove, UndoMove, kifu_line
 from .piece import side_to_str
-from .position import Position
+from .position import Position, SFEN_STARTPOS
 from .result import GameResult, side_to_move_points
 from ._misc import sfen_moveno
 
+#full validation of games constructed with trusted = True (debug switch)
+VERIFY_TRUSTED_GAMES = os.getenv('SHOGI_VERIFY_TRUSTED_GAMES', '') not in ('', '0')
+
 def player_with_rating_from_dict(d: dict, side:int) -> Optional[str]:
   name = side_to_str(side)
   player = d.get(name)
@@ -22,6 +29,118 @@ def player_with_rating_from_dict(d: dict, side:int) -> Optional[str]:
     return player
   return f'{player}({rating})'
 
+def parse_player_name(tags: dict, s: str, key: str):
+  '''player name with optional rating in brackets'''
+  if s.endswith(')'):
+    i = s.rfind('(')
+    if i >= 0:
+      t = s[i+1:len(s)-1]
+      if (len(t) > 0) and t.isdigit():
+        tags[key] = s[:i]
+        tags[key + '_rating'] = int(t)
+        return
+  tags[key] = s
+
+def _build_impasse_points():
+  a = [1] * (piece.DRAGON + 1)
+  a[piece.FREE] = 0
+  a[piece.KING] = 0
+  for p in (piece.BISHOP, piece.ROOK, piece.HORSE, piece.DRAGON):
+    a[p] = 5
+  return a
+
+#points of piece (abs) in impasse count
+_IMPASSE_POINTS = _build_impasse_points()
+
+def _in_zone(side: int, k: int) -> bool:
+  return k < 27 if side > 0 else k >= 54
+
+class Adjudicator:
+  '''detects repetition (by position key), perpetual check and impasse after every move,
+     impasse points are kept incrementally'''
+  def __init__(self):
+    #position key -> [ply of the first occurrence, number of occurrences]
+    self._repetitions = {}
+    #number of consecutive checks of the side to move (every second ply) ending at given ply
+    self._check_streaks = []
+    #by side index: pieces without king in the promotion zone, their impasse points, impasse points of pieces in hand
+    self._zone_pieces = [0, 0]
+    self._zone_points = [0, 0]
+    self._hand_points = [0, 0]
+  def _recount(self, pos: Position):
+    for i, side in enumerate((1, -1)):
+      n, points = 0, 0
+      for k, p in enumerate(pos.board):
+        if (p * side > 0) and (abs(p) != piece.KING) and _in_zone(side, k):
+          n += 1
+          points += _IMPASSE_POINTS[abs(p)]
+      c = pos.sente_pieces if side > 0 else pos.gote_pieces
+      self._zone_pieces[i] = n
+      self._zone_points[i] = points
+      self._hand_points[i] = sum(_IMPASSE_POINTS[p] * c[p - 1] for p in range(piece.PAWN, piece.KING))
+  def _apply(self, m: Move, u: UndoMove):
+    side = 1 if m.to_piece > 0 else -1
+    i = 0 if side > 0 else 1
+    if m.is_drop():
+      self._hand_points[i] -= _IMPASSE_POINTS[abs(m.to_piece)]
+    else:
+      if _in_zone(side, m.from_cell):
+        a = abs(m.from_piece)
+        if a != piece.KING:
+          self._zone_pieces[i] -= 1
+          self._zone_points[i] -= _IMPASSE_POINTS[a]
+      a = abs(u.taken_piece)
+      if a != piece.FREE:
+        if _in_zone(-side, m.to_cell):
+          self._zone_pieces[1 - i] -= 1
+          self._zone_points[1 - i] -= _IMPASSE_POINTS[a]
+        self._hand_points[i] += _IMPASSE_POINTS[piece.unpromote(a)]
+    a = abs(m.to_piece)
+    if (a != piece.KING) and _in_zone(side, m.to_cell):
+      self._zone_pieces[i] += 1
+      self._zone_points[i] += _IMPASSE_POINTS[a]
+  def _impasse(self, pos: Position) -> bool:
+    '''same as Position.fesa_impasse_points()'''
+    s = pos.side_to_move
+    i = 0 if s > 0 else 1
+    if self._zone_pieces[i] < 10:
+      return False
+    k = pos.find_king(s)
+    if (k is None) or not _in_zone(s, k):
+      return False
+    return self._zone_points[i] + self._hand_points[i] >= (28 if s > 0 else 27)
+  def update(self, pos: Position, m: Optional[Move] = None, u: Optional[UndoMove] = None) -> Optional[GameResult]:
+    '''called for the start position and after every move, m (Move or packed integer) and u are the move
+       and its undo information, without them impasse points are recounted'''
+    if m is None:
+      self._recount(pos)
+    else:
+      if isinstance(m, int):
+        m = Move.unpack_from_int(m, -pos.side_to_move)
+      self._apply(m, u)
+    ply = len(self._check_streaks)
+    check = pos.is_check()
+    if check:
+      self._check_streaks.append(self._check_streaks[ply - 2] + 1 if ply >= 2 else 1)
+    else:
+      self._check_streaks.append(0)
+    t = self._repetitions.get(pos.key())
+    if t is None:
+      self._repetitions[pos.key()] = [ply, 1]
+    else:
+      t[1] += 1
+      if log.is_debug():
+        logging.debug("Position '%s' was repeated %d times, first time on move %d", pos.sfen(move_no = False), t[1], t[0])
+      if t[1] >= 4:
+        #all positions of the side to move since the first occurrence were checks
+        if self._check_streaks[ply] > (ply - t[0]) // 2:
+          return GameResult.ILLEGAL_PRECEDING_MOVE
+        return GameResult.REPETITION
+    if (not check) and self._impasse(pos):
+      #https://lishogi.org/explanation/impasse
+      return GameResult.ENTERING_KING
+    return None
+
 class Game:
   def has_result(self) -> bool:
     return not self.game_result is None
@@ -35,56 +154,83 @@ class Game:
   def adjourn(self):
     if (self.game_result is None) and (not self.pos.has_legal_move()):
       self.set_result(GameResult.CHECKMATE)
-  def _insert_sfen(self):
+  def _insert_sfen(self, m: Optional[Move] = None, u: Optional[UndoMove] = None):
     self._positions = None
-    if self._disable_game_result_auto_detection:
+    if self._adjudicator is None:
       return
-    sfen = self.pos.sfen(move_no = False)
-    l = self._repetitions_dict[sfen]
-    l.append(len(self._checks))
-    check = self.pos.is_check()
-    self._checks.append(check)
-    if len(l) >= 2:
-      logging.debug("Position '%s' was repeated %d times on moves %s", sfen, len(l), l)
-    if len(l) >= 4:
-      u, v = l[0], l[-1]
-      if check and all(self._checks[u:v:2]):
-        self.set_result(GameResult.ILLEGAL_PRECEDING_MOVE)
-      else:
-        self.set_result(GameResult.REPETITION)
-    if (not check) and self.pos.fesa_impasse_points():
-      #https://lishogi.org/explanation/impasse
-      self.set_result(GameResult.ENTERING_KING)
+    r = self._adjudicator.update(self.pos, m, u)
+    if not r is None:
+      self.set_result(r)
   def move_no_to_side_to_move(self, move_no: int) -> int:
     if move_no < self.start_move_no:
       log.raise_value_error('move number is too small')
     return self.start_side_to_move * pow(-1, (move_no - self.start_move_no) & 1)
-  def __init__(self, start_pos = None, disable_game_result_auto_detection: bool = False):
-    self._disable_game_result_auto_detection = disable_game_result_auto_detection
+  def __init__(self, start_pos = None, disable_game_result_auto_detection: bool = False, adjudicator: Optional['Adjudicator'] = None,
+               trusted: bool = False):
+    #trusted game (e.g. loaded from DB) skips game result auto detection and position history until end_trusted_replay(),
+    #VERIFY_TRUSTED_GAMES turns full checking back on
+    self.trusted = trusted and not VERIFY_TRUSTED_GAMES
+    #adjudicator is used only if game result auto detection isn't disabled
+    if disable_game_result_auto_detection:
+      adjudicator = None
+    elif adjudicator is None:
+      adjudicator = Adjudicator()
+    #adjudicator of trusted game is fed with replayed positions only when a move is made after the replay
+    self._adjudicator, self._pending_adjudicator = (None, adjudicator) if self.trusted else (adjudicator, None)
     self.tags = {}
     self.moves = []
     #comments: move_no -> List[str]
     #comments before move
     self.comments = defaultdict(list)
     self.start_pos = start_pos
-    self.pos = Position(start_pos)
+    if self.trusted:
+      self.pos = Position.from_sfen(start_pos or SFEN_STARTPOS)
+    else:
+      #handicap and problem positions lack pieces
+      self.pos = Position() if start_pos is None else Position.from_partial_sfen(start_pos)
     self.start_move_no = self.pos.move_no
     self.start_side_to_move = self.pos.side_to_move
     self.game_result = None
-    self._repetitions_dict = defaultdict(list)
-    self._checks = []
     self._insert_sfen()
     self._positions = None
+    self._cursor = None
+    self._position_index = None
   def append_comment_before_move(self, move_no: int, s: str):
     self.comments[move_no].append(s)
-  def do_move(self, m: Move):
+  def _replay_adjudicator(self):
+    a, self._pending_adjudicator = self._pending_adjudicator, None
+    pos = Position.from_sfen(self.start_pos or SFEN_STARTPOS)
+    a.update(pos)
+    for m in self.moves:
+      a.update(pos, m, pos.do_move_unchecked(m))
+    self._adjudicator = a
+  def _reject_move(self, m: Move):
+    #rejected move, Position.do_move raises user-facing exception
     try:
       self.pos.do_move(m)
     except IllegalMove:
       self.set_result(GameResult.ILLEGAL_MOVE)
+  def do_move(self, m: Move):
+    if self.trusted:
+      #only cheap checks (Position.try_move), replay stops at illegal move as untrusted one does
+      if self.pos.try_move(m) is None:
+        self._reject_move(m)
+        return
+      self.moves.append(m)
+      self._positions = None
+      return
+    if not self._pending_adjudicator is None:
+      self._replay_adjudicator()
+    u = self.pos.try_move(m)
+    if u is None:
+      self._reject_move(m)
       return
     self.moves.append(m)
-    self._insert_sfen()
+    self._insert_sfen(m, u)
+  def end_trusted_replay(self):
+    '''called by parsers after all moves of trusted game were made: later moves are validated
+       and game result auto detection (if it wasn't disabled) is turned on'''
+    self.trusted = False
   def do_usi_move(self, usi_move: str):
     if usi_move == 'resign':
       self.set_result(GameResult.RESIGNATION)
@@ -108,6 +254,8 @@ class Game:
   def player_with_rating(self, side: int) -> Optional[str]:
     return player_with_rating_from_dict(self.tags, side)
   def sente_points(self) -> Optional[int]:
+    if self.game_result is None:
+      return None
     p = side_to_move_points(self.game_result)
     if p is None:
       return None
@@ -134,15 +282,7 @@ class Game:
     self._positions = d
     return d
   def parse_player_name(self, s: str, key: str):
-    if s.endswith(')'):
-      i = s.rfind('(')
-      if i >= 0:
-        t = s[i+1:len(s)-1]
-        if (len(t) > 0) and t.isdigit():
-          self.set_tag(key, s[:i])
-          self.set_tag(key + '_rating', int(t))
-          return
-    self.set_tag(key, s)
+    parse_player_name(self.tags, s, key)
   def set_ratings(self, d: Mapping[str, int]):
     for side in [1, -1]:
       name = side_to_str(side)
@@ -216,29 +356,276 @@ class Game:
     return ' '.join(m.usi_str() for m in self.moves)
   def kifu_line(self):
     return kifu_line(self.moves, self.start_side_to_move)
+  def cursor(self) -> 'GameCursor':
+    '''shared cursor (moves are only appended, so it stays valid)'''
+    if self._cursor is None:
+      self._cursor = GameCursor(self)
+    return self._cursor
+  def position_index(self) -> 'PositionIndex':
+    '''lazily built index of game positions (moves are only appended, so it is extended on demand)'''
+    if self._position_index is None:
+      self._position_index = PositionIndex(self)
+    return self._position_index
   def find_position_by_sfen(self, sfen: str) -> bool:
-    n = sfen_moveno(sfen) - 1
-    if len(self.moves) < n:
+    n = sfen_moveno(sfen) - self.start_move_no
+    if not 0 <= n <= len(self.moves):
       return False
-    assert self.start_pos is None
-    pos = Position()
-    for m in self.moves[:n]:
-      pos.do_move(m)
-    assert pos.move_no == n + 1
-    return pos.sfen() == sfen
+    return n in self.position_index().find_sfen(sfen)
+
+def position_keys(start_pos: Optional[str], moves, max_ply: Optional[int] = None) -> Iterator[int]:
+  '''zobrist keys of start position and of positions after each move, handicap start positions are allowed'''
+  pos = Position.from_sfen(start_pos or SFEN_STARTPOS)
+  yield pos.key()
+  for ply, m in enumerate(moves):
+    if ((not max_ply is None) and (ply >= max_ply)) or (pos.try_move(m) is None):
+      break
+    yield pos.key()
+
+def _sfen_key(sfen: str) -> int:
+  return Position.from_sfen(sfen).key()
+
+class PositionIndex:
+  '''position key -> plies (0 - start position) of the game where position occurs'''
+  def __init__(self, game: Game):
+    self._game = game
+    self._pos = Position.from_sfen(game.start_pos or SFEN_STARTPOS)
+    #number of indexed moves
+    self._plies = 0
+    self._d = {self._pos.key(): [0]}
+  def _update(self):
+    moves = self._game.moves
+    while self._plies < len(moves):
+      if self._pos.try_move(moves[self._plies]) is None:
+        break
+      self._plies += 1
+      self._d.setdefault(self._pos.key(), []).append(self._plies)
+  def find(self, key: int) -> List[int]:
+    self._update()
+    return self._d.get(key, [])
+  def find_sfen(self, sfen: str) -> List[int]:
+    '''plies of the position, move number of sfen is ignored'''
+    return self.find(_sfen_key(sfen))
+  def __contains__(self, key: int) -> bool:
+    return len(self.find(key)) > 0
+
+class GameCursor:
+  '''position of the game at any ply (0 - start position), snapshots of every interval plies are kept
+     and seek replays at most interval moves'''
+  def __init__(self, game: Game, interval: int = 16):
+    self._game = game
+    self._interval = interval
+    self.pos = Position.from_sfen(game.start_pos or SFEN_STARTPOS)
+    self.ply = 0
+    #PackedSfen needs all pieces, handicap and tsume positions are copied
+    self._packed = self.pos.packable()
+    self._checkpoints = [self._snapshot()]
+    #undo information of moves made after the last restored checkpoint
+    self._undo = []
+  def _snapshot(self):
+    pos = self.pos
+    if self._packed:
+      return pos.pack()
+    return (pos.board[:], pos.side_to_move, pos.sente_pieces[:], pos.gote_pieces[:])
+  def _restore(self, i: int):
+    move_no = self._game.start_move_no + i * self._interval
+    t = self._checkpoints[i]
+    if self._packed:
+      self.pos = Position.from_packed(t, move_no)
+    else:
+      board, side_to_move, sente_pieces, gote_pieces = t
+      self.pos = Position.from_board(board[:], side_to_move, sente_pieces[:], gote_pieces[:], move_no)
+    self.ply = i * self._interval
+    self._undo = []
+  def __len__(self):
+    '''number of plies'''
+    return len(self._game.moves)
+  def forward(self) -> bool:
+    if self.ply >= len(self._game.moves):
+      return False
+    self._undo.append(self.pos.do_move(self._game.moves[self.ply]))
+    self.ply += 1
+    if (self.ply % self._interval == 0) and (len(self._checkpoints) == self.ply // self._interval):
+      self._checkpoints.append(self._snapshot())
+    return True
+  def backward(self) -> bool:
+    if self.ply == 0:
+      return False
+    if not self._undo:
+      self.seek(self.ply - 1)
+      return True
+    self.ply -= 1
+    self.pos.undo_move(self._game.moves[self.ply], self._undo.pop())
+    return True
+  def seek(self, ply: int) -> Position:
+    '''position after ply moves, returned position is owned by the cursor'''
+    ply = max(0, min(ply, len(self._game.moves)))
+    i = min(ply // self._interval, len(self._checkpoints) - 1)
+    #checkpoint is restored if taking moves back is longer than replaying them from it
+    if (ply < self.ply - len(self._undo)) or (i * self._interval > self.ply) or (self.ply - ply > ply - i * self._interval):
+      self._restore(i)
+    while self.ply > ply:
+      self.backward()
+    while self.ply < ply:
+      self.forward()
+    return self.pos
+  def seek_move_no(self, move_no: int) -> Position:
+    return self.seek(move_no - self._game.start_move_no)
+
+class InvertedPositionIndex:
+  '''position key -> ids of games reaching the position'''
+  def __init__(self, max_ply: Optional[int] = None):
+    #only positions of first max_ply moves are indexed
+    self._max_ply = max_ply
+    self._d = {}
+    self._games = 0
+  def __len__(self):
+    '''number of distinct positions'''
+    return len(self._d)
+  def games_count(self) -> int:
+    return self._games
+  def add(self, game_id: int, game):
+    '''game is Game, CompactGame or any object with start_pos and moves'''
+    self._games += 1
+    for key in set(position_keys(game.start_pos, game.moves, self._max_ply)):
+      l = self._d.get(key)
+      if l is None:
+        self._d[key] = array('I', [game_id])
+      else:
+        l.append(game_id)
+  def extend(self, items):
+    '''items are (game_id, game) pairs'''
+    for game_id, game in items:
+      self.add(game_id, game)
+  def games(self, key: int) -> List[int]:
+    '''ids of games in insertion order'''
+    l = self._d.get(key)
+    return [] if l is None else l.tolist()
+  def games_by_sfen(self, sfen: str) -> List[int]:
+    return self.games(_sfen_key(sfen))
 
 class GameCollection:
-  def __init__(self, path: str, suffix: str):
+  '''games stored in files path/NNNN<suffix> with LRU cache bounded by number of games and/or
+     total size of game files, optional background prefetch of the next ids on a thread pool (file I/O overlaps
+     browsing), load_many() parses on a process pool'''
+  def __init__(self, path: str, suffix: str, parse_func = None, max_games: Optional[int] = None, max_bytes: Optional[int] = None,
+               prefetch: int = 0, workers: int = 4):
     self._path = path
     self._suffix = suffix
-    self._d = {}
-  def load(self, game_id: int, parse_func) -> Game:
-    g = self._d.get(game_id)
-    if not g is None:
-      return g
-    filename = os.path.join(self._path, 'f{game_id:04d}' + self._suffix)
-    with open(filename, 'r', encoding = 'UTF8') as f:
+    self._parse_func = parse_func
+    self._max_games = max_games
+    self._max_bytes = max_bytes
+    self._prefetch = prefetch
+    self._workers = workers
+    self._executor = None
+    self._lock = threading.Lock()
+    #game_id -> (game, file size)
+    self._cache = OrderedDict()
+    self._bytes = 0
+    #game_id -> future of prefetched (game, file size)
+    self._pending = {}
+    self.hits = 0
+    self.misses = 0
+    self.prefetch_hits = 0
+    self.evictions = 0
+  def filename(self, game_id: int) -> str:
+    return os.path.join(self._path, f'{game_id:04d}' + self._suffix)
+  def _read(self, game_id: int, parse_func):
+    with open(self.filename(game_id), 'r', encoding = 'UTF8') as f:
       data = f.read()
-    g = parse_func(data)
-    self._d[game_id] = g
-    return g
+    return (parse_func(data), len(data))
+  def _pool(self) -> ThreadPoolExecutor:
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(max_workers = self._workers)
+    return self._executor
+  def _insert(self, game_id: int, t):
+    #called under lock
+    if game_id in self._cache:
+      return
+    self._cache[game_id] = t
+    self._bytes += t[1]
+    while len(self._cache) > 1 and (((not self._max_games is None) and (len(self._cache) > self._max_games)) or \
+                                    ((not self._max_bytes is None) and (self._bytes > self._max_bytes))):
+      _, (_, size) = self._cache.popitem(last = False)
+      self._bytes -= size
+      self.evictions += 1
+  def _prefetched(self, game_id: int, future):
+    with self._lock:
+      self._pending.pop(game_id, None)
+      if future.exception() is None:
+        self._insert(game_id, future.result())
+  def _schedule_prefetch(self, game_id: int, parse_func):
+    for i in range(game_id + 1, game_id + 1 + self._prefetch):
+      with self._lock:
+        if (i in self._cache) or (i in self._pending) or (not os.path.exists(self.filename(i))):
+          continue
+        future = self._pool().submit(self._read, i, parse_func)
+        self._pending[i] = future
+      future.add_done_callback(lambda f, i = i: self._prefetched(i, f))
+  def load(self, game_id: int, parse_func = None) -> Game:
+    parse_func = parse_func or self._parse_func
+    future = None
+    with self._lock:
+      t = self._cache.get(game_id)
+      if t is None:
+        future = self._pending.get(game_id)
+        if future is None:
+          self.misses += 1
+        else:
+          self.prefetch_hits += 1
+      else:
+        self._cache.move_to_end(game_id)
+        self.hits += 1
+    if t is None:
+      t = self._read(game_id, parse_func) if future is None else future.result()
+      with self._lock:
+        self._insert(game_id, t)
+    if self._prefetch > 0:
+      self._schedule_prefetch(game_id, parse_func)
+    return t[0]
+  def load_many(self, ids, parse_func = None) -> List[Game]:
+    '''games in ids order, missing games are parsed on a process pool (see bulk.load_files()),
+       parse_func has to be picklable then'''
+    #circular import: bulk -> reader -> kifu -> game
+    from .bulk import load_files
+    parse_func = parse_func or self._parse_func
+    r = [None] * len(ids)
+    futures, missing = [], []
+    with self._lock:
+      for i, game_id in enumerate(ids):
+        t = self._cache.get(game_id)
+        if not t is None:
+          self._cache.move_to_end(game_id)
+          self.hits += 1
+          r[i] = t[0]
+          continue
+        future = self._pending.get(game_id)
+        if future is None:
+          self.misses += 1
+          missing.append((i, game_id))
+        else:
+          self.prefetch_hits += 1
+          futures.append((i, game_id, future))
+    #process pool doesn't pay off for a single game or CPU
+    workers = min(self._workers, len(missing), os.cpu_count() or 1)
+    if workers < 2:
+      workers = 0
+    loaded = load_files([self.filename(game_id) for _, game_id in missing], parse_func, workers)
+    for (i, game_id), (cg, size) in zip(missing, loaded):
+      t = (None if cg is None else cg.to_game(), size)
+      with self._lock:
+        self._insert(game_id, t)
+      r[i] = t[0]
+    for i, game_id, future in futures:
+      t = future.result()
+      with self._lock:
+        self._insert(game_id, t)
+      r[i] = t[0]
+    return r
+  def stats(self) -> Mapping[str, int]:
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'prefetch_hits': self.prefetch_hits, 'evictions': self.evictions,
+              'games': len(self._cache), 'bytes': self._bytes, 'pending': len(self._pending)}
+  def close(self):
+    if not self._executor is None:
+      self._executor.shutdown(wait = True)
+      self._executor = None
@@ -0,0 +1,186 @@
+# -*- coding: UTF8 -*-
+''' incremental HalfKP (king square, piece) feature indices for NNUE training
+
+    BonaPiece layout and square order (9 * file + rank) follow YaneuraOu:
+    index = FE_END * king_square + bona_piece, king_square and bona_piece are taken from the side
+    perspective (board rotated for gote, friend/enemy pieces)
+'''
+
+from array import array
+from typing import List, Optional, Tuple
+
+from . import bitboard
+from . import piece
+from .move import Move, UndoMove
+from .position import Position
+
+#(friend, enemy) bona piece base of pieces in hand, feature of n pieces in hand is base + 1 .. base + n
+_HAND_BASES = [None, (1, 20), (39, 44), (49, 54), (59, 64), (69, 74), (79, 82), (85, 88)]
+FE_HAND_END = 90
+
+def _build_board_bases() -> List[Optional[Tuple[int, int]]]:
+  kinds = [piece.PAWN, piece.LANCE, piece.KNIGHT, piece.SILVER, piece.GOLD, piece.BISHOP, piece.HORSE, piece.ROOK, piece.DRAGON]
+  t = [None] * (piece.DRAGON + 1)
+  for i, p in enumerate(kinds):
+    t[p] = (FE_HAND_END + 162 * i, FE_HAND_END + 162 * i + 81)
+  for p in (piece.PAWN, piece.LANCE, piece.KNIGHT, piece.SILVER):
+    t[piece.PROMOTED + p] = t[piece.GOLD]
+  return t
+
+#(friend, enemy) bona piece base of board pieces indexed by abs(piece), None for king
+_BOARD_BASES = _build_board_bases()
+FE_END = FE_HAND_END + 162 * 9
+#number of HalfKP features
+DIMENSIONS = 81 * FE_END
+#square of cell from sente and gote perspective
+_SQUARES = ([9 * (k % 9) + k // 9 for k in range(81)], [80 - (9 * (k % 9) + k // 9) for k in range(81)])
+
+def _board_feature(p: int, k: int, s: int) -> int:
+  '''bona piece of piece p on cell k from perspective of side with index s'''
+  return _BOARD_BASES[abs(p)][(p < 0) != (s == 1)] + _SQUARES[s][k]
+
+def _hand_feature(owner: int, p: int, n: int, s: int) -> int:
+  '''bona piece of n-th piece p in hand of side with index owner from perspective of side with index s'''
+  return _HAND_BASES[p][owner != s] + n
+
+class HalfKPDelta:
+  '''feature changes of the last move by perspective (sente, gote), refreshed perspective has all features in added'''
+  __slots__ = ('added', 'removed', 'refreshed')
+  def __init__(self):
+    self.added = ([], [])
+    self.removed = ([], [])
+    self.refreshed = [False, False]
+
+class PositionWithHalfKP(Position):
+  '''maintains active HalfKP features of both perspectives in do_move/undo_move'''
+  def __init__(self, sfen: Optional[str] = None):
+    super().__init__(sfen)
+    self._init_features()
+  def _init_features(self):
+    self._features = [set(), set()]
+    self._kings = [0, 0]
+    self._deltas = []
+    self.delta = None
+    for s in range(2):
+      self._refresh(s)
+  @classmethod
+  def from_board(cls, board, side_to_move: int, sente_pieces, gote_pieces, move_no: int = 1):
+    self = super().from_board(board, side_to_move, sente_pieces, gote_pieces, move_no)
+    self._init_features()
+    return self
+  @classmethod
+  def clone(cls, pos):
+    self = super().clone(pos)
+    if isinstance(pos, PositionWithHalfKP):
+      self._features = [set(f) for f in pos._features]
+      self._kings = pos._kings[:]
+      #deltas aren't modified after they were pushed
+      self._deltas = pos._deltas[:]
+      self.delta = pos.delta
+    else:
+      self._init_features()
+    return self
+  def _bona_pieces(self, s: int) -> List[int]:
+    r = []
+    for k, p in enumerate(self.board):
+      if (p != piece.FREE) and (abs(p) != piece.KING):
+        r.append(_board_feature(p, k, s))
+    for owner, c in enumerate((self.sente_pieces, self.gote_pieces)):
+      for i, n in enumerate(c):
+        for j in range(1, n + 1):
+          r.append(_hand_feature(owner, i + 1, j, s))
+    return r
+  def _refresh(self, s: int):
+    k = self.find_king(1 if s == 0 else -1)
+    #king square is None in tsume positions, features of such perspective use square 0
+    self._kings[s] = 0 if k is None else FE_END * _SQUARES[s][k]
+    u = self._kings[s]
+    self._features[s] = set(u + f for f in self._bona_pieces(s))
+  def features(self, side: int) -> List[int]:
+    '''sorted active feature indices from side perspective'''
+    return sorted(self._features[bitboard.side_index(side)])
+  def _move_changes(self, m: Move) -> Tuple[List[tuple], List[tuple]]:
+    '''(added, removed) features of move m (not yet made) as (cell, piece) or (owner, piece, n) items'''
+    added, removed = [], []
+    owner = bitboard.side_index(m.to_piece)
+    c = self.sente_pieces if owner == 0 else self.gote_pieces
+    if m.from_cell is None:
+      p = abs(m.to_piece)
+      removed.append((owner, p, c[p - 1]))
+    else:
+      if abs(m.from_piece) != piece.KING:
+        removed.append((m.from_cell, m.from_piece))
+      taken = self.board[m.to_cell]
+      if taken != piece.FREE:
+        removed.append((m.to_cell, taken))
+        p = piece.unpromote(abs(taken))
+        added.append((owner, p, c[p - 1] + 1))
+    if abs(m.to_piece) != piece.KING:
+      added.append((m.to_cell, m.to_piece))
+    return (added, removed)
+  def _features_of(self, items: List[tuple], s: int) -> List[int]:
+    u = self._kings[s]
+    return [u + (_board_feature(t[1], t[0], s) if len(t) == 2 else _hand_feature(t[0], t[1], t[2], s)) for t in items]
+  def do_move(self, m: Move) -> Optional[UndoMove]:
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, self.side_to_move)
+    added, removed = self._move_changes(m)
+    #rejected move raises here, base class takes it back without touching features
+    u = super().do_move(m)
+    d = HalfKPDelta()
+    king_move = abs(m.to_piece) == piece.KING
+    for s in range(2):
+      f = self._features[s]
+      if king_move and (s == bitboard.side_index(m.to_piece)):
+        d.removed[s].extend(f)
+        self._refresh(s)
+        d.added[s].extend(self._features[s])
+        d.refreshed[s] = True
+      else:
+        a = self._features_of(added, s)
+        r = self._features_of(removed, s)
+        f.difference_update(r)
+        f.update(a)
+        d.added[s].extend(a)
+        d.removed[s].extend(r)
+    self._deltas.append(d)
+    self.delta = d
+    return u
+  def undo_move(self, m: Move, u: Optional[UndoMove]):
+    super().undo_move(m, u)
+    d = self._deltas.pop()
+    for s in range(2):
+      if d.refreshed[s]:
+        self._refresh(s)
+      else:
+        f = self._features[s]
+        f.difference_update(d.added[s])
+        f.update(d.removed[s])
+    self.delta = self._deltas[-1] if self._deltas else None
+
+class FeatureWriter:
+  '''feature lists of positions in flat buffers (CSR): features of i-th position from perspective s (0 - sente, 1 - gote)
+     are indices[offsets[2 * i + s]:offsets[2 * i + s + 1]]'''
+  def __init__(self):
+    self.indices = array('I')
+    self.offsets = array('Q', [0])
+    self.side_to_move = array('b')
+  def __len__(self):
+    return len(self.side_to_move)
+  def append(self, pos: PositionWithHalfKP):
+    for s in (1, -1):
+      self.indices.extend(pos.features(s))
+      self.offsets.append(len(self.indices))
+    self.side_to_move.append(pos.side_to_move)
+  def append_game(self, game):
+    '''all positions of the game including start and final positions'''
+    pos = PositionWithHalfKP(game.start_pos)
+    self.append(pos)
+    for m in game.moves:
+      pos.do_move(m)
+      self.append(pos)
+  def to_numpy(self):
+    '''(indices uint32[M], offsets uint64[2N + 1], side_to_move int8[N]) views of the buffers (numpy is optional)'''
+    import numpy as np
+    return (np.frombuffer(self.indices, dtype = np.uint32), np.frombuffer(self.offsets, dtype = np.uint64),
+            np.frombuffer(self.side_to_move, dtype = np.int8))
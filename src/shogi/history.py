@@ -10,6 +10,8 @@ class PositionWithHistory(position.Position):
     super().__init__(sfen)
     self.start_side_to_move = self.side_to_move
   def do_move(self, m: Move):
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, self.side_to_move)
     u = super().do_move(m)
     self._history.append((m, u))
   def undo_last_move(self):
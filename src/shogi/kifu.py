@@ -12,9 +12,9 @@ from . import move
 from . import piece
 from . import position
 from . import result
-from .game import Game
+from .game import Game, parse_player_name
 
-from ._misc import iter_is_empty
+from ._misc import iter_is_empty, iter_lines
 
 _HEADER_MOVES_SEPARATOR = '手数----指手---------消費時間--'
 
@@ -108,13 +108,58 @@ def move_parse(s: str, side_to_move: int, last_move: Optional[move.Move]) -> Opt
     logging.debug("not enough data")
     return None
 
+def _build_to_cells():
+  d = {}
+  for col, c in enumerate(cell.KIFU_COLS):
+    for row, r in enumerate(cell.KIFU_ROWS):
+      d[c + r] = 9 * row + col
+  return d
+
+def _build_move_bodies():
+  '''piece part of move (between destination and source or drop mark) -> (piece, promoted)'''
+  d = {}
+  for c, p in _KIFU_PIECES_D.items():
+    d[c] = (p, False)
+    if not piece.is_promoted(p):
+      if not p in (piece.GOLD, piece.KING):
+        d['成' + c] = (piece.promote(p), False)
+        d[c + '成'] = (p, True)
+  return d
+
+#'７六' -> cell
+_TO_CELLS = _build_to_cells()
+_MOVE_BODIES = _build_move_bodies()
+_FROM_DIGITS = dict((str(i + 1), i) for i in range(9))
+
+def move_parse_fast(s: str, side_to_move: int, last_move: Optional[move.Move]) -> Optional[move.Move]:
+  '''table driven move_parse() without logging, uncommon move notations are passed to move_parse()'''
+  to_cell = _TO_CELLS.get(s[:2])
+  if to_cell is None:
+    if not s.startswith('同\u3000'):
+      return move_parse(s, side_to_move, last_move)
+    to_cell = last_move and last_move.to_cell
+    if to_cell is None:
+      return None
+  if s[-1] == '打':
+    t = _MOVE_BODIES.get(s[2:-1])
+    if (t is None) or t[1]:
+      return move_parse(s, side_to_move, last_move)
+    return move.Move(None, None, side_to_move * t[0], to_cell)
+  t = _MOVE_BODIES.get(s[2:-4])
+  col = _FROM_DIGITS.get(s[-3:-2])
+  row = _FROM_DIGITS.get(s[-2:-1])
+  if (t is None) or (col is None) or (row is None) or (s[-4] != '(') or (s[-1] != ')'):
+    return move_parse(s, side_to_move, last_move)
+  p, promoted = t
+  return move.Move(side_to_move * p, 9 * row + col, side_to_move * (piece.promote(p) if promoted else p), to_cell)
+
 def _parse_key_value(s: str, sep: str) -> Optional[Tuple[str, str]]:
   i = s.find(sep)
   if i < 0:
     return None
   return (s[:i], s[i+1:])
 
-def _parse_datetime(s: str) -> Optional[datetime.datetime]:
+def parse_datetime(s: str) -> Optional[datetime.datetime]:
   try:
     return datetime.datetime.strptime(s, '%Y/%m/%d %H:%M:%S')
   except ValueError:
@@ -144,15 +189,18 @@ def _parse_move_times(s: Optional[str]) -> Tuple[Optional[datetime.timedelta], O
   v = datetime.timedelta(hours = int(m.group(1)), minutes = int(m.group(2)), seconds = int(m.group(3)))
   return (u, v)
 
-def _parse_player_name(game: Game, s: str, key: str):
-  game.parse_player_name(s, key)
-
 class TimeControl:
   def __init__(self, initial: int, byoyomi: int):
     self.initial = initial
     self.byoyomi = byoyomi
   def __str__(self):
     return f"{self.initial}分+{self.byoyomi}秒"
+  def __eq__(self, other):
+    if not isinstance(other, TimeControl):
+      return False
+    return (self.initial == other.initial) and (self.byoyomi == other.byoyomi)
+  def __hash__(self):
+    return hash((self.initial, self.byoyomi))
 
 def parse_time_control(s: str) -> Optional[TimeControl]:
   m = _REGEXP_WITHOUT_INCREMENT_TIME_CONTROL.fullmatch(s)
@@ -163,16 +211,33 @@ def parse_time_control(s: str) -> Optional[TimeControl]:
     return TimeControl(int(m.group(1)), int(m.group(2)))
   return None
 
+class KifuParser:
+  '''debug logging of lines and moves is done only if debug level was enabled at construction,
+     fast = False uses character by character move_parse()'''
+  def __init__(self, disable_game_result_auto_detection: bool = False, fast: bool = True, debug: Optional[bool] = None,
+               trusted: bool = False):
+    #trusted: game was already validated (e.g. loaded from DB), see Game
+    self._disable_game_result_auto_detection = disable_game_result_auto_detection
+    self._trusted = trusted
+    self._move_parse = move_parse_fast if fast else move_parse
+    self._debug = log.is_debug() if debug is None else debug
+  def parse(self, s: str) -> Optional[Game]:
+    try:
+      return _game_parse(s, self._disable_game_result_auto_detection, self._move_parse, self._debug, self._trusted)
+    except ValueError as err:
+      if self._debug:
+        logging.debug(repr(err))
+      return None
+
 def game_parse(s: str, disable_game_result_auto_detection: bool = False) -> Optional[Game]:
-  try:
-    return _game_parse(s, disable_game_result_auto_detection)
-  except ValueError as err:
-    logging.debug(repr(err))
-    return None
+  return KifuParser(disable_game_result_auto_detection).parse(s)
+
+def _log_line(t):
+  logging.debug('%s', t)
+  return t
 
 def _strip_comment(t):
   """Everything after '#' will be ignored by parsers."""
-  logging.debug('%s', t)
   line, s = t
   s = s.rstrip()
   if line == 0:
@@ -197,6 +262,55 @@ _HEADER_WRITE_ORDER_L = ['start_sfen', 'start_date', 'end_date', 'location', 'ev
 _HEADER_EN_D = dict((t[1], t[0]) for t in _HEADER_JP_D.items())
 _SIDE_S = set(['sente', 'gote'])
 
+def _set_header_tag(tags: dict, key: str, value: str):
+  if key in _SIDE_S:
+    parse_player_name(tags, value, key)
+  elif key.endswith('_date'):
+    date = parse_datetime(value)
+    if not date is None:
+      tags[key] = date
+  elif key == 'time_control':
+    tc = parse_time_control(value)
+    if tc is None:
+      log.raise_value_error(f"Can not parse time control '{value}'")
+    tags[key] = tc
+  else:
+    tags[key] = value
+
+def scan_headers(text_or_stream, count_moves: bool = False, encoding: str = 'UTF8') -> Tuple[dict, Optional[int]]:
+  '''tags of the game (as game_parse() sets them) without parsing and replaying moves, stream is read up to
+     moves section, with count_moves number of move records is also returned (None otherwise)'''
+  tags = {}
+  it = filter(lambda t: t != '', map(_strip_comment, enumerate(iter_lines(text_or_stream, encoding))))
+  for t in it:
+    if t == _HEADER_MOVES_SEPARATOR:
+      break
+    if t.startswith('#'):
+      continue
+    p = _parse_key_value(t, '：')
+    if p is None:
+      if t == '後手番':
+        continue
+      break
+    key = _HEADER_JP_D.get(p[0])
+    if not key is None:
+      _set_header_tag(tags, key, p[1])
+    elif p[0] == '後手の持駒':
+      #board of handicap or problem position
+      for _ in range(12):
+        next(it, None)
+  if not count_moves:
+    return (tags, None)
+  n = 0
+  for s in it:
+    if s.startswith('*'):
+      continue
+    a = [t for t in s.split(' ') if t != '']
+    if (len(a) < 2) or (not a[0].isdigit()) or (not result.game_result_by_jp(a[1]) is None):
+      break
+    n += 1
+  return (tags, n)
+
 def _pieces_parse(s: str) -> List[int]:
   p = [0] * piece.ROOK
   if s == 'なし':
@@ -259,12 +373,16 @@ def _board_parse(s: List[str]) -> List[int]:
     log.raise_value_error('_board_parse: expected board separator')
   return b
 
-def _game_parse(game_kif: str, disable_game_result_auto_detection: bool) -> Optional[Game]:
+def _game_parse(game_kif: str, disable_game_result_auto_detection: bool, parse_move = move_parse, debug: bool = False,
+                trusted: bool = False) -> Optional[Game]:
   '''
   https://lishogi.org/explanation/kif
   '''
-  it = filter(lambda t: t != '', map(_strip_comment, enumerate(game_kif.split('\n'))))
-  game = Game(None, disable_game_result_auto_detection)
+  it = enumerate(game_kif.split('\n'))
+  if debug:
+    it = map(_log_line, it)
+  it = filter(lambda t: t != '', map(_strip_comment, it))
+  game = Game(None, disable_game_result_auto_detection, trusted = trusted)
   t = next(it)
   _version, _encoding = None, None
   try:
@@ -314,23 +432,11 @@ def _game_parse(game_kif: str, disable_game_result_auto_detection: bool) -> Opti
         else:
           side_to_move = 1
           it = itertools.chain([t], it)
-        game2 = Game(position.Position.build_sfen(board, side_to_move, 1, sente_pieces, gote_pieces))
+        game2 = Game(position.Position.build_sfen(board, side_to_move, 1, sente_pieces, gote_pieces), trusted = trusted)
         game2.tags = game.tags
         game = game2
     else:
-      if key in _SIDE_S:
-        _parse_player_name(game, value, key)
-      elif key.endswith('_date'):
-        date = _parse_datetime(value)
-        if not date is None:
-          game.set_tag(key, date)
-      elif key == 'time_control':
-        tc = parse_time_control(value)
-        if tc is None:
-          log.raise_value_error(f"Can not parse time control '{value}'")
-        game.set_tag(key, tc)
-      else:
-        game.set_tag(key, value)
+      _set_header_tag(game.tags, key, value)
   prev_move = None
   location_81dojo = game.get_tag('location') == '81Dojo'
   for s in it:
@@ -350,7 +456,7 @@ def _game_parse(game_kif: str, disable_game_result_auto_detection: bool) -> Opti
           game.set_result(result.GameResult.BAD_CONNECTION)
           break
       continue
-    a = list(filter(lambda t: t != '', s.split(' ')))
+    a = [t for t in s.split(' ') if t != '']
     t = str(game.pos.move_no)
     if (len(a) < 2) or (t != a[0]):
       break
@@ -359,8 +465,9 @@ def _game_parse(game_kif: str, disable_game_result_auto_detection: bool) -> Opti
     if not game_result is None:
       game.set_result(game_result)
       break
-    logging.debug("%s", km)
-    mv = move_parse(km, game.pos.side_to_move, prev_move)
+    if debug:
+      logging.debug("%s", km)
+    mv = parse_move(km, game.pos.side_to_move, prev_move)
     if mv is None:
       return None
     if len(a) > 2:
@@ -369,7 +476,8 @@ def _game_parse(game_kif: str, disable_game_result_auto_detection: bool) -> Opti
     if game.has_result():
       break
     prev_move = mv
-  if (game.game_result == result.GameResult.CHECKMATE) and game.pos.has_legal_move():
+  game.end_trusted_replay()
+  if (not trusted) and (game.game_result == result.GameResult.CHECKMATE) and game.pos.has_legal_move():
     logging.error("Illegal checkmate move record in KIFU, 'checkmated' side has legal moves")
     return None
   game.adjourn()
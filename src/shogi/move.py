@@ -1,7 +1,8 @@
 # -*- coding: UTF8 -*-
 
+from array import array
 from datetime import timedelta
-from typing import Optional
+from typing import Iterable, Optional
 
 from . import cell
 from . import piece
@@ -14,6 +15,7 @@ class UnresolvedCheck(IllegalMove):
   pass
 
 class Move:
+  __slots__ = ('from_piece', 'from_cell', 'to_piece', 'to_cell', 'legal', 'time', 'cum_time')
   def __init__(self, from_piece: Optional[int], from_cell: Optional[int], to_piece: int, to_cell: int):
     assert((from_cell is None) or (0 <= from_cell < 81))
     assert 0 <= to_cell < 81
@@ -115,9 +117,79 @@ class Move:
     self.cum_time = None
 
 class UndoMove:
+  __slots__ = ('taken_piece',)
   def __init__(self, taken_piece: int):
     self.taken_piece = taken_piece
 
+#None time marker in MoveList time arrays
+_NO_TIME = -(1 << 31)
+_CENTISECOND = timedelta(milliseconds = 10)
+
+def _time_to_int(t: Optional[timedelta]) -> int:
+  return _NO_TIME if t is None else round(t / _CENTISECOND)
+
+def _int_to_time(x: int) -> Optional[timedelta]:
+  return None if x == _NO_TIME else x * _CENTISECOND
+
+class MoveList:
+  '''moves packed with Move.pack_to_int() and their times (centiseconds) in flat arrays,
+     Move objects are created only on access'''
+  __slots__ = ('start_side_to_move', 'packed', 'times', 'cum_times')
+  def __init__(self, start_side_to_move: int = 1, moves: Iterable[Move] = ()):
+    self.start_side_to_move = start_side_to_move
+    self.packed = array('I')
+    self.times = array('i')
+    self.cum_times = array('i')
+    self.extend(moves)
+  def side_to_move(self, i: int) -> int:
+    '''side making i-th move'''
+    return -self.start_side_to_move if i & 1 else self.start_side_to_move
+  def append_packed(self, x: int, time: Optional[timedelta] = None, cum_time: Optional[timedelta] = None):
+    self.packed.append(x)
+    self.times.append(_time_to_int(time))
+    self.cum_times.append(_time_to_int(cum_time))
+  def append(self, m: Move):
+    self.append_packed(m.pack_to_int(), m.time, m.cum_time)
+  def extend(self, moves: Iterable[Move]):
+    for m in moves:
+      self.append(m)
+  def __len__(self):
+    return len(self.packed)
+  def _move(self, i: int) -> Move:
+    m = Move.unpack_from_int(self.packed[i], self.side_to_move(i))
+    m.time = _int_to_time(self.times[i])
+    m.cum_time = _int_to_time(self.cum_times[i])
+    return m
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      start, stop, step = i.indices(len(self.packed))
+      if step != 1:
+        raise ValueError('MoveList slice step is not supported')
+      r = MoveList(self.side_to_move(start))
+      r.packed = self.packed[start:stop]
+      r.times = self.times[start:stop]
+      r.cum_times = self.cum_times[start:stop]
+      return r
+    if i < 0:
+      i += len(self.packed)
+    if not 0 <= i < len(self.packed):
+      raise IndexError('MoveList index out of range')
+    return self._move(i)
+  def __iter__(self):
+    for i in range(len(self.packed)):
+      yield self._move(i)
+  def __eq__(self, other):
+    if not isinstance(other, MoveList):
+      return False
+    return (self.start_side_to_move == other.start_side_to_move) and (self.packed == other.packed) and \
+           (self.times == other.times) and (self.cum_times == other.cum_times)
+  def to_list(self):
+    return list(self)
+  def drop_times(self):
+    n = len(self.packed)
+    self.times = array('i', [_NO_TIME]) * n
+    self.cum_times = array('i', [_NO_TIME]) * n
+
 def kifu_line(moves, start_side_to_move):
   a = []
   prev = None
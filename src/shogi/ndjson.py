@@ -0,0 +1,298 @@
+# -*- coding: UTF8 -*-
+''' line oriented importer of games with USI moves: NDJSON exports (lishogi style, one JSON object per line),
+    USI position commands ('position startpos moves 7g7f 3c3d', 'position sfen ... moves ...') and bare move lists
+
+    trusted records (validate = False) are decoded straight into packed moves (Move.pack_to_int()) tracking only the board
+    and pieces in hand, validated records are replayed with legality checks and game result auto detection: move which can't
+    be parsed rejects the record, illegal move ends the game with ILLEGAL_MOVE result, status of the record is used only if
+    no result was found on the board (mate status without mate rejects the record)
+'''
+
+from array import array
+import datetime
+import json
+import logging
+import sys
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import log
+from . import piece
+from ._misc import iter_lines
+from .bulk import map_chunks
+from .compact import CompactGame, _intern
+from .game import Game
+from .kifu import TimeControl
+from .move import Move, MoveList
+from .position import Position, SFEN_STARTPOS
+from .result import GameResult, side_to_move_points
+
+def _build_usi_cells():
+  d = {}
+  for col in range(9):
+    for row in range(9):
+      d[str(col + 1) + chr(97 + row)] = 9 * row + col
+  return d
+
+_USI_CELLS = _build_usi_cells()
+_USI_DROPS = {c.upper(): i + 1 for i, c in enumerate(piece.ASCII_PIECES[:piece.ROOK])}
+_PROMOTABLE = frozenset([piece.PAWN, piece.LANCE, piece.KNIGHT, piece.SILVER, piece.BISHOP, piece.ROOK])
+
+#lower case status of lishogi export -> result
+_STATUS_D = {
+  'mate': GameResult.CHECKMATE,
+  'stalemate': GameResult.CHECKMATE,
+  'resign': GameResult.RESIGNATION,
+  'outoftime': GameResult.TIME,
+  'timeout': GameResult.BAD_CONNECTION,
+  'repetition': GameResult.REPETITION,
+  'perpetualcheck': GameResult.ILLEGAL_PRECEDING_MOVE,
+  'impasse': GameResult.ENTERING_KING,
+  'impasse27': GameResult.ENTERING_KING,
+  'illegalmove': GameResult.ILLEGAL_MOVE,
+  'aborted': GameResult.ABORTED,
+  'nostart': GameResult.ABORTED,
+}
+
+_WINNERS_D = {'sente': 1, 'black': 1, 'gote': -1, 'white': -1}
+
+def _illegal_move(n: int, s: str, reason: str):
+  log.raise_value_error(f"decode_usi_moves(): move {n} '{s}': {reason}")
+
+def decode_usi_moves(moves: Iterable[str], start_pos: Optional[str] = None) -> array:
+  '''packed moves, occupancy of the board and pieces in hand are tracked: geometry of moves and checks aren't verified'''
+  pos = Position.from_sfen(start_pos or SFEN_STARTPOS)
+  board, side = pos.board, pos.side_to_move
+  hands = {1: pos.sente_pieces, -1: pos.gote_pieces}
+  r = array('I')
+  for s in moves:
+    to_cell = _USI_CELLS.get(s[2:4])
+    if (to_cell is None) or (not len(s) in (4, 5)):
+      _illegal_move(len(r) + 1, s, 'bad format')
+    if s[1] == '*':
+      p = _USI_DROPS.get(s[0])
+      if (p is None) or (len(s) != 4):
+        _illegal_move(len(r) + 1, s, 'bad drop')
+      if board[to_cell] != piece.FREE:
+        _illegal_move(len(r) + 1, s, 'drop on occupied cell')
+      c = hands[side]
+      if c[p - 1] == 0:
+        _illegal_move(len(r) + 1, s, 'drop of piece which is not in hand')
+      c[p - 1] -= 1
+      board[to_cell] = p * side
+      r.append((p << 8) + (to_cell << 1) + 1)
+    else:
+      from_cell = _USI_CELLS.get(s[:2])
+      if from_cell is None:
+        _illegal_move(len(r) + 1, s, 'bad format')
+      p = board[from_cell] * side
+      if p <= 0:
+        _illegal_move(len(r) + 1, s, 'no piece of side to move on from cell')
+      taken = -board[to_cell] * side
+      if taken < 0:
+        _illegal_move(len(r) + 1, s, 'capture of own piece')
+      if taken > 0:
+        taken = piece.unpromote(taken)
+        if taken == piece.KING:
+          _illegal_move(len(r) + 1, s, 'capture of king')
+        hands[side][taken - 1] += 1
+      promoted = 0
+      if len(s) == 5:
+        if (s[4] != '+') or (not p in _PROMOTABLE):
+          _illegal_move(len(r) + 1, s, 'illegal promotion')
+        promoted = 1
+        p += piece.PROMOTED
+      board[from_cell] = piece.FREE
+      board[to_cell] = p * side
+      x = (((promoted << 7) + from_cell) << 4) + p
+      r.append(((x << 7) + to_cell) << 1)
+    side = -side
+  return r
+
+class _Record:
+  __slots__ = ('start_pos', 'moves', 'tags', 'game_result', 'winner')
+  def __init__(self, start_pos: Optional[str], moves: List[str]):
+    if start_pos == SFEN_STARTPOS:
+      start_pos = None
+    self.start_pos = start_pos
+    self.moves = moves
+    self.tags = {}
+    self.game_result = None
+    self.winner = None
+    if moves and (moves[-1] == 'resign'):
+      moves.pop()
+      self.game_result = GameResult.RESIGNATION
+
+def _position_record(a: List[str]) -> _Record:
+  '''tokens of USI position command after 'position' '''
+  j = a.index('moves') if 'moves' in a else len(a)
+  if a[:1] == ['startpos'] and (j == 1):
+    return _Record(None, a[j+1:])
+  if a[:1] == ['sfen'] and (j >= 4):
+    return _Record(' '.join(a[1:j]), a[j+1:])
+  log.raise_value_error(f"_position_record(): illegal position command '{' '.join(a)}'")
+
+def _player(players: dict, keys: Tuple[str, str]) -> dict:
+  for key in keys:
+    p = players.get(key)
+    if isinstance(p, dict):
+      return p
+  return {}
+
+def _json_record(d: dict) -> _Record:
+  moves = d.get('moves') or []
+  if isinstance(moves, str):
+    moves = moves.split()
+  r = _Record(d.get('initialSfen') or d.get('sfen') or None, list(moves))
+  tags = r.tags
+  players = d.get('players') or {}
+  for key, keys in (('sente', ('sente', 'black')), ('gote', ('gote', 'white'))):
+    p = _player(players, keys)
+    user = p.get('user') or {}
+    name = user.get('name') or user.get('id') or p.get('name')
+    if name:
+      tags[key] = name
+      rating = p.get('rating')
+      if isinstance(rating, int):
+        tags[key + '_rating'] = rating
+  if 'id' in d:
+    tags['game_id'] = d['id']
+  created = d.get('createdAt')
+  if isinstance(created, (int, float)):
+    #milliseconds since epoch
+    tags['start_date'] = datetime.datetime.fromtimestamp(created // 1000, datetime.timezone.utc).replace(tzinfo = None)
+  clock = d.get('clock')
+  if isinstance(clock, dict) and (not clock.get('increment')) and isinstance(clock.get('initial'), int):
+    tags['time_control'] = TimeControl(clock['initial'] // 60, clock.get('byoyomi', 0))
+  status = d.get('status')
+  if isinstance(status, dict):
+    status = status.get('name')
+  if isinstance(status, str):
+    game_result = _STATUS_D.get(status.lower())
+    if game_result is None:
+      tags['status'] = status
+    else:
+      r.game_result = game_result
+  r.winner = _WINNERS_D.get(d.get('winner'))
+  return r
+
+def _parse_record(line: str) -> Optional[_Record]:
+  '''None for blank and comment lines'''
+  s = line.strip()
+  if (not s) or s.startswith('#'):
+    return None
+  if s.startswith('{'):
+    try:
+      d = json.loads(s)
+    except json.JSONDecodeError as err:
+      log.raise_value_error(f'_parse_record(): {err}')
+    if not isinstance(d, dict):
+      log.raise_value_error('_parse_record(): JSON object expected')
+    return _json_record(d)
+  a = s.split()
+  if a[0] == 'position':
+    return _position_record(a[1:])
+  if a[0] in ('startpos', 'sfen'):
+    return _position_record(a)
+  return _Record(None, a)
+
+def _game_result(r: _Record, game_result: Optional[GameResult], side_to_move: int) -> Optional[GameResult]:
+  '''result contradicting winner of the record (e.g. resignation out of turn) is dropped'''
+  if (game_result is None) or (r.winner is None):
+    return game_result
+  p = side_to_move_points(game_result)
+  if (not p is None) and (p != 0) and (p * side_to_move != r.winner):
+    r.tags['winner'] = piece.side_to_str(r.winner)
+    return None
+  return game_result
+
+def _record_game(r: _Record, validate: bool) -> Game:
+  if validate:
+    g = Game(r.start_pos)
+    for s in r.moves:
+      m = g.pos.parse_usi_move(s)
+      try:
+        g.do_move(m)
+      except ValueError:
+        #e.g. drop of piece which isn't in hand
+        g.set_result(GameResult.ILLEGAL_MOVE)
+      if not g.game_result is None:
+        break
+    #result found on the board (repetition, perpetual check, impasse, mate) overrides status of the record
+    g.adjourn()
+    if (g.game_result is None) and (r.game_result == GameResult.CHECKMATE):
+      log.raise_value_error("_record_game(): mate status, but side to move has legal moves")
+  else:
+    g = Game(r.start_pos, trusted = True)
+    for x in decode_usi_moves(r.moves, r.start_pos):
+      g.do_move(Move.unpack_from_int(x, g.pos.side_to_move))
+      if not g.game_result is None:
+        break
+    g.end_trusted_replay()
+  if g.game_result is None:
+    g.game_result = _game_result(r, r.game_result, g.pos.side_to_move)
+  for key, value in r.tags.items():
+    g.set_tag(key, value)
+  return g
+
+def _record_compact_game(r: _Record, validate: bool) -> CompactGame:
+  if validate:
+    return CompactGame.from_game(_record_game(r, True))
+  start_side_to_move = -1 if (not r.start_pos is None) and (r.start_pos.split()[1] == 'w') else 1
+  l = MoveList(start_side_to_move)
+  l.packed = decode_usi_moves(r.moves, r.start_pos)
+  l.drop_times()
+  game_result = _game_result(r, r.game_result, l.side_to_move(len(l)))
+  tags = tuple((sys.intern(key), _intern(value)) for key, value in r.tags.items())
+  return CompactGame(r.start_pos, l, game_result, tags, ())
+
+def parse_game(line: str, validate: bool = True) -> Optional[Game]:
+  '''game of NDJSON or USI line, None for blank and comment lines, raises ValueError for broken lines,
+     with validate = False moves are trusted (see Game trusted mode)'''
+  r = _parse_record(line)
+  return None if r is None else _record_game(r, validate)
+
+def parse_compact_game(line: str, validate: bool = True) -> Optional[CompactGame]:
+  '''with validate = False no positions are built'''
+  r = _parse_record(line)
+  return None if r is None else _record_compact_game(r, validate)
+
+def iter_games(text_or_stream, encoding: str = 'UTF8', validate: bool = True, compact: bool = False,
+               skip_errors: bool = False) -> Iterator:
+  '''Game (CompactGame if compact) for each record, with skip_errors broken lines are logged and skipped'''
+  f = parse_compact_game if compact else parse_game
+  for line_no, line in enumerate(iter_lines(text_or_stream, encoding), 1):
+    try:
+      g = f(line, validate)
+    except ValueError as err:
+      if not skip_errors:
+        raise ValueError(f'line {line_no}: {err}') from err
+      logging.warning('line %d: %s', line_no, err)
+      continue
+    if not g is None:
+      yield g
+
+def _parse_chunk(lines: List[Tuple[int, str]], validate: bool) -> List[Tuple[int, Optional[CompactGame], Optional[str]]]:
+  r = []
+  for line_no, line in lines:
+    try:
+      g = parse_compact_game(line, validate)
+    #broken record shouldn't abort the chunk
+    except Exception as err:
+      r.append((line_no, None, repr(err)))
+      continue
+    if not g is None:
+      r.append((line_no, g, None))
+  return r
+
+def parse_parallel(text_or_stream, encoding: str = 'UTF8', validate: bool = True, skip_errors: bool = False,
+                   workers: Optional[int] = None, chunksize: int = 512, ordered: bool = True,
+                   max_pending: Optional[int] = None) -> Iterator[CompactGame]:
+  '''CompactGame for each record, lines are read lazily and parsed on a process pool (see bulk.map_chunks())'''
+  lines = enumerate(iter_lines(text_or_stream, encoding), 1)
+  for line_no, g, err in map_chunks(_parse_chunk, lines, chunksize, (validate, ), workers, ordered, max_pending):
+    if err is None:
+      yield g
+    elif not skip_errors:
+      raise ValueError(f'line {line_no}: {err}')
+    else:
+      logging.warning('line %d: %s', line_no, err)
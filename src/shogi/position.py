@@ -1,38 +1,110 @@
 # -*- coding: UTF8 -*-
 
+import functools
 import itertools
-from typing import (Iterator, Optional, Tuple)
+import re
+from typing import (Dict, Iterator, List, Optional, Tuple)
 import logging
 import log
 
 from .move import (Move, UndoMove, IllegalMove, Nifu, UnresolvedCheck)
+from . import bitboard
 from . import cell
 from . import piece
+from . import zobrist
 
 SFEN_STARTPOS = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"
 
 _GOLD_L = [piece.GOLD, piece.promote(piece.PAWN), piece.promote(piece.LANCE), piece.promote(piece.KNIGHT), piece.promote(piece.SILVER)]
 _BISHOP_L = [piece.BISHOP, piece.HORSE]
 _ROOK_L = [piece.ROOK, piece.DRAGON]
-_GENERAL_L = _GOLD_L + [piece.SILVER]
 
 _BISHOP_S = set(_BISHOP_L)
 _ROOK_S = set(_ROOK_L)
-_NEAR_S = set([piece.KING, piece.HORSE, piece.DRAGON])
-_ATTACK_UP_FAR_S = set([piece.LANCE] + _ROOK_L)
-_ATTACK_UP_NEAR_S = set(itertools.chain(_ATTACK_UP_FAR_S, _GENERAL_L, [piece.PAWN]))
-_ATTACK_DIAG_UP_NEAR_S = set(itertools.chain(_BISHOP_L, _GENERAL_L))
-_ATTACK_ROOK_NEAR_S = set(itertools.chain(_ROOK_L, _GOLD_L))
-_ATTACK_BISHOP_NEAR_S = set(itertools.chain(_BISHOP_L, [piece.SILVER]))
-_FIVE_POINTS_S = set(itertools.chain(_BISHOP_L, _ROOK_L))
 _GOLD_S = set(_GOLD_L)
+_SLIDERS_S = _ROOK_S | _BISHOP_S | set([piece.LANCE])
+#Position._move_error() reason for raising Nifu
+_NIFU = 'nifu'
+#shared undo information indexed by taken piece + bitboard.OFFSET
+_UNDO_MOVES = [UndoMove(p - bitboard.OFFSET) for p in range(2 * bitboard.OFFSET + 1)]
+_NO_CAPTURE = _UNDO_MOVES[bitboard.OFFSET]
+#pieces of both sides (PAWN .. KING)
+_PIECES_COUNT = [18, 4, 4, 4, 4, 2, 2, 2]
 _COULD_BE_PROMOTED_S = set([piece.PAWN, piece.LANCE, piece.KNIGHT, piece.SILVER, piece.BISHOP, piece.ROOK])
 _UNIQUE_S = set([piece.PAWN, piece.LANCE, piece.KING])
 
 del _GOLD_L
 del _ROOK_L
 del _BISHOP_L
-del _GENERAL_L
+
+_ASCII_PIECES_D = dict((c, i + 1) for i, c in enumerate(piece.ASCII_PIECES))
+#SFEN board token -> piece
+_SFEN_TOKENS_D = {}
+for _p in range(1, piece.DRAGON + 1):
+  if not piece.ASCII_LONG_NAMES[_p] is None:
+    _SFEN_TOKENS_D[piece.to_string(_p)] = _p
+    _SFEN_TOKENS_D[piece.to_string(-_p)] = -_p
+del _p
+_SFEN_BOARD_TOKENS = [None if (p == piece.FREE) or (abs(p) == piece.PROMOTED + piece.GOLD) else piece.to_string(p) \
+                      for p in range(-piece.DRAGON, piece.DRAGON + 1)]
+_REGEXP_SFEN_ROW = re.compile(r'\+?[A-Za-z]|[1-9]')
+_REGEXP_SFEN_HAND = re.compile(r'(\d*)([A-Za-z])')
+
+@functools.lru_cache(maxsize = 4096)
+def _sfen_row_parse(row: str) -> Tuple[int]:
+  '''pieces of SFEN row from the first to the ninth column'''
+  t = []
+  for c in _REGEXP_SFEN_ROW.findall(row):
+    p = _SFEN_TOKENS_D.get(c)
+    if p is None:
+      t.extend(itertools.repeat(piece.FREE, int(c)))
+    else:
+      t.append(p)
+  t.reverse()
+  return tuple(t)
+
+PACKED_SIZE = 32
+
+def _packed_codes():
+  '''PackedSfen huffman codes (code, bits) of pieces on board and in hand, bits are written starting from the least significant one'''
+  codes = [(0x00, 1), (0x01, 2), (0x03, 4), (0x0b, 4), (0x07, 4), (0x0f, 5), (0x1f, 6), (0x3f, 6)]
+  board = {piece.FREE: codes[piece.FREE]}
+  hand = {}
+  for p in range(1, piece.DRAGON + 1):
+    if (p == piece.KING) or (piece.ASCII_LONG_NAMES[p] is None):
+      continue
+    u = piece.unpromote(p)
+    code, bits = codes[u]
+    #promotion flag
+    if u != piece.GOLD:
+      if u != p:
+        code |= 1 << bits
+      bits += 1
+    #side flag
+    board[p] = (code, bits + 1)
+    board[-p] = (code | (1 << bits), bits + 1)
+    if u == p:
+      code, bits = codes[u][0] >> 1, codes[u][1] - 1
+      if u != piece.GOLD:
+        bits += 1
+      hand[p] = (code, bits + 1)
+      hand[-p] = (code | (1 << bits), bits + 1)
+  return (board, hand)
+
+def _packed_decode_table(d, width: int):
+  t = [None] * (1 << width)
+  for p, (code, bits) in d.items():
+    for i in range(code, 1 << width, 1 << bits):
+      t[i] = (p, bits)
+  return t
+
+_PACKED_BOARD, _PACKED_HAND = _packed_codes()
+_PACKED_BOARD_DECODE = _packed_decode_table(_PACKED_BOARD, 8)
+_PACKED_HAND_DECODE = _packed_decode_table(_PACKED_HAND, 7)
+_PACKED_BOARD = [_PACKED_BOARD.get(p - piece.DRAGON) for p in range(2 * piece.DRAGON + 1)]
+#PackedSfen squares are enumerated file by file
+_PACKED_CELLS = [9 * (sq % 9) + sq // 9 for sq in range(81)]
+_PACKED_HAND_ORDER = [piece.PAWN, piece.LANCE, piece.KNIGHT, piece.SILVER, piece.BISHOP, piece.ROOK, piece.GOLD]
 
 class Position:
   '''shogi position'''
@@ -43,59 +115,86 @@ class Position:
       self.board[9 * row + col] = p
     else:
       log.raise_value_error(f'Position._set_cell(): illegal cell ({row+1}, {col+1})')
+  def _init_bitboards(self):
+    bb = [0] * (2 * piece.DRAGON + 1)
+    o, zb = bitboard.OFFSET, zobrist.BOARD
+    sente, gote, key = 0, 0, 0
+    for k, p in enumerate(self.board):
+      if p > 0:
+        sente |= 1 << k
+      elif p < 0:
+        gote |= 1 << k
+      else:
+        continue
+      bb[p + o] |= 1 << k
+      key ^= zb[p + o][k]
+    self._bb, self._bb_sente, self._bb_gote = bb, sente, gote
+    self._key = key ^ zobrist.position_key((), self.sente_pieces, self.gote_pieces, self.side_to_move)
+  def _bb_toggle(self, p: int, k: int):
+    b = 1 << k
+    if p > 0:
+      self._bb_sente ^= b
+    elif p < 0:
+      self._bb_gote ^= b
+    else:
+      return
+    self._bb[p + bitboard.OFFSET] ^= b
+    self._key ^= zobrist.BOARD[p + bitboard.OFFSET][k]
+  def _hand_change(self, side: int, p: int, delta: int):
+    c = self.sente_pieces if side > 0 else self.gote_pieces
+    i = p - 1
+    n = c[i]
+    t = zobrist.HAND[bitboard.side_index(side)][i]
+    self._key ^= t[n] ^ t[n + delta]
+    c[i] = n + delta
+  def key(self) -> int:
+    '''64-bit zobrist key of board, pieces in hand and side to move (move number isn't included)'''
+    return self._key
+  def __hash__(self):
+    return self._key
+  def __eq__(self, other):
+    if not isinstance(other, Position):
+      return NotImplemented
+    return (self._key == other._key) and (self.side_to_move == other.side_to_move) and (self.board == other.board) and \
+           (self.sente_pieces == other.sente_pieces) and (self.gote_pieces == other.gote_pieces)
   def find_king(self, side: int) -> Optional[int]:
+    b = self._bb[side * piece.KING + bitboard.OFFSET]
+    if b == 0:
+      return None
+    return b.bit_length() - 1
+  def _king_under_check(self, side: int) -> bool:
+    bb, o = self._bb, bitboard.OFFSET
+    kb = bb[side * piece.KING + o]
+    if kb == 0:
+      #tsume positions without attacker king
+      return False
+    k = kb.bit_length() - 1
+    s = -side
     if side > 0:
-      for i in range(80, -1, -1):
-        if self.board[i] == piece.KING:
-          return i
+      enemy, lance_direction = self._bb_gote, bitboard.UP
     else:
-      p = -piece.KING
-      for i in range(81):
-        if self.board[i] == p:
-          return i
-    return None
-  def _scan_board(self, side, r, c, dr, dc, far, near) -> bool:
-    #logging.debug('dr = %s, dc = %s', dr, dc)
-    k = 0
-    while True:
-      k += 1
-      r += dr
-      if (r < 0) or (r > 8):
-        return False
-      c += dc
-      if (c < 0) or (c > 8):
-        return False
-      p = self.board[9 * r + c]
-      t = p * side
-      if t > 0:
-        p = abs(p)
-        #logging.debug('piece = %s, k = %d, (r = %d, c = %d)', p, k, r, c)
-        if k > 1:
-          return p in far
-        return (p in _NEAR_S) or (p in near)
-      if t < 0:
-        return False
-  def _king_under_check(self, side: int) -> bool:
-    s = side
-    (rk, ck) = divmod(self.find_king(s), 9)
-    if self._scan_board(-s, rk, ck, -s, 0, _ATTACK_UP_FAR_S, _ATTACK_UP_NEAR_S) or \
-       self._scan_board(-s, rk, ck, -s, -1, _BISHOP_S, _ATTACK_DIAG_UP_NEAR_S) or \
-       self._scan_board(-s, rk, ck, -s, 1, _BISHOP_S, _ATTACK_DIAG_UP_NEAR_S) or \
-       self._scan_board(-s, rk, ck, 0, -1, _ROOK_S, _ATTACK_ROOK_NEAR_S) or \
-       self._scan_board(-s, rk, ck, 0, 1, _ROOK_S, _ATTACK_ROOK_NEAR_S) or \
-       self._scan_board(-s, rk, ck, s, 0, _ROOK_S, _ATTACK_ROOK_NEAR_S) or \
-       self._scan_board(-s, rk, ck, s, -1, _BISHOP_S, _ATTACK_BISHOP_NEAR_S) or \
-       self._scan_board(-s, rk, ck, s, 1, _BISHOP_S, _ATTACK_BISHOP_NEAR_S):
-      return True
-    #knight check
-    row = rk - 2 * s
-    if 0 <= row < 9:
-      u = 9 * row + ck
-      knight = -piece.KNIGHT * s
-      if (ck > 0) and (self.board[u - 1] == knight):
-        return True
-      if (ck < 8) and (self.board[u + 1] == knight):
-        return True
+      enemy, lance_direction = self._bb_sente, bitboard.DOWN
+    near = bitboard.NEIGHBOURS[k] & enemy
+    if near:
+      board, steps = self.board, bitboard.STEP_ATTACKS_BY_PIECE
+      for j in bitboard.cells(near):
+        if steps[board[j] + o][j] & kb:
+          return True
+    occupied = self._bb_sente | self._bb_gote
+    rays = bitboard.RAYS
+    t = bb[s * piece.ROOK + o] | bb[s * piece.DRAGON + o]
+    if t & bitboard.ROOK_RAYS[k]:
+      for d in bitboard.ROOK_DIRECTIONS:
+        if (rays[d][k] & t) and ((t >> bitboard.first_blocker(d, k, occupied)) & 1):
+          return True
+    t = bb[s * piece.BISHOP + o] | bb[s * piece.HORSE + o]
+    if t & bitboard.BISHOP_RAYS[k]:
+      for d in bitboard.BISHOP_DIRECTIONS:
+        if (rays[d][k] & t) and ((t >> bitboard.first_blocker(d, k, occupied)) & 1):
+          return True
+    t = bb[s * piece.LANCE + o]
+    if t & rays[lance_direction][k]:
+      return ((t >> bitboard.first_blocker(lance_direction, k, occupied)) & 1) != 0
     return False
   def __init__(self, sfen: Optional[str] = None):
     if sfen is None:
@@ -111,7 +210,7 @@ class Position:
       self.side_to_move = -1
     else:
       log.raise_value_error(f"Position.__init__(sfen: {sfen}) unknown side to move")
-    d = dict(map(lambda t: (t[1], t[0] + 1), enumerate(piece.ASCII_PIECES)))
+    d = _ASCII_PIECES_D
     for row, t in enumerate(a[0].split('/')):
       col = 9
       promoted = False
@@ -186,124 +285,220 @@ class Position:
       if sente_c[p-1] + gote_c[p-1] != 2:
         name = piece.ASCII_LONG_NAMES[p]
         log.raise_value_error(f'Position.__init__(sfen: {sfen}) illegal number of {name}s')
+    self._init_bitboards()
+    self._sfen = None
     if not self.is_legal():
       log.raise_value_error(f'Position.__init__(sfen: {sfen}) king under check')
-  def sfen(self, move_no = True) -> str:
-    s = ''
-    for row in range(9):
-      u = 9 * row
+  @classmethod
+  def from_sfen(cls, sfen: str, validate: bool = False):
+    '''with validate = False sfen is trusted (piece counts, kings and checks aren't verified)'''
+    if validate:
+      return cls(sfen)
+    a = sfen.split(' ')
+    board = []
+    for row in a[0].split('/'):
+      board.extend(_sfen_row_parse(row))
+    if len(board) != 81:
+      log.raise_value_error(f'Position.from_sfen(sfen: {sfen}) illegal board size')
+    sente_pieces = [0] * piece.ROOK
+    gote_pieces = [0] * piece.ROOK
+    if a[2] != '-':
+      for n, c in _REGEXP_SFEN_HAND.findall(a[2]):
+        if c.isupper():
+          sente_pieces[_ASCII_PIECES_D[c.lower()] - 1] += int(n) if n else 1
+        else:
+          gote_pieces[_ASCII_PIECES_D[c] - 1] += int(n) if n else 1
+    return cls.from_board(board, 1 if a[1] == 'b' else -1, sente_pieces, gote_pieces, int(a[3]) if len(a) > 3 else 1)
+  @classmethod
+  def from_partial_sfen(cls, sfen: str):
+    '''validated position which could lack pieces (handicap, tsume problem)'''
+    self = cls.from_sfen(sfen)
+    err = self._partial_error()
+    if not err is None:
+      log.raise_value_error(f'Position.from_partial_sfen(sfen: {sfen}) {err}')
+    return self
+  def _partial_error(self) -> Optional[str]:
+    c = [self.sente_pieces[i] + self.gote_pieces[i] for i in range(piece.ROOK)] + [0]
+    for p in self.board:
+      if p != piece.FREE:
+        c[piece.unpromote(abs(p)) - 1] += 1
+    for i, n in enumerate(c):
+      if n > _PIECES_COUNT[i]:
+        return f'too many {piece.ASCII_LONG_NAMES[i + 1]}s'
+    o = bitboard.OFFSET
+    for side in (1, -1):
+      if (self._bb[side * piece.KING + o] & (self._bb[side * piece.KING + o] - 1)) != 0:
+        return 'more than one king of a side'
+      pawns = self._bb[side * piece.PAWN + o]
+      for f in bitboard.FILES:
+        x = pawns & f
+        if (x & (x - 1)) != 0:
+          return 'nifu'
+    if c[piece.KING - 1] == 0:
+      return 'no kings'
+    if not self.is_legal():
+      return 'king under check'
+    return None
+  @classmethod
+  def from_board(cls, board: List[int], side_to_move: int, sente_pieces: List[int], gote_pieces: List[int], move_no: int = 1):
+    '''trusted construction, lists are owned by new position'''
+    self = cls.__new__(cls)
+    self.board = board
+    self.side_to_move = side_to_move
+    self.move_no = move_no
+    self.sente_pieces = sente_pieces
+    self.gote_pieces = gote_pieces
+    self._init_bitboards()
+    self._sfen = None
+    return self
+  def _build_sfen(self) -> str:
+    rows = []
+    board, tokens = self.board, _SFEN_BOARD_TOKENS
+    o = bitboard.OFFSET
+    for u in range(0, 81, 9):
+      s = ''
       t = 0
-      if row > 0:
-        s += '/'
       for i in range(u + 8, u - 1, -1):
-        c = self.board[i]
-        if c == 0:
+        c = tokens[board[i] + o]
+        if c is None:
           t += 1
         else:
           if t > 0:
             s += chr(48 + t)
             t = 0
-          s += piece.to_string(c)
+          s += c
       if t > 0:
         s += chr(48 + t)
-    s += ' '
-    s += 'b' if self.side_to_move > 0 else 'w'
-    s += ' '
+      rows.append(s)
     w = ''
-    for p in range(piece.ROOK, piece.FREE, -1):
-      t = self.sente_pieces[p-1]
-      if t > 0:
-        if t > 1:
-          w += str(t)
-        w += piece.ASCII_PIECES[p-1].upper()
-    for p in range(piece.ROOK, piece.FREE, -1):
-      t = self.gote_pieces[p-1]
-      if t > 0:
-        if t > 1:
-          w += str(t)
-        w += piece.ASCII_PIECES[p-1]
-    if w == '':
-      s += '-'
-    else:
-      s += w
+    for c, a in ((self.sente_pieces, piece.ASCII_PIECES.upper()), (self.gote_pieces, piece.ASCII_PIECES)):
+      for p in range(piece.ROOK - 1, -1, -1):
+        t = c[p]
+        if t > 0:
+          if t > 1:
+            w += str(t)
+          w += a[p]
+    return '/'.join(rows) + (' b ' if self.side_to_move > 0 else ' w ') + (w or '-')
+  def sfen(self, move_no = True) -> str:
+    s = self._sfen
+    if s is None:
+      s = self._build_sfen()
+      self._sfen = s
     if move_no:
-      s += ' ' + str(self.move_no)
+      return s + ' ' + str(self.move_no)
     return s
-  def _validate_move(self, m: Move):
+  def _move_error(self, m: Move) -> Optional[str]:
+    '''None if move could be done in the position (ignoring checks) else reason'''
     if self.side_to_move * m.to_piece <= 0:
-      raise ValueError("position side_to_move field isn't matched to move to_piece field'")
+      return "position side_to_move field isn't matched to move to_piece field'"
     if m.is_drop():
       if self.board[m.to_cell] != piece.FREE:
-        raise ValueError('drop piece on occupied cell')
+        return 'drop piece on occupied cell'
       c = self.sente_pieces if m.to_piece > 0 else self.gote_pieces
       if c[abs(m.to_piece) - 1] <= 0:
-        raise ValueError('dropping piece which not in the player hand')
+        return 'dropping piece which not in the player hand'
       if not cell.can_drop(m.to_cell, m.to_piece):
-        raise ValueError('dropping piece which can not move')
+        return 'dropping piece which can not move'
       if abs(m.to_piece) == piece.PAWN:
-        col = m.to_cell % 9
-        if any(map(lambda row: self.board[9 * row + col] == m.to_piece, range(9))):
-          raise Nifu
+        if self._bb[m.to_piece + bitboard.OFFSET] & bitboard.FILES[m.to_cell % 9]:
+          return _NIFU
     else:
       if self.side_to_move * m.from_piece <= 0:
-        raise ValueError("position side_to_move field isn't matched to move from_piece field'")
+        return "position side_to_move field isn't matched to move from_piece field'"
       taken_piece = self.board[m.to_cell]
       if taken_piece * self.side_to_move > 0:
-        raise ValueError("player takes his piece'")
+        return "player takes his piece'"
+    return None
   def is_legal(self) -> bool:
     return not self._king_under_check(-self.side_to_move)
   def is_check(self) -> bool:
     return self._king_under_check(self.side_to_move)
-  def do_move(self, m: Move) -> Optional[UndoMove]:
-    if m.legal < 0:
-      raise IllegalMove()
-    try:
-      self._validate_move(m)
-    except ValueError as err:
-      m.legal = -1
-      log.raise_value_error(f'Position.do_move(m = {m}): {err}. SFEN = "{self.sfen()}"')
+  def _apply_move(self, m: Move) -> UndoMove:
+    '''makes move without any checks'''
+    self._sfen = None
     if m.is_drop():
       self.board[m.to_cell] = m.to_piece
-      c = self.sente_pieces if m.to_piece > 0 else self.gote_pieces
-      c[abs(m.to_piece) - 1] -= 1
-      u = None
+      self._bb_toggle(m.to_piece, m.to_cell)
+      self._hand_change(m.to_piece, abs(m.to_piece), -1)
+      u = _NO_CAPTURE
     else:
       taken_piece = self.board[m.to_cell]
-      if taken_piece == piece.FREE:
-        u = None
-      else:
-        u = UndoMove(taken_piece)
+      u = _UNDO_MOVES[taken_piece + bitboard.OFFSET]
+      if taken_piece != piece.FREE:
+        self._bb_toggle(taken_piece, m.to_cell)
         a = abs(taken_piece)
         if a != piece.KING:
-          c = self.sente_pieces if taken_piece < 0 else self.gote_pieces
-          c[piece.unpromote(a) - 1] += 1
+          self._hand_change(-taken_piece, piece.unpromote(a), 1)
+      self._bb_toggle(self.board[m.from_cell], m.from_cell)
+      self._bb_toggle(m.to_piece, m.to_cell)
       self.board[m.from_cell] = piece.FREE
       self.board[m.to_cell] = m.to_piece
     self.side_to_move *= -1
     self.move_no += 1
+    self._key ^= zobrist.SIDE
+    return u
+  def do_move_unchecked(self, m: Move) -> UndoMove:
+    '''makes legal move (Move or packed integer) without validation, for replaying already validated games,
+       subclasses history isn't updated'''
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, self.side_to_move)
+    return self._apply_move(m)
+  def try_move(self, m: Move) -> Optional[UndoMove]:
+    '''makes move in place and returns undo information (never None) or returns None if move is illegal,
+       doesn't raise exceptions, subclasses history isn't updated'''
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, self.side_to_move)
+    if (m.legal < 0) or (not self._move_error(m) is None):
+      return None
+    u = self._apply_move(m)
+    if m.legal == 0:
+      if not self.is_legal():
+        m.legal = -1
+        Position.undo_move(self, m, u)
+        return None
+      m.legal = 1
+    return u
+  def do_move(self, m: Move) -> Optional[UndoMove]:
+    '''m is Move or integer packed with Move.pack_to_int()'''
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, self.side_to_move)
+    if m.legal < 0:
+      raise IllegalMove()
+    err = self._move_error(m)
+    if not err is None:
+      if err is _NIFU:
+        raise Nifu
+      m.legal = -1
+      log.raise_value_error(f'Position.do_move(m = {m}): {err}. SFEN = "{self.sfen()}"')
+    u = self._apply_move(m)
     if (m.legal == 0) and not self.is_legal():
       m.legal = -1
       #logging.debug("Illegal position (king under check) = %s", self.sfen())
-      self.undo_move(m, u)
+      #not virtual: subclasses haven't recorded rejected move
+      Position.undo_move(self, m, u)
       raise UnresolvedCheck
     m.legal = 1
-    return u
+    return None if u is _NO_CAPTURE else u
   def undo_move(self, m: Move, u: Optional[UndoMove]):
+    if isinstance(m, int):
+      m = Move.unpack_from_int(m, -self.side_to_move)
     self.side_to_move *= -1
     self.move_no -= 1
+    self._key ^= zobrist.SIDE
+    self._sfen = None
     if m.is_drop():
-      c = self.sente_pieces if m.to_piece > 0 else self.gote_pieces
-      c[abs(m.to_piece) - 1] += 1
+      self._hand_change(m.to_piece, abs(m.to_piece), 1)
       self.board[m.to_cell] = piece.FREE
+      self._bb_toggle(m.to_piece, m.to_cell)
     else:
-      taken_piece = u and u.taken_piece
-      if taken_piece is None:
-        taken_piece = piece.FREE
+      taken_piece = piece.FREE if u is None else u.taken_piece
       if taken_piece != piece.FREE:
         a = abs(taken_piece)
         if a != piece.KING:
-          c = self.sente_pieces if taken_piece < 0 else self.gote_pieces
-          c[piece.unpromote(a) - 1] -= 1
+          self._hand_change(-taken_piece, piece.unpromote(a), -1)
+      self._bb_toggle(self.board[m.to_cell], m.to_cell)
+      self._bb_toggle(taken_piece, m.to_cell)
+      self._bb_toggle(m.from_piece, m.from_cell)
       self.board[m.to_cell] = taken_piece
       self.board[m.from_cell] = m.from_piece
   def parse_usi_move(self, s: str) -> Move:
@@ -394,23 +589,17 @@ class Position:
     return r
   def fesa_impasse_points(self) -> bool:
     s = self.side_to_move
-    king_in_zone, pieces_in_zone, points = False, 0, 0
-    for p in self.board[0:27] if s > 0 else self.board[54:]:
-      if p * s <= 0:
-        continue
-      p = abs(p)
-      if p == piece.KING:
-        king_in_zone = True
-      else:
-        pieces_in_zone += 1
-        points += 5 if p in _FIVE_POINTS_S else 1
-    if (not king_in_zone) or (pieces_in_zone < 10):
+    bb, o = self._bb, bitboard.OFFSET
+    zone = bitboard.PROMOTION_ZONES[bitboard.side_index(s)]
+    if not bb[s * piece.KING + o] & zone:
       return False
-    for i, v in enumerate(self.sente_pieces if s > 0 else self.gote_pieces):
-      if v == 0:
-        continue
-      p = i + 1
-      points += (5 if p in _FIVE_POINTS_S else 1) * v
+    #pieces without king
+    pieces_in_zone = bin((self._bb_sente if s > 0 else self._bb_gote) & zone).count('1') - 1
+    if pieces_in_zone < 10:
+      return False
+    big = (bb[s * piece.BISHOP + o] | bb[s * piece.HORSE + o] | bb[s * piece.ROOK + o] | bb[s * piece.DRAGON + o]) & zone
+    c = self.sente_pieces if s > 0 else self.gote_pieces
+    points = pieces_in_zone + 4 * bin(big).count('1') + sum(c) + 4 * (c[piece.BISHOP - 1] + c[piece.ROOK - 1])
     threshold = 28 if s > 0 else 27
     return points >= threshold
   def _not_unique_piece(self, p: int, to_cell: int, moves) -> bool:
@@ -498,6 +687,11 @@ class Position:
     self.move_no = pos.move_no
     self.sente_pieces = pos.sente_pieces[:]
     self.gote_pieces = pos.gote_pieces[:]
+    self._bb = pos._bb[:]
+    self._bb_sente = pos._bb_sente
+    self._bb_gote = pos._bb_gote
+    self._key = pos._key
+    self._sfen = pos._sfen
     return self
   @classmethod
   def build_sfen(cls, board, side_to_move, move_no, sente_pieces, gote_pieces):
@@ -507,7 +701,81 @@ class Position:
     self.move_no = move_no
     self.sente_pieces = sente_pieces
     self.gote_pieces = gote_pieces
-    return self.sfen()
+    return self._build_sfen() + ' ' + str(move_no)
+  def _pack_error(self) -> Optional[str]:
+    c = [self.sente_pieces[i] + self.gote_pieces[i] for i in range(piece.ROOK)] + [0]
+    for p in self.board:
+      if p != piece.FREE:
+        c[piece.unpromote(abs(p)) - 1] += 1
+    if c != _PIECES_COUNT:
+      return 'PackedSfen needs all 40 pieces'
+    if (self.find_king(1) is None) or (self.find_king(-1) is None):
+      return 'PackedSfen needs both kings'
+    return None
+  def packable(self) -> bool:
+    '''False for positions which lack pieces (handicap, tsume problem)'''
+    return self._pack_error() is None
+  def pack(self) -> bytes:
+    '''fixed size (PACKED_SIZE bytes) huffman coded PackedSfen, move number isn't stored'''
+    err = self._pack_error()
+    if not err is None:
+      log.raise_value_error(f'Position.pack(): {err}. SFEN = "{self.sfen()}"')
+    x = 0 if self.side_to_move > 0 else 1
+    x |= _PACKED_CELLS.index(self.find_king(1)) << 1
+    x |= _PACKED_CELLS.index(self.find_king(-1)) << 8
+    n = 15
+    board = self.board
+    for k in _PACKED_CELLS:
+      p = board[k]
+      if abs(p) == piece.KING:
+        continue
+      code, bits = _PACKED_BOARD[p + bitboard.OFFSET]
+      x |= code << n
+      n += bits
+    for side, c in ((1, self.sente_pieces), (-1, self.gote_pieces)):
+      for p in _PACKED_HAND_ORDER:
+        code, bits = _PACKED_HAND[side * p]
+        for _ in range(c[p - 1]):
+          x |= code << n
+          n += bits
+    return x.to_bytes(PACKED_SIZE, 'little')
+  @classmethod
+  def from_packed(cls, data, move_no: int = 1):
+    '''inverse of pack(), data is bytes-like object of PACKED_SIZE length'''
+    if len(data) != PACKED_SIZE:
+      log.raise_value_error(f'Position.from_packed(): expected {PACKED_SIZE} bytes, but {len(data)} found')
+    x = int.from_bytes(data, 'little')
+    board = [piece.FREE] * 81
+    sente_king, gote_king = (x >> 1) & 0x7f, (x >> 8) & 0x7f
+    if (sente_king >= 81) or (gote_king >= 81) or (sente_king == gote_king):
+      log.raise_value_error('Position.from_packed(): illegal king cell')
+    board[_PACKED_CELLS[sente_king]] = piece.KING
+    board[_PACKED_CELLS[gote_king]] = -piece.KING
+    n = 15
+    for k in _PACKED_CELLS:
+      if board[k] != piece.FREE:
+        continue
+      t = _PACKED_BOARD_DECODE[(x >> n) & 0xff]
+      if t is None:
+        log.raise_value_error('Position.from_packed(): illegal piece code on board')
+      board[k] = t[0]
+      n += t[1]
+    sente_pieces = [0] * piece.ROOK
+    gote_pieces = [0] * piece.ROOK
+    size = 8 * PACKED_SIZE
+    while n < size:
+      t = _PACKED_HAND_DECODE[(x >> n) & 0x7f]
+      if t is None:
+        log.raise_value_error('Position.from_packed(): illegal piece code in hand')
+      p = t[0]
+      if p > 0:
+        sente_pieces[p - 1] += 1
+      else:
+        gote_pieces[-p - 1] += 1
+      n += t[1]
+    if n != size:
+      log.raise_value_error('Position.from_packed(): pieces overflow')
+    return cls.from_board(board, -1 if x & 1 else 1, sente_pieces, gote_pieces, move_no)
   @classmethod
   def packed_to_sfen(cls, s: str):
     '''convert formate used in tsumeshogi DB to sfen'''
@@ -559,51 +827,297 @@ class Position:
     self.move_no = 1
     self.sente_pieces = sente_pieces
     self.gote_pieces = gote_pieces
-    return self.sfen()
-  def _generate_piece_moves(self, p: int, r: int, c: int, direction: Tuple[int, int, bool]) -> Iterator[int]:
-    dr, dc, sliding = direction
-    if p < 0:
-      dr *= -1
-    while True:
-      r += dr
-      if (r < 0) or (r > 8):
-        break
-      c += dc
-      if (c < 0) or (c > 8):
-        break
-      q = self.board[9 * r + c]
-      if q * p > 0:
-        break
-      yield 9 * r + c
-      if not sliding or q != piece.FREE:
-        break
-  def _generate_some_moves(self):
-    s = self.side_to_move
-    c = self.sente_pieces if s > 0 else self.gote_pieces
-    for i, p in enumerate(self.board):
-      if p * s < 0:
+    return self._build_sfen() + ' ' + str(self.move_no)
+  def _attackers_mask(self, k: int, side: int, occupied: int) -> int:
+    '''bitboard of side pieces attacking cell k with given occupancy'''
+    bb, o = self._bb, bitboard.OFFSET
+    #piece of side attacks k iff it stands on a cell attacked from k by the same piece of opposite side
+    st = bitboard.STEP_ATTACKS[bitboard.side_index(-side)]
+    s = side
+    r = st[piece.PAWN][k] & bb[s * piece.PAWN + o]
+    r |= st[piece.KNIGHT][k] & bb[s * piece.KNIGHT + o]
+    r |= st[piece.SILVER][k] & bb[s * piece.SILVER + o]
+    r |= st[piece.GOLD][k] & (bb[s * piece.GOLD + o] | bb[s * piece.TOKIN + o] | bb[s * (piece.PROMOTED + piece.LANCE) + o] | \
+                              bb[s * (piece.PROMOTED + piece.KNIGHT) + o] | bb[s * (piece.PROMOTED + piece.SILVER) + o])
+    r |= st[piece.KING][k] & (bb[s * piece.KING + o] | bb[s * piece.HORSE + o] | bb[s * piece.DRAGON + o])
+    t = bb[s * piece.ROOK + o] | bb[s * piece.DRAGON + o]
+    if t & bitboard.ROOK_RAYS[k]:
+      r |= bitboard.rook_attacks(k, occupied) & t
+    t = bb[s * piece.BISHOP + o] | bb[s * piece.HORSE + o]
+    if t & bitboard.BISHOP_RAYS[k]:
+      r |= bitboard.bishop_attacks(k, occupied) & t
+    t = bb[s * piece.LANCE + o]
+    if t:
+      r |= bitboard.lance_attacks(k, -s, occupied) & t
+    return r
+  def _pins(self, side: int, k: int, own: int, occupied: int) -> dict:
+    '''cell of side piece pinned to the king on cell k -> cells where it could move'''
+    bb, o, s = self._bb, bitboard.OFFSET, -side
+    rooks = bb[s * piece.ROOK + o] | bb[s * piece.DRAGON + o]
+    bishops = bb[s * piece.BISHOP + o] | bb[s * piece.HORSE + o]
+    lance_direction = bitboard.UP if side > 0 else bitboard.DOWN
+    rays = bitboard.RAYS
+    d = {}
+    for i in range(8):
+      sliders = rooks if i < 4 else bishops
+      if i == lance_direction:
+        sliders |= bb[s * piece.LANCE + o]
+      if not rays[i][k] & sliders:
+        continue
+      j = bitboard.first_blocker(i, k, occupied)
+      if not (own >> j) & 1:
         continue
-      if p == piece.FREE:
-        for j, _ in filter(lambda t: t[1] > 0, enumerate(c)):
-          q = s * (j + 1)
-          if cell.can_drop(i, q):
-            yield Move(None, None, q, i)
+      t = bitboard.first_blocker(i, j, occupied)
+      if (t >= 0) and ((sliders >> t) & 1):
+        d[j] = rays[i][k] ^ rays[i][t]
+    return d
+  def attackers_to(self, k: int, side: int) -> int:
+    '''bitboard of side pieces attacking cell k'''
+    return self._attackers_mask(k, side, self._bb_sente | self._bb_gote)
+  def checkers(self) -> int:
+    '''bitboard of pieces giving check to the side to move'''
+    k = self.find_king(self.side_to_move)
+    if k is None:
+      return 0
+    return self.attackers_to(k, -self.side_to_move)
+  def pinned(self, side: int) -> int:
+    '''bitboard of side pieces pinned to its king'''
+    k = self.find_king(side)
+    if k is None:
+      return 0
+    own = self._bb_sente if side > 0 else self._bb_gote
+    return sum(1 << j for j in self._pins(side, k, own, self._bb_sente | self._bb_gote))
+  def _is_pawn_drop_mate(self, m: Move) -> bool:
+    #base class methods, subclasses track history in do_move
+    u = self._apply_move(m)
+    r = not self.has_legal_move()
+    Position.undo_move(self, m, u)
+    return r
+  def _generate_legal_moves(self) -> Iterator[Move]:
+    s = self.side_to_move
+    bb, o, board = self._bb, bitboard.OFFSET, self.board
+    king = s * piece.KING
+    kb = bb[king + o]
+    k = kb.bit_length() - 1
+    own, enemy = (self._bb_sente, self._bb_gote) if s > 0 else (self._bb_gote, self._bb_sente)
+    occupied = own | enemy
+    checkers = self._attackers_mask(k, -s, occupied) if kb else 0
+    double_check = (checkers & (checkers - 1)) != 0
+    if not double_check:
+      if checkers:
+        drop_target = bitboard.BETWEEN[k][checkers.bit_length() - 1]
+        target = drop_target | checkers
       else:
-        row, col = divmod(i, 9)
-        for d in piece.MOVE_TABLE[abs(p)]:
-          for to_cell in self._generate_piece_moves(p, row, col, d):
-            yield Move(p, i, p, to_cell)
-  def has_legal_move(self):
-    pos = Position.clone(self)
-    for m in self._generate_some_moves():
-      try:
-        pos.do_move(m)
-        logging.debug('Found move %s in position %s', m.kifu_str(None), self.sfen())
-        return True
-      except IllegalMove:
-        pass
+        target = bitboard.FULL ^ own
+        drop_target = bitboard.FULL ^ occupied
+      pins = self._pins(s, k, own, occupied) if kb else {}
+      zone = bitboard.PROMOTION_ZONES[bitboard.side_index(s)]
+      for j in bitboard.cells(own ^ kb):
+        p = board[j]
+        t = bitboard.piece_attacks(p, j, occupied) & target
+        if not t:
+          continue
+        if j in pins:
+          t &= pins[j]
+        if abs(p) in _COULD_BE_PROMOTED_S:
+          q = piece.promote(p)
+          unpromoted_mask = bitboard.DROP_MASKS[p + o]
+          from_zone = (zone >> j) & 1
+          for to in bitboard.cells(t):
+            if from_zone or ((zone >> to) & 1):
+              m = Move(p, j, q, to)
+              m.legal = 1
+              yield m
+              if not (unpromoted_mask >> to) & 1:
+                continue
+            m = Move(p, j, p, to)
+            m.legal = 1
+            yield m
+        else:
+          for to in bitboard.cells(t):
+            m = Move(p, j, p, to)
+            m.legal = 1
+            yield m
+      if drop_target:
+        c = self.sente_pieces if s > 0 else self.gote_pieces
+        for i in range(piece.ROOK):
+          if c[i] == 0:
+            continue
+          p = s * (i + 1)
+          t = drop_target & bitboard.DROP_MASKS[p + o]
+          if p == s * piece.PAWN:
+            for col in range(9):
+              if bitboard.FILES[col] & bb[p + o]:
+                t &= ~bitboard.FILES[col]
+            #uchifuzume
+            pawn_check = bb[-king + o].bit_length() - 1 + 9 * s if bb[-king + o] else -1
+          else:
+            pawn_check = -1
+          for to in bitboard.cells(t):
+            m = Move(None, None, p, to)
+            m.legal = 1
+            if (to == pawn_check) and self._is_pawn_drop_mate(m):
+              continue
+            yield m
+    if not kb:
+      return
+    t = bitboard.STEP_ATTACKS_BY_PIECE[king + o][k] & ~own
+    occupied ^= kb
+    for to in bitboard.cells(t):
+      if not self._attackers_mask(to, -s, occupied):
+        m = Move(king, k, king, to)
+        m.legal = 1
+        yield m
+  def legal_moves(self) -> List[Move]:
+    '''all legal moves including optional promotions, check evasions and drops (without nifu and uchifuzume)'''
+    return list(self._generate_legal_moves())
+  def count_legal_moves(self) -> int:
+    return sum(1 for _ in self._generate_legal_moves())
+  def has_legal_move(self) -> bool:
+    for _ in self._generate_legal_moves():
+      return True
     return False
+  def _check_squares(self, a: int, ek: int, occupied: int) -> int:
+    '''cells from which unsigned piece a of the side to move attacks cell ek'''
+    s = self.side_to_move
+    r = bitboard.STEP_ATTACKS[bitboard.side_index(-s)][a][ek]
+    if a in _ROOK_S:
+      r |= bitboard.rook_attacks(ek, occupied)
+    elif a in _BISHOP_S:
+      r |= bitboard.bishop_attacks(ek, occupied)
+    elif a == piece.LANCE:
+      r |= bitboard.lance_attacks(ek, -s, occupied)
+    return r
+  def _generate_check_moves(self) -> Iterator[Move]:
+    s = self.side_to_move
+    bb, o, board = self._bb, bitboard.OFFSET, self.board
+    ekb = bb[-s * piece.KING + o]
+    if not ekb:
+      return
+    ek = ekb.bit_length() - 1
+    king = s * piece.KING
+    kb = bb[king + o]
+    k = kb.bit_length() - 1
+    own, enemy = (self._bb_sente, self._bb_gote) if s > 0 else (self._bb_gote, self._bb_sente)
+    occupied = own | enemy
+    checkers = self._attackers_mask(k, -s, occupied) if kb else 0
+    if checkers:
+      if checkers & (checkers - 1):
+        target, drop_target = 0, 0
+      else:
+        drop_target = bitboard.BETWEEN[k][checkers.bit_length() - 1]
+        target = drop_target | checkers
+    else:
+      target = bitboard.FULL ^ own
+      drop_target = bitboard.FULL ^ occupied
+    pins = self._pins(s, k, own, occupied) if kb else {}
+    #own pieces between own slider and enemy king -> cells of this line, moving off the line is discovered check
+    discovers = self._pins(-s, ek, own, occupied)
+    #check squares of step pieces by unsigned piece
+    squares = {}
+    zone = bitboard.PROMOTION_ZONES[bitboard.side_index(s)]
+    for j in bitboard.cells((own ^ kb) if target else 0):
+      p = board[j]
+      t = bitboard.piece_attacks(p, j, occupied) & target
+      if j in pins:
+        t &= pins[j]
+      if not t:
+        continue
+      line = discovers.get(j)
+      a = abs(p)
+      variants = []
+      if a in _COULD_BE_PROMOTED_S:
+        from_zone = (zone >> j) & 1
+        variants.append((piece.promote(p), zone if not from_zone else bitboard.FULL))
+        variants.append((p, bitboard.DROP_MASKS[p + o]))
+      else:
+        variants.append((p, bitboard.FULL))
+      for q, allowed in variants:
+        aq = abs(q)
+        if aq in _SLIDERS_S:
+          #moving piece could have blocked its own line to the king
+          c = self._check_squares(aq, ek, occupied ^ (1 << j))
+        else:
+          c = squares.get(aq)
+          if c is None:
+            c = squares[aq] = self._check_squares(aq, ek, occupied)
+        u = t & allowed
+        if line is None:
+          u &= c
+        else:
+          u &= c | ~line
+        for to in bitboard.cells(u):
+          m = Move(p, j, q, to)
+          m.legal = 1
+          yield m
+    if drop_target:
+      c = self.sente_pieces if s > 0 else self.gote_pieces
+      for i in range(piece.ROOK):
+        if c[i] == 0:
+          continue
+        p = s * (i + 1)
+        t = drop_target & bitboard.DROP_MASKS[p + o] & self._check_squares(i + 1, ek, occupied)
+        if t and (p == s * piece.PAWN):
+          for col in range(9):
+            if bitboard.FILES[col] & bb[p + o]:
+              t &= ~bitboard.FILES[col]
+        for to in bitboard.cells(t):
+          m = Move(None, None, p, to)
+          m.legal = 1
+          if (p == s * piece.PAWN) and self._is_pawn_drop_mate(m):
+            continue
+          yield m
+    line = discovers.get(k) if kb else None
+    if line is None:
+      return
+    t = bitboard.STEP_ATTACKS_BY_PIECE[king + o][k] & ~own & ~line
+    occupied ^= kb
+    for to in bitboard.cells(t):
+      if not self._attackers_mask(to, -s, occupied):
+        m = Move(king, k, king, to)
+        m.legal = 1
+        yield m
+  def check_moves(self) -> List[Move]:
+    '''legal moves giving check to the opponent king (direct and discovered checks, checking drops),
+       empty list if there is no opponent king'''
+    return list(self._generate_check_moves())
+  def perft(self, depth: int) -> int:
+    '''number of leaf nodes in the legal moves tree of given depth'''
+    if depth <= 0:
+      return 1
+    if depth == 1:
+      return self.count_legal_moves()
+    n = 0
+    for m in self.legal_moves():
+      u = self._apply_move(m)
+      n += self.perft(depth - 1)
+      Position.undo_move(self, m, u)
+    return n
+  def divide(self, depth: int) -> Dict[str, int]:
+    '''perft split by the first move (usi move -> number of leaf nodes)'''
+    d = {}
+    for m in self.legal_moves():
+      u = self._apply_move(m)
+      d[m.usi_str()] = self.perft(depth - 1)
+      Position.undo_move(self, m, u)
+    return d
   def opponent_piece_in_the_camp(self, side: int) -> bool:
     if side > 0:
       return any(p < 0 for p in self.board[63:])
     return any(p > 0 for p in self.board[:18])
+
+def pack_many(positions) -> bytearray:
+  '''packs positions one after another into a single buffer'''
+  positions = list(positions)
+  a = bytearray(PACKED_SIZE * len(positions))
+  for i, pos in enumerate(positions):
+    a[PACKED_SIZE * i:PACKED_SIZE * (i + 1)] = pos.pack()
+  return a
+
+def unpack_many(data, move_no: int = 1) -> Iterator[Position]:
+  '''iterates over positions packed by pack_many() without copying data'''
+  m = memoryview(data)
+  if len(m) % PACKED_SIZE != 0:
+    log.raise_value_error(f'unpack_many(): data length {len(m)} is not multiple of {PACKED_SIZE}')
+  for i in range(0, len(m), PACKED_SIZE):
+    yield Position.from_packed(m[i:i+PACKED_SIZE], move_no)
@@ -5,7 +5,7 @@ import itertools
 import logging
 from typing import Optional, Tuple
 import log
-from ._misc import iter_is_empty
+from ._misc import iter_is_empty, iter_lines
 from .game import Game
 from .move import Move
 from .result import GameResult
@@ -72,6 +72,39 @@ _PSN_TO_KIF_D = {
   'white': 'gote',
 }
 
+def _set_header_tag(tags: dict, key: str, value: str):
+  if key == 'sfen':
+    if value != position.SFEN_STARTPOS:
+      tags['sfen_startpos'] = value
+  elif key == 'date':
+    day, month, year = value.split('/')
+    if year.isdigit() and month.isdigit() and day.isdigit():
+      tags['start_date'] = datetime.date(int(year), int(month), int(day))
+  else:
+    logging.debug("set_tag: %s %s", key, value)
+    tags[_PSN_TO_KIF_D.get(key, key)] = value
+
+def scan_headers(text_or_stream, count_moves: bool = False, encoding: str = 'UTF8') -> Tuple[dict, Optional[int]]:
+  '''tags of the game (as game_parse() sets them) without parsing and replaying moves, stream is read up to
+     the first move, with count_moves number of move records is also returned (None otherwise)'''
+  tags = {}
+  it = iter_lines(text_or_stream, encoding)
+  s = None
+  for s in it:
+    p = _parse_psn_header(s)
+    if p is None:
+      break
+    _set_header_tag(tags, p[0], p[1])
+  if not count_moves:
+    return (tags, None)
+  n = 0
+  for s in itertools.chain([] if s is None else [s], it):
+    mn = str(n + 1) + '.'
+    if (not s.startswith(mn)) or (s[len(mn):].split()[:1] in (['Mate'], ['Resigns'], [])):
+      break
+    n += 1
+  return (tags, n)
+
 def game_parse(game_psn: str) -> Game:
   it = iter(game_psn.split('\n'))
   g = Game()
@@ -83,17 +116,7 @@ def game_parse(game_psn: str) -> Game:
     if p is None:
       it = itertools.chain([s], it)
       break
-    if p[0] == 'sfen':
-      if p[1] != position.SFEN_STARTPOS:
-        g.set_tag('sfen_startpos', p[1])
-    elif p[0] == 'date':
-      day, month, year = p[1].split('/')
-      if year.isdigit() and month.isdigit() and day.isdigit():
-        g.set_tag('start_date', datetime.date(int(year), int(month), int(day)))
-    else:
-      logging.debug("set_tag: %s %s", p[0], p[1])
-      t = _PSN_TO_KIF_D.get(p[0], p[0])
-      g.set_tag(_PSN_TO_KIF_D.get(p[0], p[0]), p[1])
+    _set_header_tag(g.tags, p[0], p[1])
   for i, s in enumerate(it):
     mn = str(i+1) + '.'
     logging.debug('%s %s', mn, s)
@@ -0,0 +1,183 @@
+# -*- coding: UTF8 -*-
+''' streaming readers of concatenated KIF/CSA/PSN games from files, binary streams, .zip and .tar.* archives
+
+    games are split on format boundaries line by line, only the current game is kept in memory
+'''
+
+import logging
+import os
+import tarfile
+import zipfile
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple, Union
+
+import log
+from . import csa, kifu, psn
+from .game import Game
+
+_SUFFIXES = {'.kif': 'kif', '.kifu': 'kif', '.csa': 'csa', '.psn': 'psn'}
+_FORMATS = ('kif', 'csa', 'psn')
+
+class RawGame:
+  '''text of a game, name of the file (archive member) and byte range of the game in it'''
+  __slots__ = ('text', 'name', 'offset', 'size')
+  def __init__(self, text: str, name: Optional[str], offset: int, size: int):
+    self.text = text
+    self.name = name
+    self.offset = offset
+    self.size = size
+  def __repr__(self):
+    return f'RawGame {{name = {self.name}, offset = {self.offset}, size = {self.size}}}'
+
+def format_by_filename(filename: str) -> Optional[str]:
+  return _SUFFIXES.get(os.path.splitext(filename)[1].lower())
+
+def _sniff_format(line: str) -> Optional[str]:
+  if line.startswith('#KIF') or ('：' in line):
+    return 'kif'
+  if line.startswith('['):
+    return 'psn'
+  if line.startswith("'") or line.startswith('V2') or line.startswith('N+') or line.startswith('$') or line.startswith('PI'):
+    return 'csa'
+  return None
+
+class _Splitter:
+  '''decides if line starts a new game, state is reset for each game'''
+  def __init__(self, fmt: str):
+    self._fmt = fmt
+    self.reset()
+  def reset(self):
+    #KIF: moves separator was met, CSA: move or game result was met, PSN: move line was met
+    self._body = False
+    #KIF: line other than # comment was met
+    self._started = False
+  def starts_game(self, line: str) -> bool:
+    '''line without end of line characters'''
+    fmt = self._fmt
+    if fmt == 'kif':
+      if line.startswith('#'):
+        return line.startswith('#KIF') and self._started
+      if line.strip():
+        self._started = True
+      if line.startswith(kifu._HEADER_MOVES_SEPARATOR):
+        self._body = True
+        return False
+      return self._body and ('：' in line) and (not line[:1] in ('*', '&', ' ', '変')) and (not line[:1].isdigit())
+    if fmt == 'csa':
+      if self._body and csa._is_header(line):
+        return True
+      if csa._is_move(line) or line.startswith('%'):
+        self._body = True
+      return False
+    if line.startswith('['):
+      return self._body
+    if line.strip():
+      self._body = True
+    return False
+  def leads_header(self, line: str) -> bool:
+    '''line after game body which belongs to the next game if its header follows (KIF # comments)'''
+    return (self._fmt == 'kif') and self._body and line.startswith('#')
+
+def _open_sources(source) -> Iterator[Tuple[Optional[str], BinaryIO]]:
+  '''(name, binary stream) for file path, .zip/.tar.* archive path or binary stream'''
+  if isinstance(source, (str, os.PathLike)):
+    path = os.fspath(source)
+    if zipfile.is_zipfile(path):
+      with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+          if not info.is_dir():
+            with z.open(info) as f:
+              yield (info.filename, f)
+      return
+    if tarfile.is_tarfile(path):
+      with tarfile.open(path, 'r:*') as t:
+        for member in t:
+          if member.isfile():
+            f = t.extractfile(member)
+            with f:
+              yield (member.name, f)
+      return
+    with open(path, 'rb') as f:
+      yield (path, f)
+    return
+  yield (getattr(source, 'name', None), source)
+
+def _split_stream(f: BinaryIO, name: Optional[str], fmt: Optional[str], encoding: str) -> Iterator[RawGame]:
+  splitter = None if fmt is None else _Splitter(fmt)
+  lines: List[str] = []
+  start, offset = 0, 0
+  #(index in lines, offset) of the first line which could start header of the next game
+  lead = None
+  for b in f:
+    line = b.decode(encoding, errors = 'replace')
+    if offset == 0:
+      line = line.removeprefix('\ufeff')
+    s = line.rstrip('\r\n')
+    if splitter is None:
+      fmt = _sniff_format(s)
+      if not fmt is None:
+        splitter = _Splitter(fmt)
+    if (fmt == 'csa') and s.startswith('/'):
+      #separator isn't part of any game
+      if lines:
+        yield RawGame(''.join(lines), name, start, offset - start)
+      splitter.reset()
+      lines = []
+      offset += len(b)
+      start = offset
+      continue
+    if (not splitter is None) and splitter.starts_game(s) and lines:
+      k, k_offset = (len(lines), offset) if lead is None else lead
+      yield RawGame(''.join(lines[:k]), name, start, k_offset - start)
+      splitter.reset()
+      lines = lines[k:]
+      start = k_offset
+      lead = None
+    elif (not splitter is None) and splitter.leads_header(s):
+      if lead is None:
+        lead = (len(lines), offset)
+    elif s.strip():
+      lead = None
+    if (not lines) and (not s.strip()):
+      #blank lines between games
+      offset += len(b)
+      start = offset
+      continue
+    lines.append(s + '\n')
+    offset += len(b)
+  if lines:
+    yield RawGame(''.join(lines), name, start, offset - start)
+
+def iter_raw_games(source: Union[str, os.PathLike, BinaryIO], fmt: Optional[str] = None, encoding: str = 'UTF8') -> Iterator[RawGame]:
+  '''raw games of source, format is detected by file (archive member) suffix or by the first line if fmt is None'''
+  if (not fmt is None) and (not fmt in _FORMATS):
+    log.raise_value_error(f'iter_raw_games(): unknown format {fmt}')
+  for name, f in _open_sources(source):
+    member_fmt = fmt
+    if (member_fmt is None) and (not name is None):
+      member_fmt = format_by_filename(name)
+    yield from _split_stream(f, name, member_fmt, encoding)
+
+def _parse_function(fmt: str) -> Callable[[str], Optional[Game]]:
+  return {'kif': kifu.game_parse, 'csa': csa.game_parse, 'psn': psn.game_parse}[fmt]
+
+def parse_raw_game(raw: RawGame, fmt: Optional[str] = None) -> Optional[Game]:
+  if fmt is None:
+    fmt = format_by_filename(raw.name or '') or _sniff_format(raw.text.lstrip().split('\n', 1)[0])
+  if fmt is None:
+    log.raise_value_error(f'parse_raw_game(): unknown format of game {raw}')
+  return _parse_function(fmt)(raw.text)
+
+def iter_games(source: Union[str, os.PathLike, BinaryIO], fmt: Optional[str] = None, encoding: str = 'UTF8',
+               skip_errors: bool = False) -> Iterator[Game]:
+  '''parsed games of source, with skip_errors games which can't be parsed are logged and skipped'''
+  for raw in iter_raw_games(source, fmt, encoding):
+    try:
+      g = parse_raw_game(raw, fmt)
+      if g is None:
+        log.raise_value_error(f'iter_games(): could not parse game {raw}', logging.DEBUG)
+    except (ValueError, StopIteration) as err:
+      if not skip_errors:
+        raise ValueError(f'{raw}: {err}') from err
+      logging.warning('%s: %s', raw, err)
+      continue
+    yield g
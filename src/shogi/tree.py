@@ -0,0 +1,209 @@
+# -*- coding: UTF8 -*-
+''' prefix sharing store of games: moves of all games form a trie with per node counts,
+    a game is a reference to its last node plus metadata (result, tags, comments), move times are not stored
+'''
+
+from array import array
+import io
+import pickle
+import sys
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import log
+from .compact import CompactGame
+from .game import Game
+from .move import Move, MoveList
+from .position import SFEN_STARTPOS
+
+_MAGIC = b'PSGT\x01'
+_NO_NODE = 0xffffffff
+#packed moves have 20 bits
+_MOVE_BITS = 20
+
+def _start_side_to_move(start_pos: Optional[str]) -> int:
+  return -1 if (not start_pos is None) and (start_pos.split()[1] == 'w') else 1
+
+class GameTree:
+  '''roots are start positions, other nodes are moves, parent of a node always has smaller index'''
+  def __init__(self):
+    self._parent = array('I')
+    #packed move, index of start position for root
+    self._move = array('I')
+    #number of games passing through the node
+    self._count = array('I')
+    self._first_child = array('I')
+    self._next_sibling = array('I')
+    #(parent << _MOVE_BITS) | packed move -> node
+    self._children = {}
+    #start position (None for SFEN_STARTPOS) -> root node
+    self._roots = {}
+    self._start_pos = []
+    #last node of each game
+    self._leaves = array('I')
+    #(game_result, tags, comments) of each game
+    self._meta = []
+  def __len__(self):
+    return len(self._meta)
+  def node_count(self) -> int:
+    return len(self._parent)
+  def _new_node(self, parent: int, move: int) -> int:
+    k = len(self._parent)
+    self._parent.append(parent)
+    self._move.append(move)
+    self._count.append(0)
+    self._first_child.append(_NO_NODE)
+    self._next_sibling.append(_NO_NODE)
+    return k
+  def _root(self, start_pos: Optional[str], create: bool) -> Optional[int]:
+    if start_pos == SFEN_STARTPOS:
+      start_pos = None
+    k = self._roots.get(start_pos)
+    if (k is None) and create:
+      k = self._new_node(_NO_NODE, len(self._start_pos))
+      self._roots[start_pos] = k
+      self._start_pos.append(start_pos)
+    return k
+  def _child(self, node: int, packed_move: int, create: bool) -> Optional[int]:
+    key = (node << _MOVE_BITS) | packed_move
+    k = self._children.get(key)
+    if (k is None) and create:
+      k = self._new_node(node, packed_move)
+      self._children[key] = k
+      self._next_sibling[k] = self._first_child[node]
+      self._first_child[node] = k
+    return k
+  def insert(self, game) -> int:
+    '''game is Game or CompactGame, returns index of inserted game'''
+    if isinstance(game, Game):
+      game = CompactGame.from_game(game)
+    node = self._root(game.start_pos, True)
+    self._count[node] += 1
+    for x in game.moves.packed:
+      node = self._child(node, x, True)
+      self._count[node] += 1
+    self._leaves.append(node)
+    self._meta.append((game.game_result, game.tags, game.comments))
+    return len(self._meta) - 1
+  def find(self, moves, start_pos: Optional[str] = None) -> Optional[int]:
+    '''node reached by moves (Move or packed moves), None if no game contains this prefix'''
+    node = self._root(start_pos, False)
+    for m in moves:
+      if node is None:
+        break
+      node = self._child(node, m.pack_to_int() if isinstance(m, Move) else m, False)
+    return node
+  def count(self, node: int) -> int:
+    return self._count[node]
+  def depth(self, node: int) -> int:
+    d = 0
+    while self._parent[node] != _NO_NODE:
+      node = self._parent[node]
+      d += 1
+    return d
+  def children(self, node: int) -> List[Tuple[int, int]]:
+    '''(packed move, child node) pairs ordered by number of games descending'''
+    r = []
+    k = self._first_child[node]
+    while k != _NO_NODE:
+      r.append((self._move[k], k))
+      k = self._next_sibling[k]
+    r.sort(key = lambda t: -self._count[t[1]])
+    return r
+  def _path(self, node: int) -> Tuple[int, array]:
+    '''(root, packed moves from root to node)'''
+    a = array('I')
+    while self._parent[node] != _NO_NODE:
+      a.append(self._move[node])
+      node = self._parent[node]
+    a.reverse()
+    return (node, a)
+  def __getitem__(self, i: int) -> CompactGame:
+    if i < 0:
+      i += len(self._meta)
+    if not 0 <= i < len(self._meta):
+      raise IndexError('GameTree index out of range')
+    root, packed = self._path(self._leaves[i])
+    start_pos = self._start_pos[self._move[root]]
+    l = MoveList(_start_side_to_move(start_pos))
+    for x in packed:
+      l.append_packed(x)
+    game_result, tags, comments = self._meta[i]
+    return CompactGame(start_pos, l, game_result, tags, comments)
+  def __iter__(self) -> Iterator[CompactGame]:
+    for i in range(len(self._meta)):
+      yield self[i]
+  def duplicates(self) -> List[List[int]]:
+    '''groups of indices of games with the same start position and moves'''
+    d = {}
+    for i, leaf in enumerate(self._leaves):
+      d.setdefault(leaf, []).append(i)
+    return [l for l in d.values() if len(l) > 1]
+  def _merge_nodes(self, other: 'GameTree', roots: List[int]):
+    '''adds nodes (with counts) and games of other tree, roots[i] is node of i-th start position of other tree'''
+    m = array('I', [_NO_NODE]) * len(other._parent)
+    for k in range(len(other._parent)):
+      p = other._parent[k]
+      if p == _NO_NODE:
+        j = roots[other._move[k]]
+      else:
+        j = self._child(m[p], other._move[k], True)
+      m[k] = j
+      self._count[j] += other._count[k]
+    for leaf, meta in zip(other._leaves, other._meta):
+      self._leaves.append(m[leaf])
+      self._meta.append(meta)
+  def merge(self, other: 'GameTree'):
+    '''adds all games of other tree'''
+    if other is self:
+      other = GameTree.read_bytes(self.to_bytes())
+    self._merge_nodes(other, [self._root(p, True) for p in other._start_pos])
+  def write(self, f: BinaryIO):
+    f.write(_MAGIC)
+    header = pickle.dumps((len(self._parent), len(self._leaves), self._start_pos), protocol = pickle.HIGHEST_PROTOCOL)
+    f.write(len(header).to_bytes(4, 'little'))
+    f.write(header)
+    for a in (self._parent, self._move, self._count, self._leaves):
+      if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+      f.write(a.tobytes())
+    pickle.dump(self._meta, f, protocol = pickle.HIGHEST_PROTOCOL)
+  @classmethod
+  def read(cls, f: BinaryIO) -> 'GameTree':
+    if f.read(len(_MAGIC)) != _MAGIC:
+      log.raise_value_error('GameTree.read(): unknown file format')
+    header = f.read(int.from_bytes(f.read(4), 'little'))
+    nodes, games, start_pos = pickle.loads(header)
+    t = cls()
+    arrays = []
+    for n in (nodes, nodes, nodes, games):
+      a = array('I')
+      a.frombytes(f.read(a.itemsize * n))
+      if sys.byteorder != 'little':
+        a.byteswap()
+      arrays.append(a)
+    t._parent, t._move, t._count, t._leaves = arrays
+    t._meta = pickle.load(f)
+    t._start_pos = start_pos
+    for k in range(nodes):
+      if t._parent[k] == _NO_NODE:
+        t._roots[start_pos[t._move[k]]] = k
+    t._first_child = array('I', [_NO_NODE]) * nodes
+    t._next_sibling = array('I', [_NO_NODE]) * nodes
+    for k in range(nodes):
+      p = t._parent[k]
+      if p == _NO_NODE:
+        continue
+      t._children[(p << _MOVE_BITS) | t._move[k]] = k
+      t._next_sibling[k] = t._first_child[p]
+      t._first_child[p] = k
+    return t
+  def to_bytes(self) -> bytes:
+    f = io.BytesIO()
+    self.write(f)
+    return f.getvalue()
+  @classmethod
+  def read_bytes(cls, data: bytes) -> 'GameTree':
+    return cls.read(io.BytesIO(data))
+  def stats(self) -> Dict[str, int]:
+    return {'games': len(self._meta), 'nodes': len(self._parent), 'moves': sum(self.depth(leaf) for leaf in self._leaves)}
@@ -0,0 +1,205 @@
+# -*- coding: UTF8 -*-
+''' tsume (mate) solver: depth first proof number search (df-pn) '''
+
+from array import array
+import time
+from typing import FrozenSet, List, Optional, Tuple
+
+from .move import Move
+from .position import Position
+
+#proof/disproof number of solved node
+INF = 1 << 30
+_NO_DEPS = frozenset()
+
+class TranspositionTable:
+  '''fixed size table of (phi, delta, work) keyed by position hash,
+     buckets of two entries, entry with less search work is replaced'''
+  def __init__(self, size: int = 1 << 18):
+    n = 1 << max(1, (size - 1).bit_length())
+    self._mask = n - 2
+    self._keys = array('Q', [0]) * n
+    self._phi = array('i', [0]) * n
+    self._delta = array('i', [0]) * n
+    self._work = array('Q', [0]) * n
+  def __len__(self):
+    return len(self._keys)
+  def clear(self):
+    n = len(self._keys)
+    self._keys = array('Q', [0]) * n
+    self._phi = array('i', [0]) * n
+    self._delta = array('i', [0]) * n
+    self._work = array('Q', [0]) * n
+  def _find(self, key: int) -> int:
+    i = key & self._mask
+    if self._keys[i] == key:
+      return i
+    if self._keys[i + 1] == key:
+      return i + 1
+    return -1
+  def lookup(self, key: int) -> Tuple[int, int, int]:
+    '''(phi, delta, work), (1, 1, 0) for unknown position'''
+    i = self._find(key)
+    if i < 0:
+      return (1, 1, 0)
+    return (self._phi[i], self._delta[i], self._work[i])
+  def store(self, key: int, phi: int, delta: int, work: int):
+    i = self._find(key)
+    if i < 0:
+      i = key & self._mask
+      if self._work[i + 1] < self._work[i]:
+        i += 1
+    self._keys[i] = key
+    self._phi[i] = phi
+    self._delta[i] = delta
+    self._work[i] = work
+
+class TsumeResult:
+  def __init__(self, mate: Optional[bool], moves: List[Move], nodes: int, seconds: float):
+    #True: mate, False: no mate, None: search was stopped by limits
+    self.mate = mate
+    #mating line (attacker moves with defender resistance choosen by search work)
+    self.moves = moves
+    self.nodes = nodes
+    self.seconds = seconds
+  def __repr__(self):
+    return f'TsumeResult {{mate = {self.mate}, moves = {len(self.moves)}, nodes = {self.nodes}}}'
+
+class _LimitExceeded(Exception):
+  pass
+
+class Solver:
+  '''attacker is the side to move and plays only checks, repetition is counted as defender win,
+     results depending on repetition of positions on the search path aren't stored in the transposition table'''
+  def __init__(self, tt_size: int = 1 << 18, max_nodes: Optional[int] = None, max_time: Optional[float] = None):
+    self.tt = TranspositionTable(tt_size)
+    self.max_nodes = max_nodes
+    self.max_time = max_time
+    self.nodes = 0
+    self._deadline = None
+    self._path = set()
+    #key -> (phi, delta, keys of path positions whose repetition the result depends on)
+    self._path_results = {}
+    #path position key -> keys of path results depending on it
+    self._dependents = {}
+  def _check_limits(self):
+    if (not self.max_nodes is None) and (self.nodes >= self.max_nodes):
+      raise _LimitExceeded
+    if (not self._deadline is None) and ((self.nodes & 1023) == 0) and (time.monotonic() > self._deadline):
+      raise _LimitExceeded
+  def _expand(self, pos: Position, or_node: bool) -> List[Tuple[Move, int]]:
+    '''(move, child key) pairs, checks only for the attacker'''
+    r = []
+    for m in (pos.check_moves() if or_node else pos.legal_moves()):
+      u = pos.try_move(m)
+      r.append((m, pos.key()))
+      pos.undo_move(m, u)
+    return r
+  def _child_values(self, key: int, child_or_node: bool) -> Tuple[int, int, FrozenSet[int]]:
+    '''(phi, delta, path dependencies)'''
+    if key in self._path:
+      #repetition, attacker fails
+      return (INF, 0, frozenset([key])) if child_or_node else (0, INF, frozenset([key]))
+    t = self._path_results.get(key)
+    if (not t is None) and (t[2] <= self._path):
+      return t
+    phi, delta, _ = self.tt.lookup(key)
+    return (phi, delta, _NO_DEPS)
+  def _store(self, key: int, phi: int, delta: int, work: int, deps: FrozenSet[int]):
+    if deps:
+      #valid only while all positions of deps are on the search path (graph history interaction)
+      self._path_results[key] = (phi, delta, deps)
+      for k in deps:
+        self._dependents.setdefault(k, []).append(key)
+    else:
+      self._path_results.pop(key, None)
+      self.tt.store(key, phi, delta, work)
+  def _leave_path(self, key: int):
+    '''path results depending on the position are dropped, so they are bounded by the search path'''
+    self._path.discard(key)
+    for k in self._dependents.pop(key, ()):
+      t = self._path_results.get(k)
+      if (not t is None) and (key in t[2]):
+        del self._path_results[k]
+  def _mid(self, pos: Position, th_phi: int, th_delta: int, or_node: bool):
+    self.nodes += 1
+    self._check_limits()
+    key = pos.key()
+    children = self._expand(pos, or_node)
+    if not children:
+      #attacker has no checks or defender is mated
+      self._store(key, INF, 0, 1, _NO_DEPS)
+      return
+    start_nodes = self.nodes
+    self._path.add(key)
+    while True:
+      phi, delta = INF, 0
+      best, phi_best, delta2 = -1, 0, INF
+      deps, best_deps = _NO_DEPS, _NO_DEPS
+      for i, (_, ck) in enumerate(children):
+        p, d, cd = self._child_values(ck, not or_node)
+        delta = min(INF, delta + p)
+        if d < phi:
+          delta2 = phi
+          phi, best, phi_best, best_deps = d, i, p, cd
+        elif d < delta2:
+          delta2 = d
+        if cd:
+          deps = deps | cd
+      if (phi >= th_phi) or (delta >= th_delta):
+        break
+      m = children[best][0]
+      u = pos.try_move(m)
+      self._mid(pos, min(INF, th_delta + phi_best - delta), min(th_phi, delta2 + 1), not or_node)
+      pos.undo_move(m, u)
+    self._leave_path(key)
+    #win of the side to move depends only on the winning child, other values depend on all children,
+    #repetition of the node itself recurs whenever the node is searched
+    deps = (best_deps if phi == 0 else deps) - {key}
+    self._store(key, phi, delta, self.nodes - start_nodes + 1, deps)
+  def _mating_line(self, pos: Position) -> List[Move]:
+    r = []
+    seen = set()
+    or_node = True
+    while not pos.key() in seen:
+      seen.add(pos.key())
+      best, best_work = None, -1
+      for m, ck in self._expand(pos, or_node):
+        phi, delta, work = self.tt.lookup(ck)
+        if or_node:
+          #shortest proved defender position
+          if (delta == 0) and ((best is None) or (work < best_work)):
+            best, best_work = m, work
+        elif phi == 0:
+          #longest resistance
+          if work > best_work:
+            best, best_work = m, work
+        else:
+          return r
+      if best is None:
+        break
+      pos.try_move(best)
+      r.append(best)
+      or_node = not or_node
+    return r
+  def solve(self, pos: Position) -> TsumeResult:
+    '''position isn't modified'''
+    pos = Position.from_sfen(pos.sfen())
+    self.nodes = 0
+    self._path = set()
+    self._path_results = {}
+    self._dependents = {}
+    t = time.monotonic()
+    self._deadline = None if self.max_time is None else t + self.max_time
+    try:
+      self._mid(pos, INF, INF, True)
+    except _LimitExceeded:
+      return TsumeResult(None, [], self.nodes, time.monotonic() - t)
+    phi, delta, _ = self.tt.lookup(pos.key())
+    if phi == 0:
+      return TsumeResult(True, self._mating_line(pos), self.nodes, time.monotonic() - t)
+    return TsumeResult(False if delta == 0 else None, [], self.nodes, time.monotonic() - t)
+
+def solve(sfen: str, max_nodes: Optional[int] = None, max_time: Optional[float] = None) -> TsumeResult:
+  '''sfen is trusted, attacker king could be absent'''
+  return Solver(max_nodes = max_nodes, max_time = max_time).solve(Position.from_sfen(sfen))
@@ -0,0 +1,33 @@
+# -*- coding: UTF8 -*-
+''' zobrist keys for incremental position hashing '''
+
+import random
+
+from . import piece
+
+_MAX_IN_HAND = 18
+
+_rng = random.Random(0x5348_4f47_4920_4442)
+
+def _rand64() -> int:
+  return _rng.getrandbits(64)
+
+#BOARD[p + piece.DRAGON][cell], zero for free cell
+BOARD = [[0] * 81 if p == piece.FREE else [_rand64() for _ in range(81)] for p in range(-piece.DRAGON, piece.DRAGON + 1)]
+#HAND[side_index][p - 1][count], zero for empty hand
+HAND = [[[0] + [_rand64() for _ in range(_MAX_IN_HAND)] for _ in range(piece.ROOK)] for _ in range(2)]
+#xored when gote to move
+SIDE = _rand64()
+
+del _rng
+
+def position_key(board, sente_pieces, gote_pieces, side_to_move: int) -> int:
+  k = 0
+  for i, p in enumerate(board):
+    k ^= BOARD[p + piece.DRAGON][i]
+  for t, c in zip(HAND, (sente_pieces, gote_pieces)):
+    for i, n in enumerate(c):
+      k ^= t[i][n]
+  if side_to_move < 0:
+    k ^= SIDE
+  return k
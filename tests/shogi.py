@@ -1,5 +1,6 @@
 # -*- coding: UTF8 -*-
 import csv
+import datetime
 import glob
 import gzip
 import inspect
@@ -8,13 +9,21 @@ import itertools
 import logging
 import math
 import os
+import tarfile
+import tempfile
 import unittest
+import zipfile
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 import shogi
 from shogi.castles import Castle
 from shogi.history import PositionWithHistory
 from shogi.openings import Opening
-from shogi.move import (IllegalMove, Move)
+from shogi.move import (IllegalMove, Move, MoveList)
 from shogi.position import Position
 
 MODULE_DIR = os.path.dirname(inspect.getfile(inspect.currentframe()))
@@ -142,6 +151,10 @@ class TestShogiPiece(unittest.TestCase):
     self.assertEqual(shogi.piece.to_string(shogi.piece.HORSE), '+B')
     self.assertEqual(shogi.piece.to_string(-shogi.piece.HORSE), '+b')
 
+def _parse_81dojo_kifu(kifu_id: int):
+  with open(os.path.join(MODULE_DIR, '81dojo', f'{kifu_id:04d}.kif'), 'r', encoding = 'UTF8') as f:
+    return shogi.kifu.game_parse(f.read())
+
 class TestShogiPosition(unittest.TestCase):
   def test_init_default(self):
     p = Position()
@@ -181,8 +194,7 @@ class TestShogiPosition(unittest.TestCase):
     self._check_game(GAME2, fens2)
   def _check_kifu(self, t):
     kifu_id, sfen, sente_points = t
-    with open(os.path.join(MODULE_DIR, '81dojo', f'{kifu_id:04d}.kif'), 'r', encoding = 'UTF8') as f:
-      g = shogi.kifu.game_parse(f.read())
+    g = _parse_81dojo_kifu(kifu_id)
     self.assertIsNotNone(g)
     self.assertEqual(g.pos.sfen(), sfen)
     self.assertEqual(g.sente_points(), sente_points)
@@ -222,6 +234,20 @@ class TestShogiPosition(unittest.TestCase):
   def test_is_check(self):
     p = Position('ln4gkl/3s2+Ss1/2pp2np1/p5p1p/9/3P1PP1P/P1+r1PGNP1/3R2SK1/L4G2L w BG3Pbn2p 50')
     self.assertTrue(p.is_check())
+  def test_try_move(self):
+    p = Position('ln4gkl/3s2+Ss1/2pp2np1/p5p1p/9/3P1PP1P/P1+r1PGNP1/3R2SK1/L4G2L w BG3Pbn2p 50')
+    sfen, key = p.sfen(), p.key()
+    legal = set(m.usi_str() for m in p.legal_moves())
+    for s in ['2a1b', '2a3b', '3a3b', 'P*5e', 'N*4b', '6b5c']:
+      m = p.parse_usi_move(s)
+      u = p.try_move(m)
+      self.assertEqual(u is not None, s in legal, s)
+      if not u is None:
+        p.undo_move(m, u)
+      self.assertEqual(p.sfen(), sfen)
+      self.assertEqual(p.key(), key)
+    with self.assertRaises(IllegalMove):
+      p.do_move(p.parse_usi_move('P*5e'))
   def test_usi_games(self):
     for usi_moves, final_sfen in USI_GAMES:
       pos = Position()
@@ -230,6 +256,95 @@ class TestShogiPosition(unittest.TestCase):
         self.assertEqual(s, m.usi_str())
         pos.do_move(m)
       self.assertEqual(final_sfen, pos.sfen())
+  def _check_bitboards(self, pos):
+    self.assertEqual(shogi.bitboard.from_board(pos.board), (pos._bb, pos._bb_sente, pos._bb_gote))
+    self.assertEqual(pos.key(), Position(pos.sfen()).key())
+  def test_bitboards(self):
+    for usi_moves, _ in USI_GAMES:
+      pos = Position()
+      for s in usi_moves.split():
+        m = pos.parse_usi_move(s)
+        u = pos.do_move(m)
+        self._check_bitboards(pos)
+        pos.undo_move(m, u)
+        self._check_bitboards(pos)
+        pos.do_move(m)
+        self.assertEqual(pos.find_king(1), pos.board.index(shogi.piece.KING))
+        self.assertEqual(pos.find_king(-1), pos.board.index(-shogi.piece.KING))
+  def test_key(self):
+    p1, p2 = Position(), Position()
+    for s in '7g7f 3c3d 2g2f'.split():
+      p1.do_move(p1.parse_usi_move(s))
+    for s in '2g2f 3c3d 7g7f'.split():
+      p2.do_move(p2.parse_usi_move(s))
+    self.assertEqual(p1.key(), p2.key())
+    self.assertEqual(p1, p2)
+    self.assertEqual(len(set([p1, p2, Position.clone(p1)])), 1)
+    self.assertNotEqual(p1, Position())
+    p3 = Position('lnsgkgsnl/1r5b1/ppppppppp/9/9/2P6/PP1PPPPPP/1B5R1/LNSGKGSNL b - 2')
+    self.assertNotEqual(p3.key(), Position('lnsgkgsnl/1r5b1/ppppppppp/9/9/2P6/PP1PPPPPP/1B5R1/LNSGKGSNL w - 2').key())
+  def test_legal_moves(self):
+    p = Position()
+    self.assertEqual(p.count_legal_moves(), 30)
+    self.assertEqual(len(p.legal_moves()), 30)
+    #uchifuzume
+    p = Position('7lk/7p1/8G/9/9/9/9/9/4K4 b 2R2B3G4S4N3L17P 1')
+    moves = set(m.usi_str() for m in p.legal_moves())
+    self.assertNotIn('P*1b', moves)
+    self.assertIn('L*1b', moves)
+    self.assertIn('P*1d', moves)
+    #nifu
+    self.assertNotIn('P*5h', set(m.usi_str() for m in Position().legal_moves()))
+    #optional and mandatory promotions
+    p = Position('4k4/9/P8/9/9/9/9/9/4K4 b 2R2B4G4S4N4L17p 1')
+    moves = set(m.usi_str() for m in p.legal_moves())
+    self.assertIn('9c9b+', moves)
+    self.assertIn('9c9b', moves)
+    p = Position('4k4/P8/9/9/9/9/9/9/4K4 b 2R2B4G4S4N4L17p 1')
+    moves = set(m.usi_str() for m in p.legal_moves())
+    self.assertIn('9b9a+', moves)
+    self.assertNotIn('9b9a', moves)
+  def test_has_legal_move(self):
+    p = Position('ln4gkl/3s2+Ss1/2pp2np1/p5p1p/9/3P1PP1P/P1+r1PGNP1/3R2SK1/L4G2L w BG3Pbn2p 50')
+    self.assertTrue(p.has_legal_move())
+    for m in p.legal_moves():
+      u = p.do_move(m)
+      self.assertFalse(p._king_under_check(-p.side_to_move))
+      p.undo_move(m, u)
+  def test_from_sfen(self):
+    sfens = [shogi.position.SFEN_STARTPOS] + [t[1] for t in USI_GAMES] + [t[0] for t in PERFT_POSITIONS + WESTERN_MOVE_TESTS]
+    for sfen in sfens:
+      pos = Position.from_sfen(sfen)
+      self.assertEqual(pos.sfen(), sfen)
+      self.assertEqual(pos, Position(sfen))
+      self._check_bitboards(pos)
+    self.assertRaises(ValueError, Position.from_sfen, '9 b - 1', True)
+  def test_sfen_cache(self):
+    pos = Position()
+    sfen = pos.sfen()
+    m = pos.parse_usi_move('7g7f')
+    u = pos.do_move(m)
+    self.assertEqual(pos.sfen(), 'lnsgkgsnl/1r5b1/ppppppppp/9/9/2P6/PP1PPPPPP/1B5R1/LNSGKGSNL w - 2')
+    self.assertEqual(pos.sfen(move_no = False), 'lnsgkgsnl/1r5b1/ppppppppp/9/9/2P6/PP1PPPPPP/1B5R1/LNSGKGSNL w -')
+    pos.undo_move(m, u)
+    self.assertEqual(pos.sfen(), sfen)
+  def test_pack(self):
+    sfens = [shogi.position.SFEN_STARTPOS] + [t[1] for t in USI_GAMES] + [t[0] for t in PERFT_POSITIONS]
+    for sfen in sfens:
+      pos = Position(sfen)
+      data = pos.pack()
+      self.assertEqual(len(data), shogi.position.PACKED_SIZE)
+      self.assertEqual(Position.from_packed(data, pos.move_no).sfen(), sfen)
+    data = shogi.position.pack_many(Position(sfen) for sfen in sfens)
+    self.assertEqual(len(data), shogi.position.PACKED_SIZE * len(sfens))
+    self.assertEqual([p.sfen(move_no = False) for p in shogi.position.unpack_many(data)], [Position(sfen).sfen(move_no = False) for sfen in sfens])
+    self.assertRaises(ValueError, Position.from_packed, bytes(31))
+    self.assertTrue(Position().packable())
+    for sfen in ['4k4/9/4P4/9/9/9/9/9/9 b G 1', 'lnsgkgsnl/9/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w - 1',
+                 'lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNK b L 1']:
+      pos = Position.from_sfen(sfen)
+      self.assertFalse(pos.packable())
+      self.assertRaises(ValueError, pos.pack)
   '''
   def test_openings(self):
     for o in OPENINGS:
@@ -250,6 +365,182 @@ class TestShogiPosition(unittest.TestCase):
     s = Position.packed_to_sfen('9411_8411_7411_0011_0011_0011_0011_0011_0011_0011_0011_0011_0011_0011_0011_0011_0011_0011_9111_0011_0011_0011_8111_0011_0011_0011_8311_0001_0011_0011_7211_0001_0001_0011_6101_0011_7101_1711_9211')
     self.assertEqual(s, 'lnBR5/k1g6/1s7/ppp6/9/9/8b/9/9 b 2GSrg2s3n3l15p 1')
 
+class TestMoveList(unittest.TestCase):
+  def test_move_list(self):
+    g = _parse_81dojo_kifu(NORMAL_GAMES[0][0])
+    l = MoveList(1, g.moves)
+    self.assertEqual(len(l), len(g.moves))
+    self.assertEqual(list(l), g.moves)
+    for m1, m2 in zip(l, g.moves):
+      self.assertEqual(m1.time, m2.time)
+      self.assertEqual(m1.cum_time, m2.cum_time)
+    self.assertEqual(l[-1], g.moves[-1])
+    self.assertEqual(list(l[5:10]), g.moves[5:10])
+    pos = Position()
+    undo = [pos.do_move(x) for x in l.packed]
+    self.assertEqual(pos.sfen(), g.pos.sfen())
+    for x, u in zip(reversed(l.packed), reversed(undo)):
+      pos.undo_move(x, u)
+    self.assertEqual(pos.sfen(), shogi.position.SFEN_STARTPOS)
+    l.drop_times()
+    self.assertIsNone(l[0].time)
+
+class TestGameCursor(unittest.TestCase):
+  def test_game_cursor(self):
+    g = _parse_81dojo_kifu(NORMAL_GAMES[0][0])
+    sfens = [Position().sfen()]
+    pos = Position()
+    for m in g.moves:
+      pos.do_move(m)
+      sfens.append(pos.sfen())
+    c = shogi.game.GameCursor(g, 8)
+    for ply in [0, 5, 17, 16, 3, len(g.moves), 40, 39, 38, 100, 1000, 9]:
+      ply = min(ply, len(g.moves))
+      self.assertEqual(c.seek(ply).sfen(), sfens[ply])
+    while c.backward():
+      self.assertEqual(c.pos.sfen(), sfens[c.ply])
+    self.assertEqual(c.ply, 0)
+    self.assertTrue(g.find_position_by_sfen(sfens[33]))
+    self.assertFalse(g.find_position_by_sfen(sfens[34].replace(' b ', ' w ')))
+    g = shogi.game.Game('lnsgkgsnl/9/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w rb 1')
+    for s in '3c3d 7g7f 4a3b 2g2f 8c8d 2f2e 8d8e'.split():
+      g.do_usi_move(s)
+    c = g.cursor()
+    c2 = shogi.game.GameCursor(g, 2)
+    for ply in [7, 2, 0, 5, 4, 6]:
+      self.assertEqual(c.seek(ply).sfen(), c2.seek(ply).sfen())
+    self.assertEqual(c.seek(7).sfen(), g.pos.sfen())
+    #two pieces handicap can't be packed
+    g = shogi.game.Game('lnsgkgsnl/9/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w - 1', trusted = True)
+    for s in '3c3d 7g7f 4a3b 2g2f 8c8d 2f2e 8d8e'.split():
+      g.do_usi_move(s)
+    g.end_trusted_replay()
+    pos = Position.from_sfen(g.start_pos)
+    sfens = [pos.sfen()]
+    for m in g.moves:
+      pos.do_move(m)
+      sfens.append(pos.sfen())
+    c = shogi.game.GameCursor(g, 2)
+    for ply in [7, 2, 0, 5, 4, 6, 1]:
+      self.assertEqual(c.seek(ply).sfen(), sfens[ply])
+  def test_seek_replays(self):
+    g = _parse_81dojo_kifu(NORMAL_GAMES[0][0])
+    c = shogi.game.GameCursor(g, 8)
+    c.seek(len(g.moves))
+    steps = []
+    forward, backward = c.forward, c.backward
+    def counted_forward():
+      steps.append(1)
+      return forward()
+    def counted_backward():
+      steps.append(-1)
+      return backward()
+    c.forward, c.backward = counted_forward, counted_backward
+    for ply in [33, 20, 70, 64, 63, 62, 1, 0, 15, 9]:
+      steps.clear()
+      c.seek(ply)
+      self.assertEqual(c.ply, ply)
+      self.assertLess(len(steps), 8)
+
+class TestPositionIndex(unittest.TestCase):
+  def test_position_index(self):
+    games = [_parse_81dojo_kifu(t[0]) for t in NORMAL_GAMES[:3]]
+    g = games[0]
+    pos = Position()
+    sfens = [pos.sfen()]
+    for m in g.moves:
+      pos.do_move(m)
+      sfens.append(pos.sfen())
+    index = g.position_index()
+    for ply in [0, 1, 30, len(g.moves)]:
+      self.assertIn(ply, index.find_sfen(sfens[ply]))
+    self.assertTrue(g.find_position_by_sfen(sfens[20]))
+    self.assertFalse(g.find_position_by_sfen(sfens[20].replace(' 21', ' 23')))
+    #two pieces handicap
+    sfen = 'lnsgkgsnl/9/ppppppppp/9/9/9/PPPPPPPPP/9/LNSGKGSNL w - 1'
+    pos = Position.from_sfen(sfen)
+    moves = MoveList(-1)
+    keys = [pos.key()]
+    for usi in '6c6d 7g7f 6d6e 3i4h'.split():
+      m = pos.parse_usi_move(usi)
+      pos.do_move(m)
+      moves.append(m)
+      keys.append(pos.key())
+    handicap = shogi.compact.CompactGame(sfen, moves, None, (), ())
+    inv = shogi.game.InvertedPositionIndex()
+    inv.extend(enumerate(games))
+    inv.add(len(games), handicap)
+    self.assertEqual(inv.games_count(), len(games) + 1)
+    self.assertEqual(inv.games(Position().key()), list(range(len(games))))
+    self.assertEqual(inv.games_by_sfen(pos.sfen()), [len(games)])
+    self.assertEqual(inv.games_by_sfen(sfens[20]), [i for i, t in enumerate(games) if t.find_position_by_sfen(sfens[20])])
+    self.assertEqual(list(shogi.game.position_keys(sfen, moves)), keys)
+    self.assertEqual(list(shogi.game.position_keys(sfen, moves, 2)), keys[:3])
+
+class TestKifuParser(unittest.TestCase):
+  def test_move_parse_fast(self):
+    for fn in sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif'))):
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        data = f.read()
+      g1 = shogi.kifu.KifuParser(fast = False).parse(data)
+      g2 = shogi.kifu.KifuParser().parse(data)
+      self.assertEqual(g1.moves, g2.moves)
+      self.assertEqual(g1.game_result, g2.game_result)
+    for s in ['同　歩(65)', '同歩(65)', '３六桂打', '２二角成(88)', '３四成銀(43)', '５五歩(5)', '']:
+      self.assertEqual(shogi.kifu.move_parse_fast(s, -1, Move(1, 39, 1, 30)), shogi.kifu.move_parse(s, -1, Move(1, 39, 1, 30)))
+
+class TestTrustedGame(unittest.TestCase):
+  def test_trusted(self):
+    for fn in sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif'))):
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        data = f.read()
+      g1 = shogi.kifu.game_parse(data)
+      g2 = shogi.kifu.KifuParser(trusted = True).parse(data)
+      #trusted mode ends with parsing
+      self.assertFalse(g2.trusted)
+      self.assertEqual(g1.moves, g2.moves)
+      self.assertEqual(g1.game_result, g2.game_result)
+      self.assertEqual(g1.pos.sfen(), g2.pos.sfen())
+      self.assertEqual(dict(g1.comments), dict(g2.comments))
+    #moves after trusted replay are validated, repetition counts replayed positions
+    g = shogi.game.Game(trusted = True)
+    for usi in '5i5h 5a5b 5h5i 5b5a 5i5h 5a5b 5h5i 5b5a'.split():
+      g.do_usi_move(usi)
+    g.end_trusted_replay()
+    g.do_move(g.pos.parse_usi_move('5i5h').pack_to_int())
+    self.assertIsNone(g.game_result)
+    for usi in '5a5b 5h5i 5b5a'.split():
+      g.do_usi_move(usi)
+    self.assertEqual(g.game_result, shogi.result.GameResult.REPETITION)
+    g = shogi.game.Game(trusted = True)
+    for usi in '7g7f 3c3d 8h2b+ 3a2b B*3c'.split():
+      g.do_usi_move(usi)
+    #king steps into check of bishop 3c
+    g.do_usi_move('5a4b')
+    g.set_result(shogi.result.GameResult.RESIGNATION)
+    g.end_trusted_replay()
+    self.assertEqual(g.game_result, shogi.result.GameResult.ILLEGAL_MOVE)
+    self.assertEqual(len(g.moves), 5)
+    #replay stops at nifu in the middle of the game
+    with open(os.path.join(MODULE_DIR, '81dojo', '0011.kif'), 'r', encoding = 'UTF8') as f:
+      data = f.read().replace('*反則手にて終局', '106   １二玉(21)   (0:1/0:10:1)')
+    g1 = shogi.kifu.game_parse(data)
+    g2 = shogi.kifu.KifuParser(trusted = True).parse(data)
+    self.assertEqual(len(g1.moves), 104)
+    self.assertEqual(g1.game_result, shogi.result.GameResult.ILLEGAL_MOVE)
+    self.assertEqual(g1.moves, g2.moves)
+    self.assertEqual(g1.game_result, g2.game_result)
+    self.assertEqual(g1.pos.sfen(), g2.pos.sfen())
+    pos = Position()
+    for usi in ['7g7f', '3c3d', '8h2b+']:
+      pos.do_move_unchecked(pos.parse_usi_move(usi).pack_to_int())
+    self.assertEqual(pos.sfen(), 'lnsgkgsnl/1r5+B1/pppppp1pp/6p2/9/2P6/PP1PPPPPP/7R1/LNSGKGSNL w B 4')
+    shogi.game.VERIFY_TRUSTED_GAMES = True
+    try:
+      self.assertFalse(shogi.game.Game(trusted = True).trusted)
+    finally:
+      shogi.game.VERIFY_TRUSTED_GAMES = False
+
 class TestKifu(unittest.TestCase):
   def test_time_control(self):
     s = "15分+60秒"
@@ -262,6 +553,435 @@ class TestKifu(unittest.TestCase):
       pos = Position(sfen)
       self.assertEqual(pos.kifu_str(), kifu)
 
+class TestCompactGame(unittest.TestCase):
+  def test_round_trip(self):
+    store = shogi.compact.GameStore()
+    kifs = []
+    for fn in sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif')))[:20]:
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        g = shogi.kifu.game_parse(f.read())
+      c = shogi.compact.CompactGame.from_game(g)
+      with self.assertRaises(AttributeError):
+        c.game_result = None
+      t = c.to_game()
+      for attr in ['start_pos', 'tags', 'game_result', 'moves']:
+        self.assertEqual(getattr(g, attr), getattr(t, attr))
+      self.assertEqual([(m.time, m.cum_time) for m in g.moves], [(m.time, m.cum_time) for m in t.moves])
+      self.assertEqual(g.pos.sfen(), t.pos.sfen())
+      f1, f2 = io.StringIO(), io.StringIO()
+      shogi.kifu.game_write_to_file(g, f1)
+      shogi.kifu.game_write_to_file(t, f2)
+      self.assertEqual(f1.getvalue(), f2.getvalue())
+      kifs.append(f1.getvalue())
+      self.assertEqual(store.append(g), len(store) - 1)
+      self.assertEqual(store[-1], c)
+    self.assertEqual(len(store), len(kifs))
+    for c, s in zip(store, kifs):
+      f = io.StringIO()
+      shogi.kifu.game_write_to_file(c.to_game(), f)
+      self.assertEqual(f.getvalue(), s)
+
+class TestGameCollection(unittest.TestCase):
+  def test_cache(self):
+    c = shogi.game.GameCollection(os.path.join(MODULE_DIR, '81dojo'), '.kif', shogi.kifu.game_parse, max_games = 2, prefetch = 1)
+    try:
+      self.assertTrue(c.filename(10).endswith('0010.kif'))
+      g = c.load(10)
+      self.assertIs(c.load(10), g)
+      #0011 is prefetched
+      c.load(11)
+      c.load(36)
+      s = c.stats()
+      self.assertEqual(s['hits'], 1)
+      self.assertEqual(s['misses'] + s['prefetch_hits'], 3)
+      self.assertLessEqual(s['games'], 2)
+      self.assertGreater(s['evictions'], 0)
+      ids = [124, 10, 102, 53]
+      games = c.load_many(ids)
+      for game_id, g in zip(ids, games):
+        with open(c.filename(game_id), 'r', encoding = 'UTF8') as f:
+          self.assertEqual(g.pos.sfen(), shogi.kifu.game_parse(f.read()).pos.sfen())
+      loaded = list(shogi.bulk.load_files([c.filename(game_id) for game_id in ids], shogi.kifu.game_parse, 2))
+      self.assertEqual([cg.to_game().pos.sfen() for cg, _ in loaded], [g.pos.sfen() for g in games])
+      for game_id, (_, size) in zip(ids, loaded):
+        with open(c.filename(game_id), 'r', encoding = 'UTF8') as f:
+          self.assertEqual(size, len(f.read()))
+    finally:
+      c.close()
+    c = shogi.game.GameCollection(os.path.join(MODULE_DIR, '81dojo'), '.kif', shogi.kifu.game_parse, max_bytes = 1)
+    c.load(10)
+    c.load(11)
+    self.assertEqual(c.stats()['games'], 1)
+
+class TestGameTree(unittest.TestCase):
+  def test_tree(self):
+    games = []
+    for fn in sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif'))):
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        moves = MoveList(1, shogi.kifu.game_parse(f.read()).moves)
+      moves.drop_times()
+      games.append(moves)
+    tree = shogi.tree.GameTree()
+    t1, t2 = shogi.tree.GameTree(), shogi.tree.GameTree()
+    for i, moves in enumerate(games + games[:1]):
+      g = shogi.game.Game()
+      for m in moves:
+        g.do_move(m)
+      tree.insert(g)
+      (t1 if i % 2 == 0 else t2).insert(g)
+    self.assertEqual(len(tree), len(games) + 1)
+    self.assertEqual(tree.duplicates(), [[0, len(games)]])
+    self.assertLess(tree.node_count(), sum(len(moves) for moves in games) + 1)
+    root = tree.find([])
+    self.assertEqual(tree.count(root), len(tree))
+    first = tree.children(root)
+    self.assertEqual(sum(tree.count(k) for _, k in first), len(tree))
+    self.assertEqual(tree.count(tree.find(games[3][:2])), sum(1 for moves in games + games[:1] if moves[:2] == games[3][:2]))
+    self.assertIsNone(tree.find([0]))
+    for c, moves in zip(tree, games):
+      self.assertEqual(c.moves, moves)
+    t = shogi.tree.GameTree.read_bytes(tree.to_bytes())
+    self.assertEqual(list(t), list(tree))
+    self.assertEqual(t.children(t.find([])), first)
+    t1.merge(t2)
+    self.assertEqual(t1.node_count(), tree.node_count())
+    self.assertEqual(t1.count(t1.find(games[3][:2])), tree.count(tree.find(games[3][:2])))
+    self.assertEqual(sorted(c.moves.packed.tolist() for c in t1), sorted(c.moves.packed.tolist() for c in tree))
+
+CSA_GAME = """'Shogi Quest
+N+sente_player
+N-gote_player
+P1-KY-KE-GI-KI-OU-KI-GI-KE-KY
+P2 * -HI *  *  *  *  * -KA *
+P3-FU-FU-FU-FU-FU-FU-FU-FU-FU
+P4 *  *  *  *  *  *  *  *  *
+P5 *  *  *  *  *  *  *  *  *
+P6 *  *  *  *  *  *  *  *  *
+P7+FU+FU+FU+FU+FU+FU+FU+FU+FU
+P8 * +KA *  *  *  *  * +HI *
+P9+KY+KE+GI+KI+OU+KI+GI+KE+KY
++
++7776FU
+T3
+-3334FU
+T5
++2726FU
+T2
+%TORYO
+"""
+
+PSN_GAME = """[Black "sente_player"]
+[White "gote_player"]
+1.P7g-7f
+2.P3c-3d
+3.P2g-2f
+--Black Won--
+"""
+
+class TestReader(unittest.TestCase):
+  def _kif_files(self):
+    return sorted(glob.glob(os.path.join(MODULE_DIR, 'wars', '*.kif')))[:5] + sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif')))
+  def test_concatenated(self):
+    texts = []
+    for fn in self._kif_files():
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        texts.append(f.read())
+    data = '\n'.join(texts).encode('UTF8')
+    raws = list(shogi.reader.iter_raw_games(io.BytesIO(data)))
+    self.assertEqual([r.text.strip() for r in raws], [t.strip() for t in texts])
+    for r in raws:
+      self.assertEqual(data[r.offset:r.offset + r.size].decode('UTF8').strip(), r.text.strip())
+    games = list(shogi.reader.iter_games(io.BytesIO(data)))
+    self.assertEqual([g.pos.sfen() for g in games], [shogi.kifu.game_parse(t).pos.sfen() for t in texts])
+    #leading comments belong to the next game
+    texts = [f'# ---- game {i}\n' + t for i, t in enumerate(texts)]
+    data = '\n'.join(texts).encode('UTF8')
+    raws = list(shogi.reader.iter_raw_games(io.BytesIO(data)))
+    self.assertEqual([r.text.strip() for r in raws], [t.strip() for t in texts])
+    for r in raws:
+      self.assertEqual(data[r.offset:r.offset + r.size].decode('UTF8').strip(), r.text.strip())
+  def test_csa_psn(self):
+    data = (CSA_GAME + '/\n' + CSA_GAME + CSA_GAME).encode('UTF8')
+    games = list(shogi.reader.iter_games(io.BytesIO(data), 'csa'))
+    self.assertEqual(len(games), 3)
+    for g in games:
+      self.assertEqual(g.usi_moves(), '7g7f 3c3d 2g2f')
+      self.assertEqual(g.game_result, shogi.result.GameResult.RESIGNATION)
+    games = list(shogi.reader.iter_games(io.BytesIO((PSN_GAME + '\n' + PSN_GAME).encode('UTF8'))))
+    self.assertEqual([g.usi_moves() for g in games], ['7g7f 3c3d 2g2f'] * 2)
+    self.assertEqual(games[1].get_tag('gote'), 'gote_player')
+  def test_scan_headers(self):
+    for fn in self._kif_files():
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        g = shogi.kifu.game_parse(f.read())
+      with open(fn, 'rb') as f:
+        tags, n = shogi.kifu.scan_headers(f, True)
+      self.assertEqual(tags, g.tags)
+      #record of illegal move isn't added to the game
+      self.assertEqual(n, len(g.moves) + (1 if g.game_result == shogi.result.GameResult.ILLEGAL_MOVE else 0))
+      with open(fn, 'r', encoding = 'UTF8') as f:
+        self.assertEqual(shogi.kifu.scan_headers(f), (g.tags, None))
+    g = shogi.csa.game_parse(CSA_GAME + '\n')
+    self.assertEqual(shogi.csa.scan_headers(CSA_GAME, True), (g.tags, 3))
+    self.assertEqual(shogi.csa.scan_headers('V2.2\nN+a(1500)\nN-b\n$EVENT:test\n$START_TIME:2024/01/02 10:00:00\nPI\n+\n+7776FU,T1\n-3334FU\n%CHUDAN\n'),
+                     ({'csa_version': '2.2', 'sente': 'a', 'sente_rating': 1500, 'gote': 'b', 'event': 'test',
+                       'start_date': datetime.datetime(2024, 1, 2, 10, 0)}, None))
+    g = shogi.psn.game_parse(PSN_GAME)
+    self.assertEqual(shogi.psn.scan_headers(io.BytesIO(PSN_GAME.encode('UTF8')), True), (g.tags, 3))
+  def test_archives(self):
+    files = self._kif_files()
+    with tempfile.TemporaryDirectory() as d:
+      zip_path = os.path.join(d, 'games.zip')
+      with zipfile.ZipFile(zip_path, 'w') as z:
+        for fn in files:
+          z.write(fn, os.path.basename(fn))
+        z.writestr('games.csa', CSA_GAME * 2)
+      tar_path = os.path.join(d, 'games.tar.gz')
+      with tarfile.open(tar_path, 'w:gz') as t:
+        for fn in files:
+          t.add(fn, os.path.basename(fn))
+      for path, n in [(zip_path, len(files) + 2), (tar_path, len(files))]:
+        games = list(shogi.reader.iter_games(path))
+        self.assertEqual(len(games), n)
+        with open(files[0], 'r', encoding = 'UTF8') as f:
+          self.assertEqual(games[0].moves, shogi.kifu.game_parse(f.read()).moves)
+      self.assertEqual(len(list(shogi.reader.iter_raw_games(files[0]))), 1)
+
+CSA_V22_GAMES = """V2.2
+N+engine1
+N-engine2
+$EVENT:wdoor+floodgate-300-10F
+$START_TIME:2024/05/01 12:00:00
+$TIME_LIMIT:00:05+10
+PI
++
++2726FU,T3
+'** 52 -3334FU
+-8384FU,T2
++2625FU
+T1
+-4132KI,T4
+%SENNICHITE
+/
+V2.2
+N+engine3
+N-engine4
+P1-KY-KE-GI-KI-OU-KI-GI-KE-KY
+P2 * -HI *  *  *  *  *  *  *
+P3-FU-FU-FU-FU-FU-FU-FU-FU-FU
+P4 *  *  *  *  *  *  *  *  *
+P5 *  *  *  *  *  *  *  *  *
+P6 *  *  *  *  *  *  *  *  *
+P7+FU+FU+FU+FU+FU+FU+FU+FU+FU
+P8 * +KA *  *  *  *  * +HI *
+P9+KY+KE+GI+KI+OU+KI+GI+KE+KY
+P-00KA
+-
+-0055KA
++7776FU
+%CHUDAN
+V2.2
+N+engine5
+N-engine6
+PI
++
++7776FU
+%HIKIWAKE
+"""
+
+class TestCsa(unittest.TestCase):
+  def test_v22(self):
+    games = list(shogi.csa.iter_games(io.BytesIO(CSA_V22_GAMES.encode('UTF8'))))
+    self.assertEqual(len(games), 3)
+    g = games[0]
+    self.assertEqual(g.usi_moves(), '2g2f 8c8d 2f2e 4a3b')
+    self.assertEqual(g.game_result, shogi.result.GameResult.REPETITION)
+    self.assertEqual(g.get_tag('event'), 'wdoor+floodgate-300-10F')
+    self.assertEqual(g.get_tag('start_date'), datetime.datetime(2024, 5, 1, 12, 0))
+    self.assertEqual(g.get_tag('time_control'), shogi.kifu.TimeControl(5, 10))
+    self.assertEqual([m.time for m in g.moves], [datetime.timedelta(seconds = t) for t in (3, 2, 1, 4)])
+    self.assertEqual(g.comments[2], ['** 52 -3334FU'])
+    g = games[1]
+    self.assertEqual(g.start_pos, 'lnsgkgsnl/1r7/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w b 1')
+    self.assertEqual(g.usi_moves(), 'B*5e 7g7f')
+    self.assertEqual(g.game_result, shogi.result.GameResult.ABORTED)
+    self.assertEqual(games[2].get_tag('csa_result'), '%HIKIWAKE')
+    self.assertIsNone(games[2].game_result)
+    g = shogi.csa.game_parse('PI\n+\n+5958OU\n-5152OU\n+5859OU\n-5251OU\n%KACHI\n')
+    self.assertEqual(g.game_result, shogi.result.GameResult.ENTERING_KING)
+    self.assertEqual(g.sente_points(), 1)
+    #time of the move which repeated position, statements after detected result are ignored
+    moves = ['+5958OU', '-5152OU', '+5859OU', '-5251OU'] * 3
+    s = 'PI\n+\n' + ''.join(f'{m}\nT{5 if i == 11 else 1}\n' for i, m in enumerate(moves)) + '+5958OU\nT9\n'
+    g = shogi.csa.game_parse(s)
+    self.assertEqual(len(g.moves), 12)
+    self.assertEqual(g.game_result, shogi.result.GameResult.REPETITION)
+    self.assertEqual(g.moves[-1].time, datetime.timedelta(seconds = 5))
+    #handicap and tsume boards lack pieces
+    g = shogi.csa.game_parse('PI82HI22KA\n-\n-3334FU\n+7776FU\n%TORYO\n')
+    self.assertEqual(g.start_pos, 'lnsgkgsnl/9/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL w - 1')
+    self.assertEqual(g.sente_points(), 1)
+    g = shogi.csa.game_parse('P1 *  *  *  * -OU *  *  *  * \nP3 *  *  *  * +FU *  *  *  * \nP+00KI\n+\n+0052KI\n%TSUMI\n')
+    self.assertEqual(g.start_pos, '4k4/9/4P4/9/9/9/9/9/9 b G 1')
+    self.assertEqual(g.usi_moves(), 'G*5b')
+    with self.assertRaises(ValueError):
+      shogi.csa.game_parse('P1 *  *  *  * -OU *  *  *  * \nP+00KI00KI00KI00KI00KI\n+\n+0052KI\n')
+    #replay stops at move which leaves king in check
+    for trusted in (False, True):
+      g = shogi.csa.game_parse('PI\n+\n+7776FU\n-3334FU\n+8822UM\n-3122GI\n+0033KA\n-9394FU\n+9796FU\n', trusted)
+      self.assertEqual(g.usi_moves(), '7g7f 3c3d 8h2b+ 3a2b B*3c')
+      self.assertEqual(g.game_result, shogi.result.GameResult.ILLEGAL_MOVE)
+    g = shogi.csa.game_parse('PI\n+\n+7776FU\n%-ILLEGAL_ACTION\n')
+    self.assertEqual(g.sente_points(), 1)
+    with self.assertRaises(ValueError):
+      list(shogi.csa.iter_games('PI\n+\n+7776KI\n/\nPI\n+\n+7776FU\n'))
+    games = list(shogi.csa.iter_games('PI\n+\n+7776KI\n/\nPI\n+\n+7776FU\n', skip_errors = True))
+    self.assertEqual([g.usi_moves() for g in games], ['7g7f'])
+    games = list(shogi.reader.iter_games(io.BytesIO(CSA_V22_GAMES.encode('UTF8')), 'csa'))
+    self.assertEqual([len(g.moves) for g in games], [4, 2, 1])
+
+class TestBulk(unittest.TestCase):
+  def test_parse_files(self):
+    paths = sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif')))
+    paths.insert(3, os.path.join(MODULE_DIR, '81dojo', 'missing.kif'))
+    expected = [shogi.bulk.parse_file(path) for path in paths]
+    self.assertFalse(expected[3].ok())
+    self.assertEqual(expected[3].games, [])
+    self.assertTrue(all(r.ok() and len(r.games) == 1 for i, r in enumerate(expected) if i != 3))
+    r = list(shogi.bulk.parse_files(paths, workers = 2, chunksize = 2))
+    self.assertEqual([t.path for t in r], paths)
+    self.assertEqual([t.games for t in r], [t.games for t in expected])
+    r = list(shogi.bulk.parse_files(paths, format = 'kif', workers = 2, chunksize = 1, ordered = False, max_pending = 2))
+    self.assertEqual(sorted(t.path for t in r), sorted(paths))
+    self.assertEqual(len(list(shogi.bulk.parse_games(paths[:3], workers = 0))), 3)
+  def test_broken_archive(self):
+    with open(os.path.join(MODULE_DIR, '81dojo', '0102.kif'), 'r', encoding = 'UTF8') as f:
+      kif = f.read()
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, 'w', zipfile.ZIP_DEFLATED) as z:
+      z.writestr('0102.kif', kif)
+    data = bytearray(b.getvalue())
+    #corrupt compressed data of the member
+    data[60:80] = b'\xff' * 20
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'broken.zip')
+      with open(path, 'wb') as f:
+        f.write(data)
+      r = list(shogi.bulk.parse_files([path], workers = 0))
+    self.assertEqual(len(r), 1)
+    self.assertFalse(r[0].ok())
+    self.assertIsNone(r[0].errors[0][0])
+
+class TestNdjson(unittest.TestCase):
+  def _games(self):
+    paths = sorted(glob.glob(os.path.join(MODULE_DIR, '81dojo', '*.kif')))
+    return [shogi.kifu.game_parse(open(path, 'r', encoding = 'UTF8').read()) for path in paths]
+  def test_decode_usi_moves(self):
+    for g in self._games():
+      usi = [m.usi_str() for m in g.moves]
+      self.assertEqual(list(shogi.ndjson.decode_usi_moves(usi)), [m.pack_to_int() for m in g.moves])
+    sfen = '4k4/9/9/9/9/9/9/9/4K4 b P 1'
+    m = Position.from_sfen(sfen).parse_usi_move('P*5e')
+    self.assertEqual(list(shogi.ndjson.decode_usi_moves(['P*5e'], sfen)), [m.pack_to_int()])
+    for usi in [['7g7f', '3c3d', '7f7f'], ['7g7f', '3c3d', '2h2h+'], ['5i4h+'], ['P*7g'], ['7g7x'], ['X*5e'], ['7g7f', 'P*5e']]:
+      with self.assertRaises(ValueError):
+        shogi.ndjson.decode_usi_moves(usi)
+  def test_records(self):
+    line = ('{"id": "abc", "players": {"sente": {"user": {"name": "A"}, "rating": 1500}, "gote": {"user": {"name": "B"}}}, '
+            '"moves": "7g7f 3c3d 8h2b+ 3a2b", "status": "resign", "winner": "gote", "createdAt": 1700000000000, '
+            '"clock": {"initial": 600, "increment": 0, "byoyomi": 10}}')
+    g = shogi.ndjson.parse_game(line)
+    self.assertEqual(len(g.moves), 4)
+    self.assertEqual(g.game_result, shogi.result.GameResult.RESIGNATION)
+    self.assertEqual(g.sente_points(), -1)
+    self.assertEqual(g.player_with_rating(1), 'A(1500)')
+    self.assertEqual(g.get_tag('gote'), 'B')
+    self.assertEqual(g.get_tag('start_date'), datetime.datetime(2023, 11, 14, 22, 13, 20))
+    self.assertEqual(g.get_tag('time_control'), shogi.kifu.TimeControl(10, 10))
+    self.assertEqual(shogi.ndjson.parse_compact_game(line), shogi.ndjson.parse_compact_game(line, validate = False))
+    #resignation contradicting winner
+    g = shogi.ndjson.parse_game(line.replace('"winner": "gote"', '"winner": "sente"'))
+    self.assertIsNone(g.game_result)
+    self.assertEqual(g.get_tag('winner'), 'sente')
+    g = shogi.ndjson.parse_game('position startpos moves 7g7f 3c3d resign')
+    self.assertEqual(g.usi_position_command(), 'position startpos moves 7g7f 3c3d')
+    self.assertEqual(g.game_result, shogi.result.GameResult.RESIGNATION)
+    sfen = '4k4/9/4G4/9/9/9/9/9/4K4 b G2r2b2g4s4n4l18p 1'
+    g = shogi.ndjson.parse_game(f'position sfen {sfen} moves G*5b')
+    self.assertEqual(g.start_pos, sfen)
+    self.assertEqual(g.game_result, shogi.result.GameResult.CHECKMATE)
+    g = shogi.ndjson.parse_game('7g7f 3c3d 6g6f 2b6f 6i7h 6f7g 5i6h')
+    self.assertEqual(len(g.moves), 6)
+    self.assertEqual(g.game_result, shogi.result.GameResult.ILLEGAL_MOVE)
+    #results found on the board override status of the record
+    g = shogi.ndjson.parse_game('{"moves": "' + '5i5h 5a5b 5h5i 5b5a ' * 4 + '", "status": "resign", "winner": "gote"}')
+    self.assertEqual(len(g.moves), 12)
+    self.assertEqual(g.game_result, shogi.result.GameResult.REPETITION)
+    g = shogi.ndjson.parse_game(f'{{"initialSfen": "{sfen}", "moves": "G*5b", "status": "outoftime", "winner": "gote"}}')
+    self.assertEqual(g.game_result, shogi.result.GameResult.CHECKMATE)
+    with self.assertRaises(ValueError):
+      shogi.ndjson.parse_game('{"moves": "7g7f 3c3d", "status": "mate", "winner": "gote"}')
+    g = shogi.ndjson.parse_game('7g7f P*5e')
+    self.assertEqual(len(g.moves), 1)
+    self.assertEqual(g.game_result, shogi.result.GameResult.ILLEGAL_MOVE)
+    with self.assertRaises(ValueError):
+      shogi.ndjson.parse_game('7g7f P*5e', validate = False)
+    self.assertIsNone(shogi.ndjson.parse_game('  '))
+    for line in ['{"moves": "7g7f"', '[1, 2]', 'position moves 7g7f', 'position startpos moves 7g7x']:
+      with self.assertRaises(ValueError):
+        shogi.ndjson.parse_game(line)
+  def test_parallel(self):
+    lines = ['position startpos moves ' + ' '.join(m.usi_str() for m in g.moves) for g in self._games()]
+    lines.insert(2, 'position startpos moves 7g7f 7g7f')
+    text = '\n'.join(lines) + '\n'
+    with self.assertRaises(ValueError):
+      list(shogi.ndjson.iter_games(text))
+    expected = list(shogi.ndjson.iter_games(text, compact = True, skip_errors = True))
+    self.assertEqual(len(expected), len(lines) - 1)
+    f = io.BytesIO(text.encode('UTF8'))
+    self.assertEqual(list(shogi.ndjson.parse_parallel(f, skip_errors = True, workers = 2, chunksize = 2)), expected)
+    r = list(shogi.ndjson.parse_parallel(text, validate = False, skip_errors = True, workers = 0))
+    self.assertEqual([g.moves.packed for g in r], [g.moves.packed for g in expected])
+  def test_kifu_db(self):
+    import kdb
+    lines = ['position startpos moves ' + ' '.join(m.usi_str() for m in g.moves) for g in self._games()[:3]]
+    with tempfile.TemporaryDirectory() as d:
+      filename = os.path.join(d, 'games.ndjson')
+      with open(filename, 'w', encoding = 'UTF8') as f:
+        f.write('\n'.join(lines))
+      with kdb.KifuDB('test', d) as db:
+        self.assertEqual(db.insert_ndjson_file(filename, workers = 0), 3)
+        self.assertEqual(db.insert_ndjson_file(filename, workers = 0), 0)
+
+class TestAdjudicator(unittest.TestCase):
+  def _play(self, sfen, usi_moves: str, disable_game_result_auto_detection = False):
+    g = shogi.game.Game(sfen, disable_game_result_auto_detection)
+    for s in usi_moves.split():
+      if g.has_result():
+        break
+      g.do_usi_move(s)
+    return g
+  def test_repetition(self):
+    g = self._play(None, '5i5h 5a5b 5h5i 5b5a ' * 4)
+    self.assertEqual(g.game_result, shogi.result.GameResult.REPETITION)
+    self.assertEqual(len(g.moves), 12)
+    self.assertIsNone(self._play(None, '5i5h 5a5b 5h5i 5b5a ' * 4, True).game_result)
+  def test_perpetual_check(self):
+    g = self._play('8k/9/6R2/9/9/9/9/9/K8 b B2G2S2N2L9Prb2g2s2n2l9p 1', '3c3a 1a1b 3a3b 1b1a ' + '3b3a 1a1b 3a3b 1b1a ' * 3)
+    self.assertEqual(g.game_result, shogi.result.GameResult.ILLEGAL_PRECEDING_MOVE)
+    self.assertEqual(len(g.moves), 13)
+    self.assertEqual(g.sente_points(), -1)
+  def test_impasse(self):
+    g = shogi.game.Game('LNSG1GSNL/1R2K2B1/9/9/9/9/9/9/4k4 b R5Pb2g2s2n2l13p 1')
+    self.assertEqual(g.game_result, shogi.result.GameResult.ENTERING_KING)
+    self.assertEqual(g.sente_points(), 1)
+    g = shogi.game.Game('LNSG1GSNL/1R2K2B1/9/9/9/9/9/9/4k4 b R4Pb2g2s2n2l14p 1')
+    self.assertIsNone(g.game_result)
+    #capture in the zone adds the missing point
+    g = self._play('LNSG1GSNL/1R2K2B1/1p7/9/9/9/9/9/4k4 b R4Pb2g2s2n2l13p 1', '8b8c 5i5h 5b4b')
+    self.assertEqual(g.game_result, shogi.result.GameResult.ENTERING_KING)
+    self.assertEqual(len(g.moves), 2)
+
 class TestEvaluation(unittest.TestCase):
   def test_winning_percentage(self):
     with gzip.open(os.path.join(MODULE_DIR, 'eval.csv.gz'), 'rt', encoding = 'UTF8') as f:
@@ -300,6 +1020,208 @@ class TestCheckmates(unittest.TestCase):
         self.assertTrue(pos.is_check())
         self.assertFalse(pos.has_legal_move())
 
+class TestTsume(unittest.TestCase):
+  def test_mate(self):
+    #attacker without king
+    r = shogi.tsume.solve('4k4/9/4P4/9/9/9/9/9/9 b G2r2b3g4s4n4l17p 1')
+    self.assertTrue(r.mate)
+    self.assertEqual([m.usi_str() for m in r.moves], ['G*5b'])
+    self.assertFalse(shogi.tsume.solve('4k4/9/4P4/9/9/9/9/9/9 b S2r2b4g3s4n4l17p 1').mate)
+    self.assertFalse(shogi.tsume.solve(shogi.position.SFEN_STARTPOS).mate)
+  def test_puzzle(self):
+    with open(os.path.join(MODULE_DIR, 'puzzles', '0001.kif'), 'r', encoding = 'UTF8') as f:
+      g = shogi.kifu.game_parse(f.read())
+    pos = Position(g.start_pos)
+    for m in g.moves[:2]:
+      pos.do_move(m)
+    self.assertIsNone(shogi.tsume.solve(pos.sfen(), max_nodes = 10).mate)
+    r = shogi.tsume.Solver(max_nodes = 100000).solve(pos)
+    self.assertTrue(r.mate)
+    self.assertEqual(len(r.moves) % 2, 1)
+    for m in r.moves:
+      pos.do_move(m)
+    self.assertTrue(pos.is_check())
+    self.assertFalse(pos.has_legal_move())
+
+  def test_check_moves(self):
+    def checks(pos):
+      r = set()
+      for m in pos.legal_moves():
+        u = pos.try_move(m)
+        if pos.is_check():
+          r.add(m.usi_str())
+        pos.undo_move(m, u)
+      return r
+    positions = [Position.from_sfen(sfen) for sfen, _ in PERFT_POSITIONS]
+    #discovered checks by silver and king, pawn drop mate isn't a check move
+    positions.append(Position.from_sfen('8k/9/9/9/8S/9/9/9/8L b - 1'))
+    positions.append(Position.from_sfen('8k/9/9/9/9/9/9/8K/8L b - 1'))
+    positions.append(Position.from_sfen('7nk/7s1/8G/9/9/9/9/9/9 b P 1'))
+    with open(os.path.join(MODULE_DIR, '81dojo', '0102.kif'), 'r', encoding = 'UTF8') as f:
+      g = shogi.kifu.game_parse(f.read())
+    pos = Position()
+    for m in g.moves:
+      pos.do_move(m)
+      positions.append(Position.from_sfen(pos.sfen()))
+    for pos in positions:
+      l = [m.usi_str() for m in pos.check_moves()]
+      self.assertEqual(len(l), len(set(l)))
+      self.assertEqual(set(l), checks(pos), pos.sfen())
+    self.assertTrue({'1e2d', '1e2f'} <= set(m.usi_str() for m in positions[len(PERFT_POSITIONS)].check_moves()))
+    self.assertEqual(sorted(m.usi_str() for m in positions[len(PERFT_POSITIONS) + 1].check_moves()), ['1h2g', '1h2h', '1h2i'])
+    self.assertNotIn('P*1b', set(m.usi_str() for m in positions[len(PERFT_POSITIONS) + 2].check_moves()))
+  def test_repetition(self):
+    solver = shogi.tsume.Solver()
+    path_results = {}
+    store = solver._store
+    def recorded_store(key, phi, delta, work, deps):
+      if deps:
+        path_results[key] = deps
+      store(key, phi, delta, work, deps)
+    solver._store = recorded_store
+    r = solver.solve(Position.from_sfen('7nk/9/9/9/9/9/9/9/R8 b - 1'))
+    self.assertFalse(r.mate)
+    #disproofs by repetition on the search path aren't reused from transposition table
+    self.assertTrue(path_results)
+    #path results are dropped when positions they depend on leave the search path
+    self.assertEqual(solver._path_results, {})
+    self.assertEqual(solver._dependents, {})
+    solver.tt.store(1, 5, 7, 9)
+    solver.tt.clear()
+    self.assertEqual(solver.tt.lookup(1), (1, 1, 0))
+    self.assertFalse(any(solver.tt._phi) or any(solver.tt._delta))
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestFeatures(unittest.TestCase):
+  def test_game_to_arrays(self):
+    from shogi import features
+    with open(os.path.join(MODULE_DIR, '81dojo', '0102.kif'), 'r', encoding = 'UTF8') as f:
+      g = shogi.kifu.game_parse(f.read())
+    n = features.game_rows(g)
+    out = features.allocate(n + 3)
+    features.game_to_arrays(g, out, 3)
+    boards, hands, side = (a[3:] for a in out)
+    pos = Position()
+    positions = [Position()]
+    for m in g.moves:
+      pos.do_move(m)
+      positions.append(Position.from_sfen(pos.sfen()))
+    b, h, s = features.positions_to_arrays(positions)
+    self.assertTrue(np.array_equal(b, boards))
+    self.assertTrue(np.array_equal(h, hands))
+    self.assertTrue(np.array_equal(s, side))
+    self.assertEqual([p.sfen(move_no = False) for p in features.arrays_to_positions(b, h, s)], [p.sfen(move_no = False) for p in positions])
+    planes = features.one_hot(b)
+    self.assertEqual(planes.shape, (n, 28, 81))
+    self.assertTrue(np.array_equal(planes.sum(axis = 1), b != 0))
+    counts = features.attack_counts(b[::10])
+    for c, p in zip(counts, positions[::10]):
+      for i, side in enumerate((1, -1)):
+        self.assertEqual(c[i].tolist(), [bin(p.attackers_to(k, side)).count('1') for k in range(81)])
+
+class TestHalfKP(unittest.TestCase):
+  def test_incremental_features(self):
+    from shogi.halfkp import FeatureWriter, PositionWithHalfKP, DIMENSIONS
+    with open(os.path.join(MODULE_DIR, '81dojo', '0102.kif'), 'r', encoding = 'UTF8') as f:
+      g = shogi.kifu.game_parse(f.read())
+    pos = PositionWithHalfKP()
+    history = []
+    for m in g.moves:
+      before = [set(pos.features(s)) for s in (1, -1)]
+      u = pos.do_move(m)
+      history.append((m, u, before))
+      fresh = PositionWithHalfKP.from_sfen(pos.sfen())
+      for i, s in enumerate((1, -1)):
+        f = pos.features(s)
+        self.assertEqual(f, fresh.features(s))
+        self.assertTrue(all(0 <= x < DIMENSIONS for x in f))
+        if not pos.delta.refreshed[i]:
+          self.assertEqual((before[i] - set(pos.delta.removed[i])) | set(pos.delta.added[i]), set(f))
+    for m, u, before in reversed(history):
+      pos.undo_move(m, u)
+      self.assertEqual([set(pos.features(s)) for s in (1, -1)], before)
+    w = FeatureWriter()
+    w.append_game(g)
+    self.assertEqual(len(w), len(g.moves) + 1)
+    self.assertEqual(w.indices[w.offsets[0]:w.offsets[1]].tolist(), PositionWithHalfKP().features(1))
+    #38 pieces without kings from both perspectives
+    self.assertEqual(w.offsets[2], 76)
+  def test_rejected_move(self):
+    from shogi.halfkp import PositionWithHalfKP
+    #bishop on 3g is pinned by gote bishop on 1e
+    sfen = '4k4/9/9/9/8b/9/6B2/9/4K4 b - 1'
+    start = PositionWithHalfKP.from_sfen(sfen)
+    start_features = [start.features(s) for s in (1, -1)]
+    for moves in ([], ['5i4i', '5a4a', '4i5i', '4a5a']):
+      pos = PositionWithHalfKP.from_sfen(sfen)
+      history = []
+      for usi in moves:
+        m = pos.parse_usi_move(usi)
+        history.append((m, pos.do_move(m)))
+      before = [pos.features(s) for s in (1, -1)]
+      delta = pos.delta
+      with self.assertRaises(shogi.position.UnresolvedCheck):
+        pos.do_move(pos.parse_usi_move('3g4f'))
+      self.assertEqual([pos.features(s) for s in (1, -1)], before)
+      self.assertIs(pos.delta, delta)
+      c = PositionWithHalfKP.clone(pos)
+      self.assertEqual([c.features(s) for s in (1, -1)], before)
+      for m, u in reversed(history):
+        c.undo_move(m, u)
+      self.assertEqual([c.features(s) for s in (1, -1)], start_features)
+      self.assertEqual([pos.features(s) for s in (1, -1)], before)
+
+#(sfen, [perft(1), perft(2), ...])
+PERFT_POSITIONS = [
+  (shogi.position.SFEN_STARTPOS, [30, 900, 25470]),
+  ('l6nl/5+P1gk/2np1S3/p1p4Pp/3P2Sp1/1PPb2P1P/P5GS1/R8/LN4bKL w RGgsn5p 1', [207, 28684]),
+  ('R8/2K1S1SSk/4B4/9/9/9/9/9/1L1L1L3 b RBGSNLP3g3n17p 1', [593]),
+]
+
+class TestPerft(unittest.TestCase):
+  def test_perft(self):
+    for sfen, counts in PERFT_POSITIONS:
+      pos = Position(sfen)
+      for depth, n in enumerate(counts, 1):
+        self.assertEqual(pos.perft(depth), n, msg = f'perft({depth}) of {sfen}')
+      self.assertEqual(pos.sfen(), sfen)
+  def test_divide(self):
+    pos = Position()
+    d = pos.divide(2)
+    self.assertEqual(len(d), 30)
+    self.assertTrue(all(n == 30 for n in d.values()))
+  def test_checkmates(self):
+    with open(os.path.join(MODULE_DIR, 'sfen', 'checkmates.sfen'), 'r', encoding = 'UTF8') as f:
+      for s in f:
+        self.assertEqual(Position(s.rstrip()).perft(1), 0)
+
+class TestAttackMap(unittest.TestCase):
+  def test_attack_map(self):
+    pins_sfen = 'k8/4r4/9/9/8b/9/6S2/4G4/4K4 b - 1'
+    for sfen in [t[0] for t in PERFT_POSITIONS] + [pins_sfen]:
+      pos = Position.from_sfen(sfen)
+      occupied = sum(1 << k for k, p in enumerate(pos.board) if p != shogi.piece.FREE)
+      for side in (1, -1):
+        for k in range(81):
+          b = sum(1 << j for j, p in enumerate(pos.board) if (p * side > 0) and ((shogi.bitboard.piece_attacks(p, j, occupied) >> k) & 1))
+          self.assertEqual(pos.attackers_to(k, side), b)
+        king = pos.find_king(side)
+        b = 0
+        for j, p in enumerate(pos.board):
+          if (p * side <= 0) or (j == king):
+            continue
+          board = list(pos.board)
+          board[j] = shogi.piece.FREE
+          t = Position.from_sfen(Position.build_sfen(board, pos.side_to_move, pos.move_no, pos.sente_pieces, pos.gote_pieces))
+          if t.attackers_to(king, -side) & ~pos.attackers_to(king, -side):
+            b |= 1 << j
+        self.assertEqual(pos.pinned(side), b)
+      self.assertEqual(pos.checkers(), pos.attackers_to(pos.find_king(pos.side_to_move), -pos.side_to_move))
+      self.assertEqual(pos.checkers() != 0, pos.is_check())
+    pos = Position.from_sfen(pins_sfen)
+    self.assertEqual(set(shogi.bitboard.cells(pos.pinned(1))), set(shogi.cell.usi_parse(t[0], t[1]) for t in ['3g', '5h']))
+    self.assertEqual(pos.pinned(-1), 0)
+
 _TEST_CASTLE_BY_POSITIONS = [
   ('ln1g3rl/1ks2bg2/2pp1snp1/pp2ppp1p/7P1/PPP1PPP1P/1SBP2N2/1KG1GS1R1/LN6L w - 38', 1, Castle.SILVER_CROWN),
   ('ln1g3nl/1ks3gr1/1ppppsbp1/p4pp1p/7P1/P1P2PP1P/1P1PPSN2/1BK1G2R1/LNSG4L b - 27', -1, Castle.HALF_MINO_CASTLE),